@@ -6,16 +6,19 @@ Advanced AI Music Recommendation System API
 from fastapi import FastAPI, HTTPException, Query, BackgroundTasks, Header, Depends
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse, ORJSONResponse, RedirectResponse, Response
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel
 from typing import List, Optional, Dict
 import uvicorn
 import os
+import json
+import orjson
 import asyncio
 import threading
 import httpx
 from pathlib import Path
+from urllib.parse import quote
 
 # Load environment variables from .env file
 try:
@@ -54,7 +57,8 @@ from src.database.models import init_database
 app = FastAPI(
     title="AI Music Recommendation System",
     description="Advanced, production-ready music recommendation API",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
 # Add Content Security Policy headers to block ads
@@ -109,6 +113,31 @@ async def startup_event():
 
     # Start Keep-Alive Loop (Render Support)
     asyncio.create_task(start_keep_alive_loop())
+    
+    # Start write-behind flush of room playback state
+    asyncio.create_task(start_room_state_flush_loop())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Persist buffered room state before the process exits"""
+    try:
+        flushed = await asyncio.to_thread(get_room_service().flush_dirty_rooms)
+        print(f"✓ Flushed state for {flushed} room(s)")
+    except Exception as e:
+        print(f"⚠ Room state flush error: {str(e)}")
+
+async def start_room_state_flush_loop():
+    """Background task that writes dirty room playback state to the database"""
+    interval = float(os.getenv("ROOM_STATE_FLUSH_INTERVAL", "5"))
+    room_service = get_room_service()
+    
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await asyncio.to_thread(room_service.flush_dirty_rooms)
+        except Exception as e:
+            # Log but continue (don't crash the loop)
+            print(f"⚠ Room state flush error: {str(e)}")
 
 async def start_keep_alive_loop():
     """Background task to ping the server every 5 minutes to prevent idle sleep"""
@@ -733,6 +762,13 @@ async def join_room(request: JoinRoomRequest, user_id: str = Depends(require_aut
         raise HTTPException(status_code=500, detail="Failed to join room")
 
 
+def _forget_socket_room_host(room_id: str):
+    """Drop the Socket.IO layer's recorded host after a room changes over HTTP"""
+    if has_socketio:
+        from src.services.websocket_service import forget_room_host
+        forget_room_host(room_id)
+
+
 @app.post("/api/v1/rooms/{room_id}/leave")
 async def leave_room(room_id: str, user_id: str = Depends(require_auth)):
     """
@@ -742,6 +778,7 @@ async def leave_room(room_id: str, user_id: str = Depends(require_auth)):
     try:
         room_service = get_room_service()
         result = room_service.leave_room(room_id, user_id)
+        _forget_socket_room_host(room_id)
         return {
             "status": "success",
             **result
@@ -777,6 +814,33 @@ async def get_room_state(room_id: str, user_id: str = Depends(require_auth)):
         raise HTTPException(status_code=500, detail="Failed to get room")
 
 
+@app.get("/api/v1/rooms/{room_id}/events")
+async def room_events(room_id: str, user_id: str = Depends(require_auth)):
+    """
+    Stream room state changes as server-sent events.
+    Sends the current state first, then a "state_updated" event for each
+    host update; replaces polling GET /api/v1/rooms/{room_id}.
+    Requires authentication; only active participants can subscribe.
+    """
+    room_service = get_room_service()
+    room_state = await asyncio.to_thread(room_service.get_room_state, room_id)
+    if not room_state:
+        raise HTTPException(status_code=404, detail="Room not found")
+    if user_id not in room_state.get("participants", []):
+        raise HTTPException(status_code=403, detail="Not a participant in this room")
+    
+    async def event_stream():
+        # Async generator: waits on the event loop, not a threadpool thread
+        yield b"data: " + orjson.dumps({"type": "room_state", **room_state}) + b"\n\n"
+        async for event in room_service.listen_room_events(room_id):
+            if event is None:
+                yield b": keep-alive\n\n"
+            else:
+                yield b"data: " + orjson.dumps(event) + b"\n\n"
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+
 @app.get("/api/v1/rooms")
 async def get_user_rooms(user_id: str = Depends(require_auth)):
     """
@@ -799,7 +863,8 @@ async def get_user_rooms(user_id: str = Depends(require_auth)):
 @app.get("/api/v1/songs/search")
 async def search_songs(
     q: str = Query(..., description="Search query"),
-    limit: int = Query(20, ge=1, le=50, description="Maximum number of results")
+    limit: int = Query(20, ge=1, le=50, description="Maximum number of results"),
+    thumb: bool = Query(True, description="Include small thumbnail URLs (thumb=0 for full-res only)")
 ):
     """
     Search for songs with metadata and images.
@@ -807,6 +872,7 @@ async def search_songs(
     Args:
         q: Search query (song title, artist, etc.)
         limit: Maximum number of results (1-50)
+        thumb: Add a 'thumbnail' proxy URL (128px WebP) next to each 'image'
     """
     import logging
     logger = logging.getLogger(__name__)
@@ -827,6 +893,12 @@ async def search_songs(
         search_service = get_song_search_service()
         results = search_service.search_songs(query, limit)
         
+        if thumb:
+            for song in results:
+                image = song.get('image')
+                if image and search_service.is_thumbnail_source(image):
+                    song['thumbnail'] = f"/api/v1/images/thumb?url={quote(image, safe='')}"
+        
         logger.info(f"Search completed: {len(results)} results for '{query}'")
         
         return {
@@ -850,6 +922,30 @@ async def search_songs(
         }
 
 
+@app.get("/api/v1/images/thumb")
+async def image_thumbnail(
+    url: str = Query(..., description="Artwork URL from a search result"),
+    size: int = Query(128, ge=32, le=512, description="Maximum width/height in pixels")
+):
+    """
+    Serve a small WebP thumbnail of search artwork.
+    Falls back to redirecting to the original image if it can't be resized.
+    """
+    search_service = get_song_search_service()
+    if not search_service.is_thumbnail_source(url):
+        raise HTTPException(status_code=400, detail="Unsupported image URL")
+    
+    thumbnail = await asyncio.to_thread(search_service.get_thumbnail, url, size)
+    if thumbnail is None:
+        return RedirectResponse(url)
+    
+    return Response(
+        content=thumbnail,
+        media_type="image/webp",
+        headers={"Cache-Control": "public, max-age=86400"}
+    )
+
+
 def check_and_analyze_seed_songs(user_id: str):
     """
     Check if user has seed songs and automatically trigger analysis.
@@ -963,23 +1059,23 @@ async def analyze_taste(request: TasteAnalysisRequest, background_tasks: Backgro
         history_service = get_listening_history_service()
         song_storage = get_song_storage_service()
         
-        # Save seed songs to JSON storage
+        # Save seed songs to storage in one batch
         seed_songs = []
+        song_dicts = []
         for song in request.seed_songs:
-            song_dict = {
+            song_dicts.append({
                 "title": song.title,
                 "artists": song.artists,
                 "genre": song.genre or [],
                 "album": getattr(song, 'album', None) or "",
                 "image": getattr(song, 'image', None) or ""
-            }
-            # Save to storage
-            song_storage.add_song(song_dict, user_id=request.user_id)
+            })
             seed_songs.append({
                 "title": song.title,
                 "artists": song.artists,
                 "genre": song.genre or []
             })
+        song_storage.add_songs_bulk(song_dicts, user_id=request.user_id)
         
         # Get songs from JSON storage (includes saved seed songs)
         stored_songs = song_storage.get_songs_for_analysis(request.user_id)
@@ -1379,8 +1475,10 @@ async def chat_message(request: ChatMessageRequest):
     try:
         rj_service = get_rj_service()
         
-        # Use the new chat() method with integrated mood analysis and rate limiting
-        result = rj_service.chat(request.message, request.user_id)
+        # Use the new chat() method with integrated mood analysis and rate limiting.
+        # It makes blocking LLM HTTP calls, so run it in a worker thread to keep
+        # the event loop free for other requests.
+        result = await asyncio.to_thread(rj_service.chat, request.message, request.user_id)
         
         # Check if rate limited
         if result.get("rate_limited"):
@@ -1422,6 +1520,24 @@ async def chat_message(request: ChatMessageRequest):
         logging.error(traceback.format_exc())
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/v1/chat/stream")
+async def chat_message_stream(request: ChatMessageRequest):
+    """
+    Stream an RJ reply as server-sent events.
+    
+    Emits a "mood" event, then "delta" events with reply text as the model
+    generates it, then a "done" event carrying the same fields as
+    /api/v1/chat/message (response, mood, songs, rate_limited, ...).
+    """
+    rj_service = get_rj_service()
+    
+    def event_stream():
+        # Sync generator: Starlette iterates it in a worker thread
+        for event in rj_service.chat_stream(request.message, request.user_id):
+            yield b"data: " + orjson.dumps(event) + b"\n\n"
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
 @app.get("/api/v1/chat/history")
 async def get_chat_history(user_id: str, limit: int = 20):
     """Get chat conversation history"""
@@ -1820,6 +1936,7 @@ async def leave_room(room_id: str, user_id: str = Depends(require_auth)):
     try:
         room_service = get_room_service()
         result = room_service.leave_room(room_id, user_id)
+        _forget_socket_room_host(room_id)
         return {
             "status": "success",
             **result
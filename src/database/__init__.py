@@ -15,6 +15,7 @@ from src.database.models import (
     SessionLocal,
     engine
 )
+from src.database.session import session_scope, use_session
 
 __all__ = [
     "Base",
@@ -27,6 +28,8 @@ __all__ = [
     "init_database",
     "get_db",
     "SessionLocal",
-    "engine"
+    "engine",
+    "session_scope",
+    "use_session"
 ]
 
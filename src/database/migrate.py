@@ -1,3 +1,4 @@
+import json
 import os
 import sys
 from pathlib import Path
@@ -15,7 +16,7 @@ if env_path.exists():
 else:
     load_dotenv() # Try default
 
-from src.database.models import engine
+from src.database.models import engine, song_search_blob
 
 def migrate():
     """Run database migrations"""
@@ -44,6 +45,176 @@ def migrate():
             
     else:
         print("⚠ 'users' table not found. Run init_database() first.")
+    
+    # Check room_participants indexes
+    if inspector.has_table("room_participants"):
+        indexes = {i["name"] for i in inspector.get_indexes("room_participants")}
+        
+        # Unique (room_id, user_id) index backs the join_room upsert
+        required_indexes = {
+            "ix_rp_room_user": "CREATE UNIQUE INDEX ix_rp_room_user ON room_participants (room_id, user_id)",
+            "ix_rp_user_active": "CREATE INDEX ix_rp_user_active ON room_participants (user_id, is_active)",
+        }
+        # Rows to drop before an index can be built; the old check-then-insert
+        # join could leave duplicate (room_id, user_id) rows. Keep one per
+        # pair, preferring an active row, then the most recently seen.
+        cleanups = {
+            "ix_rp_room_user": (
+                "DELETE FROM room_participants WHERE id IN ("
+                "SELECT id FROM (SELECT id, ROW_NUMBER() OVER ("
+                "PARTITION BY room_id, user_id "
+                "ORDER BY CASE WHEN is_active THEN 1 ELSE 0 END DESC, last_seen DESC, id DESC"
+                ") AS rn FROM room_participants) ranked WHERE rn > 1)"
+            ),
+        }
+        for index_name, ddl in required_indexes.items():
+            if index_name not in indexes:
+                print(f"⚠ Index '{index_name}' missing on 'room_participants'. Adding it...")
+                with engine.connect() as conn:
+                    try:
+                        if index_name in cleanups:
+                            conn.execute(text(cleanups[index_name]))
+                        conn.execute(text(ddl))
+                        conn.commit()
+                        print(f"✓ Added '{index_name}' index successfully")
+                    except Exception as e:
+                        hint = " (remove duplicate participants first)" if index_name in cleanups else ""
+                        print(f"✗ Failed to add index '{index_name}'{hint}: {e}")
+            else:
+                print(f"✓ '{index_name}' index exists")
+    
+    # Check user_songs unique (user_id, song_id) index
+    if inspector.has_table("user_songs"):
+        indexes = {i["name"] for i in inspector.get_indexes("user_songs")}
+        
+        if "ix_user_songs_user_song" not in indexes:
+            print("⚠ Index 'ix_user_songs_user_song' missing on 'user_songs'. Adding it...")
+            with engine.connect() as conn:
+                try:
+                    # Drop duplicate links first, keeping the oldest row
+                    conn.execute(text(
+                        "DELETE FROM user_songs WHERE id NOT IN "
+                        "(SELECT MIN(id) FROM user_songs GROUP BY user_id, song_id)"
+                    ))
+                    conn.execute(text("CREATE UNIQUE INDEX ix_user_songs_user_song ON user_songs (user_id, song_id)"))
+                    conn.commit()
+                    print("✓ Added 'ix_user_songs_user_song' index successfully")
+                except Exception as e:
+                    print(f"✗ Failed to add index 'ix_user_songs_user_song': {e}")
+        else:
+            print("✓ 'ix_user_songs_user_song' index exists")
+    
+    # Check taste_profiles taste_vector_bytes column
+    if inspector.has_table("taste_profiles"):
+        columns = [c["name"] for c in inspector.get_columns("taste_profiles")]
+        
+        if "taste_vector_bytes" not in columns:
+            print("⚠ Column 'taste_vector_bytes' missing in 'taste_profiles' table. Adding it...")
+            blob_type = "BYTEA" if engine.dialect.name == "postgresql" else "BLOB"
+            with engine.connect() as conn:
+                try:
+                    # Existing profiles keep their JSON vector until next saved
+                    conn.execute(text(f"ALTER TABLE taste_profiles ADD COLUMN taste_vector_bytes {blob_type}"))
+                    conn.commit()
+                    print("✓ Added 'taste_vector_bytes' column successfully")
+                except Exception as e:
+                    print(f"✗ Failed to add column: {e}")
+        else:
+            print("✓ 'taste_vector_bytes' column exists")
+    
+    # Check songs search_blob column
+    if inspector.has_table("songs"):
+        columns = [c["name"] for c in inspector.get_columns("songs")]
+        
+        if "search_blob" not in columns:
+            print("⚠ Column 'search_blob' missing in 'songs' table. Adding it...")
+            with engine.connect() as conn:
+                try:
+                    conn.execute(text("ALTER TABLE songs ADD COLUMN search_blob TEXT"))
+                    conn.commit()
+                    print("✓ Added 'search_blob' column successfully")
+                except Exception as e:
+                    print(f"✗ Failed to add column: {e}")
+        else:
+            print("✓ 'search_blob' column exists")
+        
+        # Backfill rows created before the column existed
+        with engine.connect() as conn:
+            try:
+                rows = conn.execute(text(
+                    "SELECT song_id, title, artists, genre FROM songs WHERE search_blob IS NULL"
+                )).all()
+                if rows:
+                    print(f"⚠ Backfilling 'search_blob' for {len(rows)} songs...")
+                    conn.execute(
+                        text("UPDATE songs SET search_blob = :blob WHERE song_id = :song_id"),
+                        [
+                            {
+                                "song_id": row.song_id,
+                                "blob": song_search_blob(row.title, _json_list(row.artists), _json_list(row.genre)),
+                            }
+                            for row in rows
+                        ]
+                    )
+                    conn.commit()
+                    print("✓ Backfilled 'search_blob' successfully")
+            except Exception as e:
+                print(f"✗ Failed to backfill 'search_blob': {e}")
+    
+    # Check songs lower(title) index
+    if inspector.has_table("songs"):
+        indexes = {i["name"] for i in inspector.get_indexes("songs")}
+        
+        if "ix_songs_title_lower" not in indexes:
+            print("⚠ Index 'ix_songs_title_lower' missing on 'songs'. Adding it...")
+            with engine.connect() as conn:
+                try:
+                    conn.execute(text("CREATE INDEX ix_songs_title_lower ON songs (lower(title))"))
+                    conn.commit()
+                    print("✓ Added 'ix_songs_title_lower' index successfully")
+                except Exception as e:
+                    print(f"✗ Failed to add index 'ix_songs_title_lower': {e}")
+        else:
+            print("✓ 'ix_songs_title_lower' index exists")
+    
+    # Trigram indexes for song search (PostgreSQL only)
+    if engine.dialect.name == "postgresql" and inspector.has_table("songs"):
+        indexes = {i["name"] for i in inspector.get_indexes("songs")}
+        
+        # Title-only trigram index superseded by songs_blob_trgm_idx; drop it so
+        # inserts don't maintain an index no query uses
+        if "songs_title_trgm_idx" in indexes:
+            with engine.connect() as conn:
+                try:
+                    conn.execute(text("DROP INDEX IF EXISTS songs_title_trgm_idx"))
+                    conn.commit()
+                    print("✓ Dropped unused 'songs_title_trgm_idx' index")
+                except Exception as e:
+                    print(f"✗ Failed to drop index 'songs_title_trgm_idx': {e}")
+        
+        required_indexes = {
+            "songs_blob_trgm_idx": "CREATE INDEX songs_blob_trgm_idx ON songs USING gin (search_blob gin_trgm_ops)",
+        }
+        for index_name, ddl in required_indexes.items():
+            if index_name not in indexes:
+                print(f"⚠ Index '{index_name}' missing on 'songs'. Adding it...")
+                with engine.connect() as conn:
+                    try:
+                        conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+                        conn.execute(text(ddl))
+                        conn.commit()
+                        print(f"✓ Added '{index_name}' index successfully")
+                    except Exception as e:
+                        print(f"✗ Failed to add index '{index_name}': {e}")
+            else:
+                print(f"✓ '{index_name}' index exists")
+
+
+def _json_list(value):
+    """Decode a JSON array column fetched through a raw text() query"""
+    if isinstance(value, str):
+        return json.loads(value or "[]")
+    return value or []
 
 if __name__ == "__main__":
     migrate()
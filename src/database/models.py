@@ -3,7 +3,7 @@ Database Models
 SQLAlchemy models for user data and listening history
 """
 
-from sqlalchemy import create_engine, Column, String, Integer, DateTime, Text, JSON, ForeignKey, Float, Boolean
+from sqlalchemy import create_engine, Column, String, Integer, DateTime, Text, JSON, ForeignKey, Float, Boolean, LargeBinary, Index, DDL, event, func
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 from datetime import datetime
@@ -65,10 +65,37 @@ class Song(Base):
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
     last_updated = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
     extra_data = Column(JSON, default=dict)  # Additional metadata
+    search_blob = Column(Text, nullable=True)  # Lowercased title + artists + genre, see song_search_blob()
     
     # Relationships
     user_songs = relationship("UserSong", back_populates="song", cascade="all, delete-orphan")
     listening_history = relationship("ListeningHistory", back_populates="song")
+    
+    __table_args__ = (
+        # B-tree index for the case-insensitive duplicate-title lookups
+        Index("ix_songs_title_lower", func.lower(title)),
+        # Trigram index for fuzzy search over title, artists and genre
+        # (PostgreSQL only, needs pg_trgm)
+        Index(
+            "songs_blob_trgm_idx",
+            search_blob,
+            postgresql_using="gin",
+            postgresql_ops={"search_blob": "gin_trgm_ops"},
+        ).ddl_if(dialect="postgresql"),
+    )
+
+
+def song_search_blob(title: str, artists, genre) -> str:
+    """Build the denormalized text searched by SongStorageService.search_songs"""
+    return " ".join([title or "", *(artists or []), *(genre or [])]).lower()
+
+
+# gin_trgm_ops must exist before create_all() builds the trigram indexes
+event.listen(
+    Base.metadata,
+    "before_create",
+    DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect="postgresql"),
+)
 
 
 class UserSong(Base):
@@ -87,6 +114,10 @@ class UserSong(Base):
     # Relationships
     user = relationship("User", back_populates="user_songs")
     song = relationship("Song", back_populates="user_songs")
+    
+    __table_args__ = (
+        Index("ix_user_songs_user_song", "user_id", "song_id", unique=True),  # add_song_to_user upsert
+    )
 
 
 class ListeningHistory(Base):
@@ -116,7 +147,8 @@ class TasteProfile(Base):
     
     id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(String(255), ForeignKey("users.user_id", ondelete="CASCADE"), nullable=False, unique=True, index=True)
-    profile_data = Column(JSON, nullable=False)  # Taste vector, preferences, etc.
+    profile_data = Column(JSON, nullable=False)  # Seed songs, preferences, etc.
+    taste_vector_bytes = Column(LargeBinary, nullable=True)  # Taste vector as raw float32 bytes
     song_count = Column(Integer, default=0)
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
     last_updated = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
@@ -194,8 +226,10 @@ class RoomParticipant(Base):
     room = relationship("MusicRoom", back_populates="participants")
     user = relationship("User", back_populates="room_participants")
     
-    # Unique constraint: one entry per user per room
+    # Unique constraint: one entry per user per room (target of the join upsert)
     __table_args__ = (
+        Index("ix_rp_room_user", "room_id", "user_id", unique=True),
+        Index("ix_rp_user_active", "user_id", "is_active"),  # get_user_rooms
         {"sqlite_autoincrement": True},
     )
 
@@ -313,23 +347,24 @@ def create_engine_instance():
         engine = create_engine(
             database_url,
             pool_pre_ping=True,  # Verify connections before using
-            pool_size=5,  # Connection pool size
-            max_overflow=10,  # Max overflow connections
+            pool_size=20,  # Connection pool size
+            max_overflow=20,  # Max overflow connections
+            pool_timeout=30,  # Seconds to wait for a free connection
+            pool_recycle=1800,  # Recycle connections before server-side idle timeouts
             echo=False  # Set to True for SQL query logging
         )
     
     return engine
 
 
-def get_session_local():
-    """Get database session factory"""
-    engine = create_engine_instance()
-    return sessionmaker(autocommit=False, autoflush=False, bind=engine)
+def get_session_local(bind=None):
+    """Get database session factory (bound to the shared engine by default)"""
+    return sessionmaker(autocommit=False, autoflush=False, bind=bind or engine)
 
 
 # Create engine and session factory
 engine = create_engine_instance()
-SessionLocal = get_session_local()
+SessionLocal = get_session_local(engine)
 
 
 def init_database():
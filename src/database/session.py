@@ -0,0 +1,41 @@
+"""
+Database Sessions
+Transactional session scope shared by the services
+"""
+
+from contextlib import contextmanager
+from typing import Iterator
+
+from sqlalchemy.orm import Session
+
+from src.database.models import SessionLocal, engine
+
+
+@contextmanager
+def session_scope() -> Iterator[Session]:
+    """
+    Provide a session from the shared engine's pool.
+    
+    Sessions are cheap: the connection is checked out of the engine's
+    QueuePool on first use, so short requests skip the TCP/TLS handshake.
+    The caller commits; any exception rolls the session back, and the
+    session is always closed so its connection goes back to the pool.
+    """
+    db: Session = SessionLocal()
+    try:
+        yield db
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+@contextmanager
+def use_session(db: Session = None) -> Iterator[Session]:
+    """Yield the injected session as-is, or open a new ``session_scope()``"""
+    if db is not None:
+        yield db
+        return
+    with session_scope() as db:
+        yield db
@@ -62,27 +62,27 @@ class AuthService:
         try:
             # Check if user already exists
             email_lower = email.lower().strip()
-            existing_user = db.query(User).filter(
-                User.email.ilike(email_lower)
-            ).first()
+            email_taken = db.query(
+                db.query(User).filter(User.email.ilike(email_lower)).exists()
+            ).scalar()
             
-            if existing_user:
+            if email_taken:
                 raise ValueError("Email already registered")
             
             # Check username uniqueness if provided
             if username:
                 username_lower = username.lower().strip()
-                existing_username = db.query(User).filter(
-                    User.username.ilike(username_lower)
-                ).first()
-                if existing_username:
+                username_taken = db.query(
+                    db.query(User).filter(User.username.ilike(username_lower)).exists()
+                ).scalar()
+                if username_taken:
                     raise ValueError("Username already taken")
             else:
                 # Generate default username from email
                 base_username = email.split('@')[0]
                 username = base_username
                 # Simple check to avoid collision on default
-                if db.query(User).filter(User.username == username).first():
+                if db.query(db.query(User).filter(User.username == username).exists()).scalar():
                     username = f"{base_username}_{secrets.token_hex(4)}"
 
             # Create new user
@@ -10,7 +10,7 @@ import numpy as np
 from typing import Dict, List, Optional, Tuple
 from datetime import datetime
 from src.services.llm_sentiment_service import get_llm_sentiment_service
-from src.services.embedding_service import EmbeddingService
+from src.services.embedding_service import get_embedding_service
 
 
 class ChatbotService:
@@ -22,7 +22,7 @@ class ChatbotService:
         # Initialize LLM sentiment service
         self.llm_sentiment = get_llm_sentiment_service()
         # Initialize embedding service for taste profile integration
-        self.embedding_service = EmbeddingService()
+        self.embedding_service = get_embedding_service()
     
     def analyze_sentiment(self, message: str) -> Tuple[str, float, str]:
         """
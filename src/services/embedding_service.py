@@ -252,6 +252,27 @@ class EmbeddingService:
         """
         return float(np.dot(vec1, vec2) / (np.linalg.norm(vec1) * np.linalg.norm(vec2)))
     
+    def cosine_similarities(self, query: np.ndarray, vectors: np.ndarray) -> np.ndarray:
+        """
+        Compute cosine similarity between a query and every row of a matrix.
+        
+        Runs as a single float32 matrix-vector product (BLAS SGEMV) instead
+        of one cosine_similarity call per vector.
+        
+        Args:
+            query: Query vector of shape (dim,)
+            vectors: Matrix of shape (n, dim)
+            
+        Returns:
+            Array of n similarity scores (0.0 where a vector has zero norm)
+        """
+        matrix = np.ascontiguousarray(vectors, dtype=np.float32)
+        query = np.asarray(query, dtype=np.float32)
+        
+        norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(query)
+        dots = matrix @ query
+        return np.divide(dots, norms, out=np.zeros_like(dots), where=norms > 0)
+    
     def get_cache_stats(self) -> Dict:
         """Get statistics about the embedding cache"""
         return {
@@ -261,3 +282,13 @@ class EmbeddingService:
             "embedding_dim": self.embedding_dim
         }
 
+
+# Singleton instance
+_embedding_service = None
+
+def get_embedding_service() -> EmbeddingService:
+    """Get singleton instance of EmbeddingService"""
+    global _embedding_service
+    if _embedding_service is None:
+        _embedding_service = EmbeddingService()
+    return _embedding_service
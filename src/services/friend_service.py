@@ -5,21 +5,144 @@ Handles friend requests, friendships, and user search by username
 
 from sqlalchemy.orm import Session
 from sqlalchemy import or_, and_
-from typing import List, Optional, Dict
+from typing import List, Optional, Dict, Set
 from datetime import datetime
+from threading import Lock
+import os
 import logging
 
 from src.database.models import User, FriendRequest, Friendship, SessionLocal
+from src.services.ttl_cache import TTLCache
 
 logger = logging.getLogger(__name__)
 
+# Try to import Redis client (optional shared friendship cache)
+try:
+    import redis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+
+# Member stored in every cached friend set so "loaded, no friends" isn't a miss
+_LOADED_MARKER = ""
+
+# Max friend sets kept in the in-process cache (used without Redis)
+_LOCAL_FRIENDS_CACHE_SIZE = 10000
+
+# Bumped on every friendship change; a loader only writes its set back if the
+# generation is unchanged since it read the database, so it can't restore a
+# stale set over a concurrent accept/remove
+_GENERATION_KEY = "friends:generation"
+
+# KEYS: friends:{user}, generation key; ARGV: generation seen, ttl, members...
+_STORE_FRIENDS_SCRIPT = """
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[1] then return 0 end
+redis.call('DEL', KEYS[1])
+redis.call('SADD', KEYS[1], unpack(ARGV, 3))
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+# KEYS: friends:{a}, friends:{b}, generation key; ARGV: SADD|SREM, a, b
+# Only sets that are already cached are touched
+_CHANGE_FRIENDSHIP_SCRIPT = """
+redis.call('INCR', KEYS[3])
+if redis.call('EXISTS', KEYS[1]) == 1 then redis.call(ARGV[1], KEYS[1], ARGV[3]) end
+if redis.call('EXISTS', KEYS[2]) == 1 then redis.call(ARGV[1], KEYS[2], ARGV[2]) end
+return 1
+"""
+
 
 class FriendService:
     """Service for managing friendships and friend requests"""
     
     def __init__(self):
         """Initialize friend service"""
-        pass
+        # Friend-ID sets per user for O(1) are_friends checks: Redis sets
+        # friends:{user_id} when REDIS_URL is set, otherwise a local dict
+        self.friends_cache_ttl = int(os.getenv("FRIENDS_CACHE_TTL", "3600"))
+        self._friends_cache = TTLCache(max_size=_LOCAL_FRIENDS_CACHE_SIZE, ttl=self.friends_cache_ttl)
+        self._friends_generation = 0
+        self._friends_lock = Lock()
+        self._redis = None
+        
+        redis_url = os.getenv("REDIS_URL")
+        if redis_url and REDIS_AVAILABLE:
+            self._redis = redis.Redis(
+                connection_pool=redis.ConnectionPool.from_url(redis_url, decode_responses=True)
+            )
+            self._store_friends = self._redis.register_script(_STORE_FRIENDS_SCRIPT)
+            self._change_friendship = self._redis.register_script(_CHANGE_FRIENDSHIP_SCRIPT)
+    
+    def _load_friend_ids(self, user_id: str) -> Set[str]:
+        """Load a user's friend IDs from the database and cache them"""
+        # Note the generation first; the set is only cached if no friendship
+        # changed while the database was being read
+        if self._redis is None:
+            with self._friends_lock:
+                generation = self._friends_generation
+        else:
+            try:
+                generation = self._redis.get(_GENERATION_KEY) or "0"
+            except redis.RedisError as e:
+                logger.warning(f"Failed to read friends generation: {e}")
+                generation = None
+        
+        db: Session = SessionLocal()
+        try:
+            rows = db.query(Friendship.user1_id, Friendship.user2_id).filter(
+                or_(
+                    Friendship.user1_id == user_id,
+                    Friendship.user2_id == user_id
+                )
+            ).all()
+        finally:
+            db.close()
+        
+        friend_ids = {u2 if u1 == user_id else u1 for u1, u2 in rows}
+        
+        if self._redis is None:
+            with self._friends_lock:
+                if self._friends_generation == generation:
+                    self._friends_cache.put(user_id, friend_ids)
+            return friend_ids
+        
+        if generation is not None:
+            try:
+                self._store_friends(
+                    keys=[f"friends:{user_id}", _GENERATION_KEY],
+                    args=[generation, self.friends_cache_ttl, _LOADED_MARKER, *friend_ids]
+                )
+            except redis.RedisError as e:
+                logger.warning(f"Failed to cache friends of {user_id}: {e}")
+        return friend_ids
+    
+    def _update_cached_friendship(self, user1_id: str, user2_id: str, added: bool):
+        """Add or remove a friendship in both users' cached friend sets"""
+        if self._redis is None:
+            with self._friends_lock:
+                self._friends_generation += 1
+                for owner_id, friend_id in ((user1_id, user2_id), (user2_id, user1_id)):
+                    friend_ids = self._friends_cache.get(owner_id)
+                    if friend_ids is not None:
+                        if added:
+                            friend_ids.add(friend_id)
+                        else:
+                            friend_ids.discard(friend_id)
+            return
+        
+        try:
+            self._change_friendship(
+                keys=[f"friends:{user1_id}", f"friends:{user2_id}", _GENERATION_KEY],
+                args=["SADD" if added else "SREM", user1_id, user2_id]
+            )
+        except redis.RedisError as e:
+            # Drop the sets rather than leave them stale
+            logger.warning(f"Failed to update cached friends: {e}")
+            try:
+                self._redis.delete(f"friends:{user1_id}", f"friends:{user2_id}")
+            except redis.RedisError:
+                pass
     
     def search_user_by_username(self, username: str, limit: int = 20) -> List[Dict]:
         """
@@ -104,8 +227,10 @@ class FriendService:
         db: Session = SessionLocal()
         try:
             # Validate sender
-            sender = db.query(User).filter(User.user_id == sender_id).first()
-            if not sender:
+            sender_exists = db.query(
+                db.query(User).filter(User.user_id == sender_id).exists()
+            ).scalar()
+            if not sender_exists:
                 raise ValueError("Sender not found")
             
             # Find receiver by username
@@ -120,14 +245,16 @@ class FriendService:
                 raise ValueError("Cannot send friend request to yourself")
             
             # Check if already friends
-            existing_friendship = db.query(Friendship).filter(
-                or_(
-                    and_(Friendship.user1_id == sender_id, Friendship.user2_id == receiver.user_id),
-                    and_(Friendship.user1_id == receiver.user_id, Friendship.user2_id == sender_id)
-                )
-            ).first()
-            
-            if existing_friendship:
+            already_friends = db.query(
+                db.query(Friendship).filter(
+                    or_(
+                        and_(Friendship.user1_id == sender_id, Friendship.user2_id == receiver.user_id),
+                        and_(Friendship.user1_id == receiver.user_id, Friendship.user2_id == sender_id)
+                    )
+                ).exists()
+            ).scalar()
+            
+            if already_friends:
                 raise ValueError("Already friends with this user")
             
             # Check for existing pending request
@@ -202,8 +329,9 @@ class FriendService:
                 raise ValueError("Friend request not found")
             
             # Update request status
+            now = datetime.utcnow()
             friend_request.status = "accepted"
-            friend_request.responded_at = datetime.utcnow()
+            friend_request.responded_at = now
             
             # Create friendship (bidirectional)
             # Store with lower user_id first for consistency
@@ -213,11 +341,12 @@ class FriendService:
             friendship = Friendship(
                 user1_id=user1_id,
                 user2_id=user2_id,
-                created_at=datetime.utcnow()
+                created_at=now
             )
             
             db.add(friendship)
             db.commit()
+            self._update_cached_friendship(sender_id, receiver_id, added=True)
             
             logger.info(f"Friend request accepted: {sender_id} <-> {receiver_id}")
             
@@ -418,6 +547,7 @@ class FriendService:
             
             db.delete(friendship)
             db.commit()
+            self._update_cached_friendship(user_id, friend_id, added=False)
             
             logger.info(f"Friendship removed: {user_id} <-> {friend_id}")
             
@@ -444,23 +574,28 @@ class FriendService:
         Returns:
             True if friends, False otherwise
         """
-        db: Session = SessionLocal()
         try:
-            user1_id_sorted = min(user1_id, user2_id)
-            user2_id_sorted = max(user1_id, user2_id)
-            
-            friendship = db.query(Friendship).filter(
-                Friendship.user1_id == user1_id_sorted,
-                Friendship.user2_id == user2_id_sorted
-            ).first()
-            
-            return friendship is not None
+            # Cached friend set of user1 (loaded from the database on a miss)
+            if self._redis is None:
+                with self._friends_lock:
+                    friend_ids = self._friends_cache.get(user1_id)
+                    if friend_ids is not None:
+                        return user2_id in friend_ids
+            else:
+                try:
+                    pipe = self._redis.pipeline()
+                    pipe.sismember(f"friends:{user1_id}", _LOADED_MARKER)
+                    pipe.sismember(f"friends:{user1_id}", user2_id)
+                    loaded, is_friend = pipe.execute()
+                    if loaded:
+                        return bool(is_friend)
+                except redis.RedisError as e:
+                    logger.warning(f"Failed to read cached friends of {user1_id}: {e}")
+            
+            return user2_id in self._load_friend_ids(user1_id)
         except Exception as e:
             logger.error(f"Error checking friendship: {e}")
             return False
-        finally:
-            db.close()
-
 
 # Singleton instance
 _friend_service = None
@@ -6,14 +6,21 @@ Tracks songs users listen to and uses them for analysis - Database version
 from typing import List, Dict, Optional
 from datetime import datetime, timedelta
 from sqlalchemy.orm import Session
-from sqlalchemy import func, desc, and_
+from sqlalchemy import func, desc
+from sqlalchemy.dialects import postgresql, sqlite
 from collections import defaultdict
 
 from src.database.models import (
-    ListeningHistory, Song, UserSong, SessionLocal
+    ListeningHistory, Song, UserSong, SessionLocal, song_search_blob
 )
 import secrets
 
+# Dialect-specific INSERT constructs supporting ON CONFLICT upserts
+_DIALECT_INSERTS = {
+    "postgresql": postgresql.insert,
+    "sqlite": sqlite.insert,
+}
+
 
 class ListeningHistoryService:
     """Service for tracking and analyzing user listening history"""
@@ -41,6 +48,7 @@ class ListeningHistoryService:
         if not song:
             # Create new song
             song_id = f"song_{secrets.token_hex(12)}"
+            now = datetime.utcnow()
             song = Song(
                 song_id=song_id,
                 title=title,
@@ -50,8 +58,9 @@ class ListeningHistoryService:
                 image=image or "",
                 platform=platform or "unknown",
                 platform_id=platform_id,
-                created_at=datetime.utcnow(),
-                last_updated=datetime.utcnow()
+                created_at=now,
+                last_updated=now,
+                search_blob=song_search_blob(title, artists, genre)
             )
             db.add(song)
             db.commit()
@@ -98,12 +107,13 @@ class ListeningHistoryService:
             )
             
             # Create listening history entry
+            now = datetime.utcnow()
             entry = ListeningHistory(
                 user_id=user_id,
                 song_id=song.song_id,
                 song_title=song_title,
                 artists=artists,
-                timestamp=datetime.utcnow(),
+                timestamp=now,
                 source=source,
                 platform=platform,
                 duration_seconds=duration_seconds,
@@ -113,27 +123,23 @@ class ListeningHistoryService:
             
             db.add(entry)
             
-            # Update or create user_song entry
-            user_song = db.query(UserSong).filter(
-                and_(
-                    UserSong.user_id == user_id,
-                    UserSong.song_id == song.song_id
-                )
-            ).first()
-            
-            if user_song:
-                user_song.play_count += 1
-                user_song.last_played = datetime.utcnow()
-            else:
-                user_song = UserSong(
+            # Create the user_song link or bump its play count in one upsert,
+            # so overlapping listens of a new song can't collide on the
+            # unique (user_id, song_id) index
+            insert = _DIALECT_INSERTS[db.get_bind().dialect.name]
+            db.execute(
+                insert(UserSong).values(
                     user_id=user_id,
                     song_id=song.song_id,
                     source=source,
-                    added_at=datetime.utcnow(),
+                    added_at=now,
                     play_count=1,
-                    last_played=datetime.utcnow()
+                    last_played=now
+                ).on_conflict_do_update(
+                    index_elements=["user_id", "song_id"],
+                    set_={"play_count": UserSong.play_count + 1, "last_played": now}
                 )
-                db.add(user_song)
+            )
             
             db.commit()
         finally:
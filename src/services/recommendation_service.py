@@ -5,7 +5,7 @@ Generates music recommendations based on user taste profile
 
 import numpy as np
 from typing import List, Dict, Optional
-from src.services.embedding_service import EmbeddingService
+from src.services.embedding_service import get_embedding_service
 from src.services.song_search_service import get_song_search_service
 from src.services.taste_profile_service import get_taste_profile_service
 import logging
@@ -17,7 +17,7 @@ class RecommendationService:
     """Service for generating music recommendations"""
     
     def __init__(self):
-        self.embedding_service = EmbeddingService()
+        self.embedding_service = get_embedding_service()
         self.song_search_service = get_song_search_service()
         self.taste_profile_service = get_taste_profile_service()
         # Cache for in-memory profiles (loaded from DB)
@@ -206,20 +206,46 @@ class RecommendationService:
         # Get user feedback data for re-ranking
         feedback_scores = self._get_feedback_scores(user_id)
         
+        # Embed all candidates in one batch and score them against the taste
+        # vector with a single matrix-vector product
+        # (null artists/genre values are normalized so they can't fail the batch)
+        songs_to_embed = [
+            {
+                'title': candidate.get('title') or '',
+                'artists': candidate.get('artists') or ['Unknown'],
+                'genre': candidate.get('genre') or []
+            }
+            for candidate in all_candidates
+        ]
+        embedded_candidates = all_candidates
+        embeddings = []
+        if all_candidates:
+            try:
+                embeddings = [emb for emb, _ in self.embedding_service.embed_songs_batch(songs_to_embed)]
+            except Exception as e:
+                # Fall back to one candidate at a time, skipping only the ones that fail
+                logger.error(f"Error embedding candidates in batch, retrying individually: {e}")
+                embedded_candidates = []
+                for candidate, song in zip(all_candidates, songs_to_embed):
+                    try:
+                        emb, _ = self.embedding_service.embed_song(song['title'], song['artists'], song['genre'])
+                    except Exception as e:
+                        logger.error(f"Error embedding candidate {song['title']}: {e}")
+                        continue
+                    embedded_candidates.append(candidate)
+                    embeddings.append(emb)
+        
+        similarities = []
+        if embeddings:
+            similarities = self.embedding_service.cosine_similarities(
+                adjusted_taste_vector,
+                np.stack(embeddings)
+            )
+        
         # Score candidates with improved weighted scoring
         scored_candidates = []
-        for candidate in all_candidates:
+        for candidate, similarity in zip(embedded_candidates, similarities):
             try:
-                # Generate embedding for candidate
-                emb, _ = self.embedding_service.embed_song(
-                    candidate['title'],
-                    candidate.get('artists', ['Unknown']),
-                    candidate.get('genre', [])
-                )
-                
-                # Compute similarity to taste vector
-                similarity = self.embedding_service.cosine_similarity(adjusted_taste_vector, emb)
-                
                 # Compute genre match score
                 genre_match = 0.0
                 if genre and candidate.get('genre'):
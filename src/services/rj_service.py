@@ -6,54 +6,237 @@ and recommend songs based on conversation with rate limiting.
 
 import os
 import logging
+import random
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import orjson
 import re
 import time
 import hashlib
-from typing import Dict, List, Optional, Tuple
+from typing import Callable, Dict, FrozenSet, Iterator, List, Optional, Tuple
 from datetime import datetime
-from functools import wraps
-from collections import defaultdict
-from threading import Lock
+from functools import lru_cache, wraps
+from collections import Counter, OrderedDict, defaultdict, deque
+from threading import Lock, Semaphore
+from concurrent.futures import Future
+from bisect import bisect_right
 
 logger = logging.getLogger(__name__)
 
+# Canned RJ replies used when no LLM provider is available
+_FALLBACK_RESPONSES: Dict[str, Tuple[str, ...]] = {
+    "happy": (
+        "That's amazing! I love that energy! 🌟 What's got you feeling so good today?",
+        "YES! That positive vibe is contagious! Tell me more!"
+    ),
+    "sad": (
+        "I hear you, and I'm here for you. 💙 Music can really help at times like these...",
+        "It's okay to feel this way. Sometimes the best songs come from these moments."
+    ),
+    "calm": (
+        "That's a nice peaceful energy you've got going. What's on your mind?",
+        "I'm vibing with that chill mood! 🌙 Perfect for some smooth tunes."
+    ),
+    "energetic": (
+        "I can feel that energy through the airwaves! 🔥 Ready to turn it up?",
+        "That's what I'm talking about! Let's match that fire!"
+    )
+}
+
+# Song search queries used to find music for each mood
+_MOOD_QUERIES: Dict[str, str] = {
+    "happy": "upbeat happy feel good",
+    "sad": "emotional sad melancholic",
+    "angry": "intense aggressive rock",
+    "calm": "calm peaceful ambient",
+    "energetic": "energetic workout pump",
+    "tired": "soothing gentle sleep",
+    "anxious": "calming meditation peaceful",
+    "romantic": "romantic love ballad",
+    "nostalgic": "classic throwback oldies",
+    "focused": "lo-fi study instrumental",
+    "excited": "party dance energetic",
+    "melancholic": "sad emotional piano"
+}
+
+# Lines appended to the RJ reply when songs are recommended
+_MOOD_INTROS: Dict[str, str] = {
+    "happy": " I've got some feel-good tracks that'll keep that smile going! 🎵",
+    "sad": " Let me play something that understands exactly how you're feeling... 💙",
+    "energetic": " Time to turn it UP! Here's some high-energy tracks for you! 🔥",
+    "calm": " I've got some peaceful vibes coming your way... 🌙",
+    "romantic": " Aww, here's some songs to match that loving feeling! 💕",
+    "nostalgic": " Let's take a trip down memory lane with these classics! ✨",
+    "focused": " Here's some instrumental tracks to help you stay in the zone! 🎧"
+}
+
+# Moods the LLM may answer with
+_VALID_MOODS = frozenset({
+    "happy", "sad", "angry", "calm", "energetic", "tired",
+    "anxious", "romantic", "nostalgic", "focused", "excited", "melancholic"
+})
+
+# Static instructions sent as the system message, ahead of per-turn content
+_MOOD_SYSTEM_PROMPT = """You are analyzing the emotional state of a user chatting with a radio DJ.
+
+Based on the message and context, identify the user's current mood.
+Respond with ONLY ONE of these moods: happy, sad, angry, calm, energetic, tired, anxious, romantic, nostalgic, focused, excited, melancholic"""
+
+_RJ_SYSTEM_PROMPT = """You are a warm, friendly Radio Jockey (RJ) named Aura hosting a late-night music show. You chat with listeners about their feelings, life, and music preferences before suggesting songs.
+
+Your personality:
+- Warm, empathetic, and genuinely interested in listeners
+- Use casual language with occasional radio phrases like "Coming in hot!", "That's what I'm talking about!"
+- Reference music and artists naturally in conversation
+- Ask follow-up questions to understand the listener better
+- Keep responses concise (2-3 sentences max)
+- Use 1-2 emojis sparingly
+
+Respond as Aura the RJ. Be conversational - don't recommend songs yet unless they explicitly ask. Focus on connecting with the listener first."""
+
+# RJ persona plus mood detection, answered as a single JSON object
+_RJ_JSON_SYSTEM_PROMPT = _RJ_SYSTEM_PROMPT + """
+
+Also identify the listener's current mood as ONLY ONE of: happy, sad, angry, calm, energetic, tired, anxious, romantic, nostalgic, focused, excited, melancholic
+
+Respond in JSON: {"mood": "<mood>", "response": "<your reply as Aura>"}"""
+
+_JSON_OBJECT_RE = re.compile(r"\{.*\}", re.DOTALL)
+
+# Rough characters-per-token ratio for English text with BPE tokenizers
+_CHARS_PER_TOKEN = 4
+
+
+def _estimate_tokens(text: str) -> int:
+    """Cheap token count estimate used for prompt budgeting"""
+    return len(text) // _CHARS_PER_TOKEN + 1
+
+# Genre hints recognised in listener messages (single words or word pairs)
+_GENRE_KEYWORDS: Dict[str, FrozenSet[str]] = {
+    "rock": frozenset({"rock", "guitar", "metal", "punk"}),
+    "pop": frozenset({"pop", "catchy", "mainstream", "top 40"}),
+    "hip hop": frozenset({"hip hop", "rap", "hiphop", "beats"}),
+    "electronic": frozenset({"electronic", "edm", "techno", "house", "trance"}),
+    "r&b": frozenset({"r&b", "rnb", "soul", "neo-soul"}),
+    "jazz": frozenset({"jazz", "smooth", "saxophone"}),
+    "classical": frozenset({"classical", "orchestra", "symphony", "piano"}),
+    "country": frozenset({"country", "folk", "acoustic"}),
+    "indie": frozenset({"indie", "alternative", "underground"}),
+    "bollywood": frozenset({"bollywood", "hindi", "indian"})
+}
+
+# Mood keywords for the rule-based fallback
+_MOOD_KEYWORDS: Dict[str, FrozenSet[str]] = {
+    "happy": frozenset({"happy", "great", "awesome", "excited", "amazing", "good", "love"}),
+    "sad": frozenset({"sad", "depressed", "down", "upset", "lonely", "hurt"}),
+    "angry": frozenset({"angry", "mad", "furious", "annoyed", "frustrated"}),
+    "calm": frozenset({"calm", "peaceful", "relaxed", "chill"}),
+    "energetic": frozenset({"pumped", "workout", "gym", "running", "energy"}),
+    "tired": frozenset({"tired", "exhausted", "sleepy", "drained"}),
+    "anxious": frozenset({"anxious", "worried", "stressed", "nervous"}),
+    "romantic": frozenset({"romantic", "love", "dating", "crush"}),
+    "nostalgic": frozenset({"remember", "memories", "past", "childhood"})
+}
+
+
+
+def _build_genre_index() -> Dict[str, Tuple[str, ...]]:
+    """Invert the genre lexicon into keyword -> (genre, ...)"""
+    index: Dict[str, Tuple[str, ...]] = {}
+    for genre, keywords in _GENRE_KEYWORDS.items():
+        for keyword in keywords:
+            index[keyword] = index.get(keyword, ()) + (genre,)
+    return index
+
+
+_GENRE_INDEX = _build_genre_index()
+
+# All mood keywords as one case-insensitive alternation, one named group per
+# mood; the first keyword in the message decides the mood
+_MOOD_RE = re.compile(
+    "|".join(
+        rf"(?P<{mood}>\b(?:{'|'.join(map(re.escape, sorted(keywords)))})\b)"
+        for mood, keywords in _MOOD_KEYWORDS.items()
+    ),
+    re.IGNORECASE
+)
+
+_WORD_RE = re.compile(r"[a-z0-9&-]+")
+
+# Phrases that mean the listener is asking for music right now
+_SONG_TRIGGERS = (
+    "play", "song", "music", "recommend", "suggest", "listen",
+    "what should i", "any song", "play something", "put on",
+    "need music", "want music", "give me", "play me"
+)
+_SONG_TRIGGER_RE = re.compile("|".join(map(re.escape, _SONG_TRIGGERS)), re.IGNORECASE)
+
+# Speaker labels the model sometimes echoes at the start of a reply
+_SPEAKER_PREFIX_RE = re.compile(r'^(RJ|Aura|Radio Jockey)[:\s]+', re.IGNORECASE)
+
+
+def _tokenize(text: str) -> FrozenSet[str]:
+    """Lowercased words plus adjacent word pairs, for keyword set lookups"""
+    words = _WORD_RE.findall(text.lower())
+    return frozenset(words).union(f"{a} {b}" for a, b in zip(words, words[1:]))
+
+
+def _song_title_key(song: Dict) -> str:
+    """Lowercased title of a song dict that may be nested under a 'song' key"""
+    title = song.get("title")
+    if not title:
+        nested = song.get("song")
+        title = nested.get("title", "") if nested else ""
+    return title.lower()
+
+
+def _scan_genres(text: str) -> FrozenSet[str]:
+    """
+    Find every genre hinted at in a message with a single pass.
+    
+    Each token is looked up once in the genre keyword index.
+    """
+    hits = set()
+    for token in _tokenize(text):
+        hits.update(_GENRE_INDEX.get(token, ()))
+    return frozenset(hits)
+
 
 class RateLimiter:
-    """Token bucket rate limiter for API calls"""
+    """Sliding-window rate limiter for API calls"""
     
     def __init__(self, calls_per_minute: int = 30, calls_per_hour: int = 500):
         self.calls_per_minute = calls_per_minute
         self.calls_per_hour = calls_per_hour
-        self.minute_calls = defaultdict(list)  # user_id -> [timestamps]
-        self.hour_calls = defaultdict(list)
+        # user_id -> monotonic timestamps, oldest first; a call is only recorded
+        # after is_allowed passed, so the window never holds more than the limit
+        self.minute_calls = defaultdict(lambda: deque(maxlen=self.calls_per_minute))
+        self.hour_calls = defaultdict(lambda: deque(maxlen=self.calls_per_hour))
         self.lock = Lock()
     
-    def _clean_old_calls(self, calls: list, window_seconds: int) -> list:
-        """Remove calls older than the window"""
-        now = time.time()
-        return [t for t in calls if now - t < window_seconds]
+    def _clean_old_calls(self, calls: deque, window_seconds: int, now: float):
+        """Drop calls older than the window from the front of the deque"""
+        while calls and now - calls[0] >= window_seconds:
+            calls.popleft()
     
     def is_allowed(self, user_id: str) -> Tuple[bool, str]:
         """Check if a request is allowed for this user"""
         with self.lock:
-            now = time.time()
+            now = time.monotonic()
             
             # Clean and check minute limit
-            self.minute_calls[user_id] = self._clean_old_calls(
-                self.minute_calls[user_id], 60
-            )
-            if len(self.minute_calls[user_id]) >= self.calls_per_minute:
-                wait_time = 60 - (now - self.minute_calls[user_id][0])
+            minute_calls = self.minute_calls[user_id]
+            self._clean_old_calls(minute_calls, 60, now)
+            if len(minute_calls) >= self.calls_per_minute:
+                wait_time = 60 - (now - minute_calls[0])
                 return False, f"Rate limit exceeded. Please wait {int(wait_time)} seconds."
             
             # Clean and check hour limit
-            self.hour_calls[user_id] = self._clean_old_calls(
-                self.hour_calls[user_id], 3600
-            )
-            if len(self.hour_calls[user_id]) >= self.calls_per_hour:
-                wait_time = 3600 - (now - self.hour_calls[user_id][0])
+            hour_calls = self.hour_calls[user_id]
+            self._clean_old_calls(hour_calls, 3600, now)
+            if len(hour_calls) >= self.calls_per_hour:
+                wait_time = 3600 - (now - hour_calls[0])
                 return False, f"Hourly limit exceeded. Please wait {int(wait_time // 60)} minutes."
             
             return True, ""
@@ -61,7 +244,7 @@ class RateLimiter:
     def record_call(self, user_id: str):
         """Record a successful API call"""
         with self.lock:
-            now = time.time()
+            now = time.monotonic()
             self.minute_calls[user_id].append(now)
             self.hour_calls[user_id].append(now)
 
@@ -69,70 +252,173 @@ class RateLimiter:
 class ConversationManager:
     """Manages conversation history and context for RJ interactions"""
     
-    def __init__(self, max_history: int = 20, max_users: int = 1000):
-        self.conversations = {}  # user_id -> list of messages
+    def __init__(self, max_history: int = 20, max_users: int = 1000, lock_stripes: int = 64):
+        # user_id -> deque of the last max_history messages, least recently used first
+        self.conversations = OrderedDict()
         self.max_history = max_history
         self.max_users = max_users
-        self.user_moods = {}  # user_id -> list of detected moods
+        self.max_moods = 10
+        # user_id -> (deque of the last max_moods moods, Counter over that deque)
+        self.user_moods = {}
+        # Guards membership and LRU order of the dicts above; held only briefly
         self.lock = Lock()
+        # Per-user data is guarded by one of these, chosen by hashing user_id,
+        # so unrelated users don't serialize on a single mutex. Always take a
+        # stripe before self.lock, never the other way round.
+        self.user_locks = [Lock() for _ in range(lock_stripes)]
+    
+    def _user_lock(self, user_id: str) -> Lock:
+        """Lock stripe guarding this user's history and moods"""
+        return self.user_locks[hash(user_id) % len(self.user_locks)]
     
-    def add_message(self, user_id: str, role: str, content: str, mood: str = None):
+    def add_message(self, user_id: str, role: str, content: str, mood: str = None,
+                    timestamp: Optional[float] = None):
         """Add a message to conversation history"""
-        with self.lock:
-            if user_id not in self.conversations:
-                # Evict oldest user if at capacity
-                if len(self.conversations) >= self.max_users:
-                    oldest = min(self.conversations.keys(), 
-                               key=lambda k: self.conversations[k][-1]['timestamp'] if self.conversations[k] else 0)
-                    del self.conversations[oldest]
-                    if oldest in self.user_moods:
-                        del self.user_moods[oldest]
+        if timestamp is None:
+            timestamp = time.time()
+        
+        with self._user_lock(user_id):
+            with self.lock:
+                if user_id not in self.conversations:
+                    # Evict least recently active user if at capacity
+                    if len(self.conversations) >= self.max_users:
+                        oldest, _ = self.conversations.popitem(last=False)
+                        self.user_moods.pop(oldest, None)
+                    
+                    self.conversations[user_id] = deque(maxlen=self.max_history)
+                    self.user_moods[user_id] = (deque(), Counter())
+                else:
+                    self.conversations.move_to_end(user_id)
                 
-                self.conversations[user_id] = []
-                self.user_moods[user_id] = []
+                history = self.conversations[user_id]
+                recent_moods, mood_counts = self.user_moods[user_id]
             
-            self.conversations[user_id].append({
+            history.append({
                 'role': role,
                 'content': content,
                 'mood': mood,
-                'timestamp': datetime.now().isoformat()
+                'timestamp': timestamp
             })
             
             if mood:
-                self.user_moods[user_id].append(mood)
-                # Keep only last 10 moods
-                self.user_moods[user_id] = self.user_moods[user_id][-10:]
-            
-            # Trim history if too long
-            if len(self.conversations[user_id]) > self.max_history:
-                self.conversations[user_id] = self.conversations[user_id][-self.max_history:]
+                # Keep only the last max_moods moods, updating counts incrementally
+                if len(recent_moods) >= self.max_moods:
+                    evicted = recent_moods.popleft()
+                    mood_counts[evicted] -= 1
+                    if not mood_counts[evicted]:
+                        del mood_counts[evicted]
+                recent_moods.append(mood)
+                mood_counts[mood] += 1
     
     def get_context(self, user_id: str, last_n: int = 5) -> List[Dict]:
         """Get recent conversation context"""
-        with self.lock:
-            if user_id not in self.conversations:
-                return []
-            return self.conversations[user_id][-last_n:]
+        with self._user_lock(user_id):
+            with self.lock:
+                history = self.conversations.get(user_id)
+                if history is None:
+                    return []
+                self.conversations.move_to_end(user_id)
+            return list(history)[-last_n:]
     
     def get_dominant_mood(self, user_id: str) -> str:
         """Get the most common mood for a user"""
-        with self.lock:
-            if user_id not in self.user_moods or not self.user_moods[user_id]:
+        with self._user_lock(user_id):
+            moods = self.user_moods.get(user_id)
+            if not moods or not moods[1]:
                 return "calm"
             
-            from collections import Counter
-            mood_counts = Counter(self.user_moods[user_id])
-            return mood_counts.most_common(1)[0][0]
+            return moods[1].most_common(1)[0][0]
     
     def should_recommend_songs(self, user_id: str) -> bool:
         """Determine if we have enough conversation to recommend songs"""
-        with self.lock:
-            if user_id not in self.conversations:
+        with self._user_lock(user_id):
+            history = self.conversations.get(user_id)
+            if history is None:
                 return False
             
             # Recommend after 2+ exchanges OR if user explicitly asks
-            user_messages = [m for m in self.conversations[user_id] if m['role'] == 'user']
-            return len(user_messages) >= 2
+            user_messages = sum(1 for m in history if m['role'] == 'user')
+            return user_messages >= 2
+    
+    def clear(self, user_id: str):
+        """Drop all stored history and moods for a user"""
+        with self._user_lock(user_id):
+            with self.lock:
+                self.conversations.pop(user_id, None)
+                self.user_moods.pop(user_id, None)
+
+
+class ResponseCache:
+    """Thread-safe bounded LRU cache for generated RJ text"""
+    
+    def __init__(self, max_size: int = 500):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = Lock()
+    
+    def get(self, key) -> Optional[str]:
+        """Return a cached value and mark it as recently used"""
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+    
+    def put(self, key, value: str):
+        """Store a value, evicting the least recently used entry when full"""
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+class RequestCoalescer:
+    """
+    Collapses identical concurrent LLM requests into a single provider call.
+    
+    The first caller for a key performs the request; callers arriving with
+    the same key while it is in flight wait for and share its result.
+    
+    Requests are bucketed by estimated size (prompt plus completion tokens)
+    and each bucket has its own ``max_inflight`` concurrency limit, so short
+    mood classifications don't queue behind long reply generations.
+    """
+    
+    def __init__(self, max_inflight: int = 8, bucket_bounds: Tuple[int, ...] = (256, 1024)):
+        self.inflight = {}  # key -> Future for the request in progress
+        self.bucket_bounds = bucket_bounds
+        self.slots = [Semaphore(max_inflight) for _ in range(len(bucket_bounds) + 1)]
+        self.lock = Lock()
+    
+    def run(self, key, request: Callable[[], Optional[str]],
+            estimated_tokens: int = 0) -> Optional[str]:
+        """Run ``request`` for ``key`` or join an identical one in flight"""
+        with self.lock:
+            future = self.inflight.get(key)
+            is_owner = future is None
+            if is_owner:
+                future = Future()
+                self.inflight[key] = future
+        
+        if not is_owner:
+            return future.result()
+        
+        try:
+            with self.slot(estimated_tokens):
+                result = request()
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                self.inflight.pop(key, None)
+    
+    def slot(self, estimated_tokens: int = 0) -> Semaphore:
+        """Concurrency slot for a request of this size (for calls that can't be coalesced)"""
+        return self.slots[bisect_right(self.bucket_bounds, estimated_tokens)]
 
 
 class RJService:
@@ -155,9 +441,25 @@ class RJService:
         self.llama_model = os.getenv("LLAMA_MODEL", "llama-3.1-8b-instant")  # Groq model
         self.hf_model = os.getenv("HF_MODEL", "meta-llama/Llama-2-7b-chat-hf")
         
+        # Token budget for conversation context included in prompts
+        self.context_token_budget = int(os.getenv("RJ_CONTEXT_TOKEN_BUDGET", "200"))
+        
+        # Share identical in-flight LLM calls and cap provider concurrency
+        # (per prompt-size bucket)
+        self.llm_coalescer = RequestCoalescer(
+            max_inflight=int(os.getenv("RJ_MAX_INFLIGHT_LLM_CALLS", "8"))
+        )
+        
+        # Persistent HTTP sessions so LLM calls reuse pooled keep-alive connections
+        self.groq_session = self._create_session(self.groq_api_key)
+        self.hf_session = self._create_session(self.hf_api_key)
+        
         # Response cache
-        self.response_cache = {}
         self.cache_max_size = 500
+        self.response_cache = ResponseCache(max_size=self.cache_max_size)
+        
+        # Exact-match cache for opening messages, keyed by (mood, normalized message)
+        self.opening_response_cache = ResponseCache(max_size=self.cache_max_size)
         
         # Import services lazily to avoid circular imports
         self._recommendation_service = None
@@ -165,6 +467,27 @@ class RJService:
         
         logger.info(f"RJ Service initialized with provider: {self.api_provider}")
     
+    @staticmethod
+    def _create_session(api_key: str) -> requests.Session:
+        """Create a pooled HTTP session with retries for an LLM provider"""
+        session = requests.Session()
+        session.headers.update({
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json"
+        })
+        adapter = HTTPAdapter(
+            pool_connections=16,
+            pool_maxsize=32,
+            max_retries=Retry(
+                total=2,
+                backoff_factor=0.2,
+                status_forcelist=[502, 503, 504],
+                allowed_methods=frozenset(["POST"])
+            )
+        )
+        session.mount("https://", adapter)
+        return session
+    
     @property
     def recommendation_service(self):
         if self._recommendation_service is None:
@@ -204,20 +527,33 @@ class RJService:
             # Record the API call
             self.rate_limiter.record_call(user_id)
             
+            # Stamp both sides of this turn with a single timestamp
+            turn_timestamp = time.time()
+            
             # Get conversation context
             context = self.conversation_manager.get_context(user_id, last_n=5)
             
-            # Analyze mood using Llama
-            mood, confidence = self._analyze_mood_with_llama(user_message, context)
+            # Detect mood and write the reply in a single LLM round trip when
+            # the provider supports JSON output; otherwise use two calls
+            fused = self._analyze_and_respond(user_message, context, user_id)
+            if fused:
+                mood, rj_response = fused
+                confidence = 0.8
+            else:
+                # Analyze mood using Llama
+                mood, confidence = self._analyze_mood_with_llama(user_message, context)
             
             # Store user message
-            self.conversation_manager.add_message(user_id, 'user', user_message, mood)
+            self.conversation_manager.add_message(user_id, 'user', user_message, mood,
+                                                  timestamp=turn_timestamp)
             
             # Generate RJ response
-            rj_response = self._generate_rj_response(user_message, mood, context, user_id)
+            if not fused:
+                rj_response = self._generate_rj_response(user_message, mood, context, user_id)
             
             # Store RJ response
-            self.conversation_manager.add_message(user_id, 'rj', rj_response)
+            self.conversation_manager.add_message(user_id, 'rj', rj_response,
+                                                  timestamp=turn_timestamp)
             
             # Determine if we should recommend songs
             songs = []
@@ -245,47 +581,129 @@ class RJService:
                 "rate_limited": False
             }
     
+    def chat_stream(self, user_message: str, user_id: str) -> Iterator[Dict]:
+        """
+        Streaming variant of chat() that yields events as the reply is generated.
+        
+        Events, in order:
+            {"type": "mood", "mood": ..., "mood_confidence": ...}
+            {"type": "delta", "content": ...}  (one or more)
+            {"type": "done", ...}  (same fields as chat()'s return value)
+        
+        A rate-limited or failed request yields only the "done" event.
+        """
+        allowed, error_msg = self.rate_limiter.is_allowed(user_id)
+        if not allowed:
+            yield {
+                "type": "done",
+                "response": f"Whoa there, listener! You're messaging faster than a drum solo! 🥁 {error_msg}",
+                "mood": None,
+                "songs": [],
+                "rate_limited": True
+            }
+            return
+        
+        try:
+            self.rate_limiter.record_call(user_id)
+            turn_timestamp = time.time()
+            context = self.conversation_manager.get_context(user_id, last_n=5)
+            
+            # Mood analysis is a tiny call, so it isn't streamed
+            mood, confidence = self._analyze_mood_with_llama(user_message, context)
+            self.conversation_manager.add_message(user_id, 'user', user_message, mood,
+                                                  timestamp=turn_timestamp)
+            yield {"type": "mood", "mood": mood, "mood_confidence": confidence}
+            
+            chunks = []
+            for chunk in self._stream_rj_response(user_message, mood, context, user_id):
+                chunks.append(chunk)
+                yield {"type": "delta", "content": chunk}
+            rj_response = "".join(chunks)
+            
+            self.conversation_manager.add_message(user_id, 'rj', rj_response,
+                                                  timestamp=turn_timestamp)
+            
+            songs = []
+            if self._should_recommend_now(user_message, user_id):
+                songs = self._get_song_recommendations(user_id, mood, user_message)
+                if songs:
+                    intro = self._format_song_intro(mood)
+                    rj_response += intro
+                    yield {"type": "delta", "content": intro}
+            
+            yield {
+                "type": "done",
+                "response": rj_response,
+                "mood": mood,
+                "mood_confidence": confidence,
+                "songs": songs,
+                "conversation_turn": len(self.conversation_manager.get_context(user_id, 100)),
+                "rate_limited": False
+            }
+            
+        except Exception as e:
+            logger.error(f"RJ chat stream error: {e}")
+            yield {
+                "type": "done",
+                "response": "Hey there! 🎵 I'm having a little technical hiccup, but the music never stops! Tell me what kind of vibe you're feeling today?",
+                "mood": "calm",
+                "songs": [],
+                "error": str(e),
+                "rate_limited": False
+            }
+    
+    def _has_llm_provider(self) -> bool:
+        """Check whether the selected LLM provider has an API key configured"""
+        if self.api_provider == "groq":
+            return bool(self.groq_api_key)
+        if self.api_provider == "huggingface":
+            return bool(self.hf_api_key)
+        return False
+    
+    def _format_context(self, context: List[Dict], user_label: str) -> str:
+        """
+        Format conversation context for a prompt, bounded by the token budget.
+        
+        Walks the messages from newest to oldest and stops once the estimated
+        token count would exceed ``self.context_token_budget``, so a chatty
+        listener can't blow up prompt size. The newest message is always kept,
+        clipped to the budget if it is too long on its own.
+        """
+        lines = []
+        remaining = self.context_token_budget
+        for m in reversed(context):
+            speaker = user_label if m['role'] == 'user' else 'RJ'
+            line = f"{speaker}: {m['content']}"
+            cost = _estimate_tokens(line)
+            if cost > remaining:
+                if not lines and remaining > 0:
+                    lines.append(line[-remaining * _CHARS_PER_TOKEN:])
+                break
+            lines.append(line)
+            remaining -= cost
+        
+        return "\n".join(reversed(lines))
+    
     def _analyze_mood_with_llama(self, message: str, context: List[Dict]) -> Tuple[str, float]:
         """Use Llama to analyze mood from message and context"""
         
+        # Skip prompt construction entirely when no LLM is configured
+        if not self._has_llm_provider():
+            return self._fallback_mood_analysis(message), 0.8
+        
         # Build context string
-        context_str = ""
-        if context:
-            recent = context[-3:]
-            context_str = "\n".join([
-                f"{'User' if m['role'] == 'user' else 'RJ'}: {m['content']}"
-                for m in recent
-            ])
+        context_str = self._format_context(context[-3:], user_label="User")
         
-        prompt = f"""You are analyzing the emotional state of a user chatting with a radio DJ.
-
-Previous conversation:
+        prompt = f"""Previous conversation:
 {context_str}
 
 Current user message: "{message}"
 
-Based on the message and context, identify the user's current mood.
-Respond with ONLY ONE of these moods: happy, sad, angry, calm, energetic, tired, anxious, romantic, nostalgic, focused, excited, melancholic
-
 Mood:"""
         
         try:
-            if self.api_provider == "groq" and self.groq_api_key:
-                mood = self._call_groq_api(prompt, max_tokens=10)
-            elif self.api_provider == "huggingface" and self.hf_api_key:
-                mood = self._call_hf_api(prompt, max_tokens=10)
-            else:
-                mood = self._fallback_mood_analysis(message)
-            
-            # Clean and validate mood
-            mood = mood.strip().lower().split()[0] if mood else "calm"
-            valid_moods = ["happy", "sad", "angry", "calm", "energetic", "tired", 
-                          "anxious", "romantic", "nostalgic", "focused", "excited", "melancholic"]
-            
-            if mood not in valid_moods:
-                mood = self._fallback_mood_analysis(message)
-            
-            return mood, 0.8
+            mood = self._call_llm(prompt, max_tokens=10, system_prompt=_MOOD_SYSTEM_PROMPT)
+            return self._normalize_mood(mood, message), 0.8
             
         except Exception as e:
             logger.error(f"Mood analysis error: {e}")
@@ -295,28 +713,46 @@ Mood:"""
                               context: List[Dict], user_id: str) -> str:
         """Generate an RJ-style conversational response using Llama"""
         
+        # Skip prompt construction entirely when no LLM is configured
+        if not self._has_llm_provider():
+            return self._get_fallback_response(mood)
+        
+        # Opening messages ("hi", "play something") repeat verbatim across
+        # listeners; without prior context the prompt depends only on these
+        opening_key = None
+        if not context:
+            opening_key = (mood, user_message.strip().lower())
+            cached = self.opening_response_cache.get(opening_key)
+            if cached:
+                return cached
+        
+        prompt = self._build_rj_prompt(user_message, mood, context, user_id)
+        
+        try:
+            response = self._clean_response(
+                self._call_llm(prompt, max_tokens=150, system_prompt=_RJ_SYSTEM_PROMPT)
+            )
+            if response:
+                if opening_key:
+                    self.opening_response_cache.put(opening_key, response)
+                return response
+            
+            return self._get_fallback_response(mood)
+            
+        except Exception as e:
+            logger.error(f"Response generation error: {e}")
+            return self._get_fallback_response(mood)
+    
+    def _build_rj_prompt(self, user_message: str, mood: str,
+                         context: List[Dict], user_id: str) -> str:
+        """Build the per-turn user prompt for RJ response generation"""
         # Build conversation history
-        conv_history = ""
-        if context:
-            conv_history = "\n".join([
-                f"{'Listener' if m['role'] == 'user' else 'RJ'}: {m['content']}"
-                for m in context[-4:]
-            ])
+        conv_history = self._format_context(context[-4:], user_label="Listener")
         
         # Get dominant mood trend
         dominant_mood = self.conversation_manager.get_dominant_mood(user_id)
         
-        prompt = f"""You are a warm, friendly Radio Jockey (RJ) named Aura hosting a late-night music show. You chat with listeners about their feelings, life, and music preferences before suggesting songs.
-
-Your personality:
-- Warm, empathetic, and genuinely interested in listeners
-- Use casual language with occasional radio phrases like "Coming in hot!", "That's what I'm talking about!"
-- Reference music and artists naturally in conversation
-- Ask follow-up questions to understand the listener better
-- Keep responses concise (2-3 sentences max)
-- Use 1-2 emojis sparingly
-
-Conversation so far:
+        return f"""Conversation so far:
 {conv_history}
 
 Listener's current mood: {mood}
@@ -324,52 +760,212 @@ Listener's overall mood trend: {dominant_mood}
 
 Listener just said: "{user_message}"
 
-Respond as Aura the RJ. Be conversational - don't recommend songs yet unless they explicitly ask. Focus on connecting with the listener first:"""
+Aura:"""
+    
+    def _stream_rj_response(self, user_message: str, mood: str,
+                            context: List[Dict], user_id: str) -> Iterator[str]:
+        """
+        Yield the RJ reply in chunks as Groq generates it.
+        
+        The first few characters are buffered so a leading "RJ:"/"Aura:" label
+        can be stripped, and streaming stops at the first line break, matching
+        the cleanup applied to non-streamed replies. Providers without
+        streaming support get the whole reply as a single chunk.
+        """
+        if not (self.api_provider == "groq" and self.groq_api_key):
+            yield self._generate_rj_response(user_message, mood, context, user_id)
+            return
+        
+        # Same opening-message cache as _generate_rj_response
+        opening_key = None
+        if not context:
+            opening_key = (mood, user_message.strip().lower())
+            cached = self.opening_response_cache.get(opening_key)
+            if cached:
+                yield cached
+                return
+        
+        prompt = self._build_rj_prompt(user_message, mood, context, user_id)
+        pending = ""
+        started = False
+        sent = 0
+        streamed = []
+        
+        for delta in self._stream_groq_api(prompt, max_tokens=150, system_prompt=_RJ_SYSTEM_PROMPT):
+            pending += delta
+            if not started:
+                if len(pending) < 16 and '\n' not in pending:
+                    continue
+                pending = _SPEAKER_PREFIX_RE.sub('', pending.lstrip())
+                started = True
+            
+            chunk, newline, _ = pending.partition('\n')
+            chunk = chunk[:500 - sent]
+            if chunk:
+                sent += len(chunk)
+                streamed.append(chunk)
+                yield chunk
+            pending = ""
+            if newline or sent >= 500:
+                break
+        
+        if not started:
+            pending = _SPEAKER_PREFIX_RE.sub('', pending.strip()).partition('\n')[0]
+            if len(pending) > 10:
+                sent += len(pending)
+                streamed.append(pending)
+                yield pending
+        
+        if not sent:
+            yield self._get_fallback_response(mood)
+        elif opening_key and sent > 10:
+            self.opening_response_cache.put(opening_key, "".join(streamed))
+    
+    def _analyze_and_respond(self, user_message: str, context: List[Dict],
+                             user_id: str) -> Optional[Tuple[str, str]]:
+        """
+        Detect mood and write the RJ reply with one JSON-mode Groq call.
+        
+        Returns (mood, response), or None if the provider doesn't support JSON
+        output or the reply can't be parsed, in which case the caller falls
+        back to separate mood analysis and response generation calls.
+        """
+        if not (self.api_provider == "groq" and self.groq_api_key):
+            return None
+        
+        dominant_mood = self.conversation_manager.get_dominant_mood(user_id)
+        
+        # Opening messages repeat verbatim across listeners; without prior
+        # context the prompt depends only on the mood trend and the message
+        opening_key = None
+        if not context:
+            opening_key = ("json", dominant_mood, user_message.strip().lower())
+            cached = self.opening_response_cache.get(opening_key)
+            if cached:
+                return cached
+        
+        conv_history = self._format_context(context[-4:], user_label="Listener")
+        
+        prompt = f"""Conversation so far:
+{conv_history}
+
+Listener's overall mood trend: {dominant_mood}
+
+Listener just said: "{user_message}"
 
+JSON:"""
+        
         try:
-            if self.api_provider == "groq" and self.groq_api_key:
-                response = self._call_groq_api(prompt, max_tokens=150)
-            elif self.api_provider == "huggingface" and self.hf_api_key:
-                response = self._call_hf_api(prompt, max_tokens=150)
-            else:
-                response = self._get_fallback_response(mood)
+            raw = self._call_llm(prompt, max_tokens=200,
+                                 system_prompt=_RJ_JSON_SYSTEM_PROMPT, json_mode=True)
+            if not raw:
+                return None
             
-            # Clean up response
-            if response:
-                response = response.strip()
-                # Remove any "RJ:" or "Aura:" prefixes
-                response = re.sub(r'^(RJ|Aura|Radio Jockey)[:\s]+', '', response, flags=re.IGNORECASE)
-                response = response.split('\n')[0]  # Take first paragraph only
-                
-                if len(response) > 10:
-                    return response[:500]  # Limit length
+            # Tolerate stray text around the object
+            match = _JSON_OBJECT_RE.search(raw)
+            result = orjson.loads(match.group(0) if match else raw)
             
-            return self._get_fallback_response(mood)
+            response = self._clean_response(str(result.get("response") or ""))
+            if not response:
+                return None
+            
+            fused = self._normalize_mood(str(result.get("mood") or ""), user_message), response
+            if opening_key:
+                self.opening_response_cache.put(opening_key, fused)
+            return fused
             
         except Exception as e:
-            logger.error(f"Response generation error: {e}")
-            return self._get_fallback_response(mood)
+            logger.debug(f"Combined mood/response call failed: {e}")
+            return None
     
-    def _call_groq_api(self, prompt: str, max_tokens: int = 100) -> Optional[str]:
+    def _normalize_mood(self, raw_mood: Optional[str], message: str) -> str:
+        """Reduce an LLM mood answer to a known mood, falling back to keyword rules"""
+        words = raw_mood.strip().lower().split() if raw_mood else []
+        mood = words[0] if words else "calm"
+        
+        if mood not in _VALID_MOODS:
+            mood = self._fallback_mood_analysis(message)
+        
+        return mood
+    
+    def _clean_response(self, response: Optional[str]) -> Optional[str]:
+        """Tidy an LLM reply for display, or return None if it is unusable"""
+        if not response:
+            return None
+        
+        response = response.strip()
+        # Remove any "RJ:" or "Aura:" prefixes
+        response = _SPEAKER_PREFIX_RE.sub('', response)
+        response = response.partition('\n')[0]  # Take first paragraph only
+        
+        if len(response) > 10:
+            return response[:500]  # Limit length
+        return None
+    
+    def _call_llm(self, prompt: str, max_tokens: int,
+                  system_prompt: Optional[str] = None,
+                  json_mode: bool = False) -> Optional[str]:
+        """
+        Call the configured LLM provider, reusing replies for identical prompts.
+        
+        Replies are cached under a BLAKE2b digest of the provider, token limit,
+        system prompt and prompt, so a repeated mood or context skips the
+        network round trip entirely. Failed calls (None) are not cached.
+        """
+        key = hashlib.blake2b(
+            f"{self.api_provider}\0{max_tokens}\0{json_mode}\0{system_prompt or ''}\0{prompt}".encode(),
+            digest_size=16
+        ).digest()
+        cached = self.response_cache.get(key)
+        if cached is not None:
+            return cached
+        
+        if self.api_provider == "groq":
+            result = self._call_groq_api(prompt, max_tokens, system_prompt, json_mode)
+        else:
+            result = self._call_hf_api(prompt, max_tokens, system_prompt)
+        
+        if result:
+            self.response_cache.put(key, result)
+        return result
+    
+    def _call_groq_api(self, prompt: str, max_tokens: int = 100,
+                       system_prompt: Optional[str] = None,
+                       json_mode: bool = False) -> Optional[str]:
         """Call Groq API for Llama inference"""
+        return self.llm_coalescer.run(
+            ("groq", max_tokens, json_mode, system_prompt, prompt),
+            lambda: self._post_groq(prompt, max_tokens, system_prompt, json_mode),
+            estimated_tokens=_estimate_tokens(system_prompt or "") + _estimate_tokens(prompt) + max_tokens
+        )
+    
+    def _post_groq(self, prompt: str, max_tokens: int,
+                   system_prompt: Optional[str], json_mode: bool = False) -> Optional[str]:
+        """Send a single completion request to Groq"""
+        # The static system message goes first so the provider can reuse
+        # its cached prefix; only the user message changes per turn
+        messages = [{"role": "user", "content": prompt}]
+        if system_prompt:
+            messages.insert(0, {"role": "system", "content": system_prompt})
+        
+        payload = {
+            "model": self.llama_model,
+            "messages": messages,
+            "max_tokens": max_tokens,
+            "temperature": 0.7
+        }
+        if json_mode:
+            payload["response_format"] = {"type": "json_object"}
+        
         try:
-            response = requests.post(
+            response = self.groq_session.post(
                 "https://api.groq.com/openai/v1/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {self.groq_api_key}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "model": self.llama_model,
-                    "messages": [{"role": "user", "content": prompt}],
-                    "max_tokens": max_tokens,
-                    "temperature": 0.7
-                },
+                data=orjson.dumps(payload),
                 timeout=10
             )
             
             if response.status_code == 200:
-                result = response.json()
+                result = orjson.loads(response.content)
                 return result["choices"][0]["message"]["content"]
             elif response.status_code == 429:
                 logger.warning("Groq rate limit hit")
@@ -382,25 +978,76 @@ Respond as Aura the RJ. Be conversational - don't recommend songs yet unless the
             logger.error(f"Groq API error: {e}")
             return None
     
-    def _call_hf_api(self, prompt: str, max_tokens: int = 100) -> Optional[str]:
+    def _stream_groq_api(self, prompt: str, max_tokens: int,
+                         system_prompt: Optional[str] = None) -> Iterator[str]:
+        """Stream content deltas from a Groq completion (server-sent events)"""
+        messages = [{"role": "user", "content": prompt}]
+        if system_prompt:
+            messages.insert(0, {"role": "system", "content": system_prompt})
+        
+        # Streams can't be shared like coalesced calls, but they take the
+        # same concurrency slot so they count against the provider cap
+        estimated_tokens = _estimate_tokens(system_prompt or "") + _estimate_tokens(prompt) + max_tokens
+        try:
+            with self.llm_coalescer.slot(estimated_tokens), self.groq_session.post(
+                "https://api.groq.com/openai/v1/chat/completions",
+                data=orjson.dumps({
+                    "model": self.llama_model,
+                    "messages": messages,
+                    "max_tokens": max_tokens,
+                    "temperature": 0.7,
+                    "stream": True
+                }),
+                timeout=10,
+                stream=True
+            ) as response:
+                if response.status_code != 200:
+                    logger.warning(f"Groq streaming error: {response.status_code}")
+                    return
+                
+                for line in response.iter_lines(decode_unicode=True):
+                    if not line or not line.startswith("data: "):
+                        continue
+                    data = line[len("data: "):]
+                    if data == "[DONE]":
+                        break
+                    delta = orjson.loads(data)["choices"][0]["delta"].get("content")
+                    if delta:
+                        yield delta
+                        
+        except Exception as e:
+            logger.error(f"Groq streaming error: {e}")
+    
+    def _call_hf_api(self, prompt: str, max_tokens: int = 100,
+                     system_prompt: Optional[str] = None) -> Optional[str]:
         """Call Hugging Face API for Llama inference"""
+        if system_prompt:
+            # Text generation has no roles; keep the static block as the prefix
+            prompt = f"{system_prompt}\n\n{prompt}"
+        return self.llm_coalescer.run(
+            ("huggingface", max_tokens, prompt),
+            lambda: self._post_hf(prompt, max_tokens),
+            estimated_tokens=_estimate_tokens(prompt) + max_tokens
+        )
+    
+    def _post_hf(self, prompt: str, max_tokens: int) -> Optional[str]:
+        """Send a single text-generation request to Hugging Face"""
         try:
-            response = requests.post(
+            response = self.hf_session.post(
                 f"https://api-inference.huggingface.co/models/{self.hf_model}",
-                headers={"Authorization": f"Bearer {self.hf_api_key}"},
-                json={
+                data=orjson.dumps({
                     "inputs": prompt,
                     "parameters": {
                         "max_new_tokens": max_tokens,
                         "temperature": 0.7,
                         "return_full_text": False
                     }
-                },
+                }),
                 timeout=15
             )
             
             if response.status_code == 200:
-                result = response.json()
+                result = orjson.loads(response.content)
                 if isinstance(result, list) and len(result) > 0:
                     return result[0].get("generated_text", "")
             
@@ -412,16 +1059,8 @@ Respond as Aura the RJ. Be conversational - don't recommend songs yet unless the
     
     def _should_recommend_now(self, message: str, user_id: str) -> bool:
         """Determine if we should recommend songs now"""
-        message_lower = message.lower()
-        
         # Explicit song request triggers
-        song_triggers = [
-            "play", "song", "music", "recommend", "suggest", "listen",
-            "what should i", "any song", "play something", "put on",
-            "need music", "want music", "give me", "play me"
-        ]
-        
-        if any(trigger in message_lower for trigger in song_triggers):
+        if _SONG_TRIGGER_RE.search(message):
             return True
         
         # Also recommend after enough conversation
@@ -431,7 +1070,12 @@ Respond as Aura the RJ. Be conversational - don't recommend songs yet unless the
                                    message: str) -> List[Dict]:
         """Get personalized song recommendations"""
         try:
-            recommendations = []
+            # Songs keyed by lowercased title, deduplicated as batches arrive
+            recommendations: Dict[str, Dict] = {}
+            
+            def merge(batch: List[Dict]):
+                for song in batch:
+                    recommendations.setdefault(_song_title_key(song), song)
             
             # Extract any genre hints from message
             genre_hints = self._extract_genre_hints(message)
@@ -444,7 +1088,7 @@ Respond as Aura the RJ. Be conversational - don't recommend songs yet unless the
                     mood=mood,
                     genre=genre_hints if genre_hints else None
                 )
-                recommendations.extend(recs)
+                merge(recs)
             except Exception as e:
                 logger.debug(f"Recommendation service error: {e}")
             
@@ -453,20 +1097,11 @@ Respond as Aura the RJ. Be conversational - don't recommend songs yet unless the
                 mood_query = self._get_mood_search_query(mood)
                 try:
                     songs = self.song_search_service.search_songs(mood_query, limit=3)
-                    recommendations.extend(songs)
+                    merge(songs)
                 except Exception as e:
                     logger.debug(f"Song search error: {e}")
             
-            # Deduplicate
-            seen = set()
-            unique = []
-            for song in recommendations:
-                title = song.get("title", "") or song.get("song", {}).get("title", "")
-                if title.lower() not in seen:
-                    seen.add(title.lower())
-                    unique.append(song)
-            
-            return unique[:5]
+            return list(recommendations.values())[:5]
             
         except Exception as e:
             logger.error(f"Song recommendation error: {e}")
@@ -474,126 +1109,40 @@ Respond as Aura the RJ. Be conversational - don't recommend songs yet unless the
     
     def _extract_genre_hints(self, message: str) -> List[str]:
         """Extract genre hints from user message"""
-        message_lower = message.lower()
-        
-        genre_keywords = {
-            "rock": ["rock", "guitar", "metal", "punk"],
-            "pop": ["pop", "catchy", "mainstream", "top 40"],
-            "hip hop": ["hip hop", "rap", "hiphop", "beats"],
-            "electronic": ["electronic", "edm", "techno", "house", "trance"],
-            "r&b": ["r&b", "rnb", "soul", "neo-soul"],
-            "jazz": ["jazz", "smooth", "saxophone"],
-            "classical": ["classical", "orchestra", "symphony", "piano"],
-            "country": ["country", "folk", "acoustic"],
-            "indie": ["indie", "alternative", "underground"],
-            "bollywood": ["bollywood", "hindi", "indian"]
-        }
-        
-        detected = []
-        for genre, keywords in genre_keywords.items():
-            if any(kw in message_lower for kw in keywords):
-                detected.append(genre)
-        
-        return detected
+        hits = _scan_genres(message)
+        return [genre for genre in _GENRE_KEYWORDS if genre in hits]
     
     def _get_mood_search_query(self, mood: str) -> str:
         """Convert mood to a search query"""
-        mood_queries = {
-            "happy": "upbeat happy feel good",
-            "sad": "emotional sad melancholic",
-            "angry": "intense aggressive rock",
-            "calm": "calm peaceful ambient",
-            "energetic": "energetic workout pump",
-            "tired": "soothing gentle sleep",
-            "anxious": "calming meditation peaceful",
-            "romantic": "romantic love ballad",
-            "nostalgic": "classic throwback oldies",
-            "focused": "lo-fi study instrumental",
-            "excited": "party dance energetic",
-            "melancholic": "sad emotional piano"
-        }
-        return mood_queries.get(mood, mood)
+        return _MOOD_QUERIES.get(mood, mood)
     
     def _format_song_intro(self, mood: str) -> str:
         """Add a song introduction to the response"""
-        intros = {
-            "happy": " I've got some feel-good tracks that'll keep that smile going! 🎵",
-            "sad": " Let me play something that understands exactly how you're feeling... 💙",
-            "energetic": " Time to turn it UP! Here's some high-energy tracks for you! 🔥",
-            "calm": " I've got some peaceful vibes coming your way... 🌙",
-            "romantic": " Aww, here's some songs to match that loving feeling! 💕",
-            "nostalgic": " Let's take a trip down memory lane with these classics! ✨",
-            "focused": " Here's some instrumental tracks to help you stay in the zone! 🎧"
-        }
-        return intros.get(mood, " Here's what I've got for you! 🎶")
+        return _MOOD_INTROS.get(mood, " Here's what I've got for you! 🎶")
     
     def _fallback_mood_analysis(self, message: str) -> str:
         """Rule-based fallback for mood analysis"""
-        message_lower = message.lower()
-        
-        mood_keywords = {
-            "happy": ["happy", "great", "awesome", "excited", "amazing", "good", "love"],
-            "sad": ["sad", "depressed", "down", "upset", "lonely", "hurt"],
-            "angry": ["angry", "mad", "furious", "annoyed", "frustrated"],
-            "calm": ["calm", "peaceful", "relaxed", "chill"],
-            "energetic": ["pumped", "workout", "gym", "running", "energy"],
-            "tired": ["tired", "exhausted", "sleepy", "drained"],
-            "anxious": ["anxious", "worried", "stressed", "nervous"],
-            "romantic": ["romantic", "love", "dating", "crush"],
-            "nostalgic": ["remember", "memories", "past", "childhood"]
-        }
-        
-        for mood, keywords in mood_keywords.items():
-            if any(kw in message_lower for kw in keywords):
-                return mood
-        
-        return "calm"
+        match = _MOOD_RE.search(message)
+        return match.lastgroup if match else "calm"
     
     def _get_fallback_response(self, mood: str) -> str:
         """Get a fallback response when API fails"""
-        import random
-        
-        responses = {
-            "happy": [
-                "That's amazing! I love that energy! 🌟 What's got you feeling so good today?",
-                "YES! That positive vibe is contagious! Tell me more!"
-            ],
-            "sad": [
-                "I hear you, and I'm here for you. 💙 Music can really help at times like these...",
-                "It's okay to feel this way. Sometimes the best songs come from these moments."
-            ],
-            "calm": [
-                "That's a nice peaceful energy you've got going. What's on your mind?",
-                "I'm vibing with that chill mood! 🌙 Perfect for some smooth tunes."
-            ],
-            "energetic": [
-                "I can feel that energy through the airwaves! 🔥 Ready to turn it up?",
-                "That's what I'm talking about! Let's match that fire!"
-            ]
-        }
-        
-        mood_responses = responses.get(mood, responses["calm"])
-        return random.choice(mood_responses)
+        return random.choice(_FALLBACK_RESPONSES.get(mood, _FALLBACK_RESPONSES["calm"]))
     
     def get_conversation_history(self, user_id: str, limit: int = 10) -> List[Dict]:
         """Get conversation history for a user"""
-        return self.conversation_manager.get_context(user_id, limit)
+        # Timestamps are stored as epoch floats; format them only when read
+        return [
+            {**m, 'timestamp': datetime.fromtimestamp(m['timestamp']).isoformat()}
+            for m in self.conversation_manager.get_context(user_id, limit)
+        ]
     
     def clear_conversation(self, user_id: str):
         """Clear conversation history for a user"""
-        with self.conversation_manager.lock:
-            if user_id in self.conversation_manager.conversations:
-                del self.conversation_manager.conversations[user_id]
-            if user_id in self.conversation_manager.user_moods:
-                del self.conversation_manager.user_moods[user_id]
-
+        self.conversation_manager.clear(user_id)
 
-# Singleton instance
-_rj_service = None
 
+@lru_cache(maxsize=1)
 def get_rj_service() -> RJService:
     """Get singleton instance of RJService"""
-    global _rj_service
-    if _rj_service is None:
-        _rj_service = RJService()
-    return _rj_service
+    return RJService()
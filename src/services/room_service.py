@@ -4,32 +4,335 @@ Handles music room creation, joining, leaving, and state management
 """
 
 from sqlalchemy.orm import Session
-from sqlalchemy import and_
-from typing import List, Optional, Dict
+from sqlalchemy import and_, delete, func, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from typing import AsyncIterator, Dict, List, Optional, Set, Tuple
+from threading import Lock
 from datetime import datetime, timedelta
+import asyncio
+import os
+import orjson
 import secrets
 import logging
 
-from src.database.models import MusicRoom, RoomParticipant, User, SessionLocal
+from src.database.models import MusicRoom, RoomParticipant, User
+from src.database.session import use_session
 from src.services.friend_service import get_friend_service
+from src.services.ttl_cache import TTLCache
 
 logger = logging.getLogger(__name__)
 
+# Attempts at drawing an unused room code before giving up
+_ROOM_ID_ATTEMPTS = 5
+
+# Max dirty rooms written back per flush batch
+_DIRTY_BATCH_SIZE = 500
+
+# Max rooms kept in the in-process cache (used without Redis)
+_LOCAL_ROOM_CACHE_SIZE = 10000
+
+# Dialect-specific INSERT constructs supporting ON CONFLICT upserts
+_DIALECT_INSERTS = {
+    "postgresql": postgresql.insert,
+    "sqlite": sqlite.insert,
+}
+
+def _active_participant_ids(dialect: str):
+    """Correlated subquery aggregating a room's active participant IDs into one value"""
+    # array_agg on PostgreSQL; JSON array text on SQLite
+    aggregate = func.array_agg if dialect == "postgresql" else func.json_group_array
+    return select(aggregate(RoomParticipant.user_id)).where(
+        RoomParticipant.room_id == MusicRoom.room_id,
+        RoomParticipant.is_active == True
+    ).scalar_subquery()
+
+
+def _decode_participant_ids(value) -> List[str]:
+    """Turn an aggregated participant value into a list of user IDs"""
+    if value is None:
+        return []
+    if isinstance(value, str):
+        return orjson.loads(value)
+    return list(value)
+
+
+def _offer_event(listener: asyncio.Queue, event: Dict):
+    """Queue an event for a local subscriber (runs on the subscriber's loop)"""
+    try:
+        listener.put_nowait(event)
+    except asyncio.QueueFull:
+        # Slow consumer - drop rather than block the publisher
+        pass
+
+
+# Try to import Redis client (optional shared room cache)
+try:
+    import redis
+    import redis.asyncio
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+
 
 class RoomService:
     """Service for managing music rooms"""
     
     def __init__(self):
         """Initialize room service"""
-        # In-memory cache for room state (for performance)
-        # In production, use Redis for this
-        self._room_cache = {}
+        # Room state cache: Redis when REDIS_URL is set, so every worker
+        # sees the same state; otherwise a bounded per-process TTL cache
+        # (disabled below when several workers would each hold their own)
+        self.room_cache_ttl = int(os.getenv("ROOM_CACHE_TTL", "3600"))
+        self._room_cache: Optional[TTLCache] = TTLCache(
+            max_size=_LOCAL_ROOM_CACHE_SIZE, ttl=self.room_cache_ttl
+        )
+        self._redis = None
+        
+        # Rooms whose cached playback state hasn't been flushed to the database
+        # (local mode; Redis mode uses the rooms:dirty set)
+        self._dirty_rooms: Set[str] = set()
+        self._dirty_lock = Lock()
+        
+        # In-process event subscribers (their loop and queue), used when
+        # Redis isn't configured
+        self._room_listeners: Dict[str, Set[Tuple[asyncio.AbstractEventLoop, asyncio.Queue]]] = {}
+        self._listeners_lock = Lock()
+        # Async client for pub/sub subscriptions, so SSE streams don't hold threads
+        self._async_redis = None
+        
+        redis_url = os.getenv("REDIS_URL")
+        if redis_url:
+            if REDIS_AVAILABLE:
+                self._redis = redis.Redis(
+                    connection_pool=redis.ConnectionPool.from_url(redis_url, decode_responses=True)
+                )
+                self._async_redis = redis.asyncio.Redis.from_url(redis_url, decode_responses=True)
+                logger.info("Room cache backed by Redis")
+            else:
+                logger.warning("REDIS_URL is set but redis is not installed; using in-process room cache")
+        
+        # Each worker would serve its own stale copy of the in-process cache,
+        # so without Redis several workers read and write the database directly
+        if self._redis is None and int(os.getenv("WEB_CONCURRENCY", "1")) > 1:
+            logger.warning(
+                "Multiple workers without REDIS_URL; room state cache disabled, "
+                "writes go straight to the database"
+            )
+            self._room_cache = None
+    
+    def _cache_room(self, state: Dict):
+        """Store a full room state (including participant IDs) in the cache"""
+        room_id = state["room_id"]
+        fields = {k: v for k, v in state.items() if k != "participants"}
+        participants = state.get("participants", [])
+        
+        if self._redis is None:
+            if self._room_cache is not None:
+                self._room_cache.put(room_id, {**fields, "participants": set(participants)})
+            return
+        
+        try:
+            key = f"room:{room_id}"
+            pipe = self._redis.pipeline()
+            pipe.delete(key, f"{key}:participants")
+            pipe.hset(key, mapping={k: orjson.dumps(v) for k, v in fields.items()})
+            if participants:
+                pipe.sadd(f"{key}:participants", *participants)
+            pipe.expire(key, self.room_cache_ttl)
+            pipe.expire(f"{key}:participants", self.room_cache_ttl)
+            pipe.execute()
+        except redis.RedisError as e:
+            logger.warning(f"Failed to cache room {room_id}: {e}")
+    
+    def _get_cached_room(self, room_id: str) -> Optional[Dict]:
+        """Get a cached room state, refreshing its TTL; None on miss"""
+        if self._redis is None:
+            cached = self._room_cache.get(room_id) if self._room_cache is not None else None
+            if cached is None:
+                return None
+            return {**cached, "participants": list(cached["participants"])}
+        
+        try:
+            key = f"room:{room_id}"
+            pipe = self._redis.pipeline()
+            pipe.hgetall(key)
+            pipe.smembers(f"{key}:participants")
+            pipe.expire(key, self.room_cache_ttl)
+            pipe.expire(f"{key}:participants", self.room_cache_ttl)
+            fields, participants, _, _ = pipe.execute()
+        except redis.RedisError as e:
+            logger.warning(f"Failed to read cached room {room_id}: {e}")
+            return None
+        
+        # A hash without room_id is partial (expired mid-update) - treat as a miss
+        if "room_id" not in fields:
+            return None
+        state = {k: orjson.loads(v) for k, v in fields.items()}
+        state["participants"] = list(participants)
+        return state
+    
+    def _update_cached_room(
+        self,
+        room_id: str,
+        fields: Optional[Dict] = None,
+        add_participant: Optional[str] = None,
+        remove_participant: Optional[str] = None
+    ) -> bool:
+        """Apply a partial update to a cached room; returns False if it isn't cached"""
+        if self._redis is None:
+            cached = self._room_cache.get(room_id) if self._room_cache is not None else None
+            if cached is None:
+                return False
+            if fields:
+                cached.update(fields)
+            if add_participant:
+                cached["participants"].add(add_participant)
+            if remove_participant:
+                cached["participants"].discard(remove_participant)
+            return True
+        
+        try:
+            key = f"room:{room_id}"
+            if not self._redis.exists(key):
+                return False
+            pipe = self._redis.pipeline()
+            if fields:
+                pipe.hset(key, mapping={k: orjson.dumps(v) for k, v in fields.items()})
+            if add_participant:
+                pipe.sadd(f"{key}:participants", add_participant)
+            if remove_participant:
+                pipe.srem(f"{key}:participants", remove_participant)
+            pipe.expire(key, self.room_cache_ttl)
+            pipe.expire(f"{key}:participants", self.room_cache_ttl)
+            pipe.execute()
+            return True
+        except redis.RedisError as e:
+            # Drop the entry rather than leave it stale
+            logger.warning(f"Failed to update cached room {room_id}: {e}")
+            self._evict_cached_rooms(room_id)
+            return False
+    
+    def _mark_room_dirty(self, room_id: str) -> bool:
+        """Mark a room's cached playback state as not yet written to the database"""
+        if self._redis is None:
+            with self._dirty_lock:
+                self._dirty_rooms.add(room_id)
+            return True
+        
+        try:
+            self._redis.sadd("rooms:dirty", room_id)
+            return True
+        except redis.RedisError as e:
+            logger.warning(f"Failed to mark room {room_id} dirty: {e}")
+            return False
+    
+    def _pop_dirty_rooms(self, room_ids: Optional[List[str]] = None) -> List[str]:
+        """Take dirty room IDs (all, or only those in room_ids) off the dirty set"""
+        if self._redis is None:
+            with self._dirty_lock:
+                if room_ids is None:
+                    popped, self._dirty_rooms = self._dirty_rooms, set()
+                else:
+                    popped = self._dirty_rooms.intersection(room_ids)
+                    self._dirty_rooms -= popped
+            return list(popped)
+        
+        try:
+            if room_ids is None:
+                return self._redis.spop("rooms:dirty", _DIRTY_BATCH_SIZE) or []
+            pipe = self._redis.pipeline()
+            for room_id in room_ids:
+                pipe.srem("rooms:dirty", room_id)
+            return [room_id for room_id, removed in zip(room_ids, pipe.execute()) if removed]
+        except redis.RedisError as e:
+            logger.warning(f"Failed to read dirty rooms: {e}")
+            return []
+    
+    def _publish_room_event(self, room_id: str, event: Dict):
+        """Publish a room event on room:{room_id}:events (or to local listeners)"""
+        if self._redis is None:
+            with self._listeners_lock:
+                listeners = list(self._room_listeners.get(room_id, ()))
+            # Publishers run in worker threads; hand events to each
+            # subscriber's event loop
+            for loop, listener in listeners:
+                try:
+                    loop.call_soon_threadsafe(_offer_event, listener, event)
+                except RuntimeError:
+                    # Subscriber's loop already closed
+                    pass
+            return
+        
+        try:
+            self._redis.publish(f"room:{room_id}:events", orjson.dumps(event))
+        except redis.RedisError as e:
+            logger.warning(f"Failed to publish event for room {room_id}: {e}")
+    
+    async def listen_room_events(self, room_id: str, timeout: float = 15.0) -> AsyncIterator[Optional[Dict]]:
+        """
+        Subscribe to a room's state-change events.
+        
+        Waits on the event loop between events (no thread is held); yields
+        None after ``timeout`` idle seconds so callers can send keep-alives.
+        Unsubscribes when the generator closes.
+        """
+        room_id = room_id.upper()
+        
+        if self._async_redis is None:
+            listener = asyncio.Queue(maxsize=100)
+            entry = (asyncio.get_running_loop(), listener)
+            with self._listeners_lock:
+                self._room_listeners.setdefault(room_id, set()).add(entry)
+            try:
+                while True:
+                    try:
+                        yield await asyncio.wait_for(listener.get(), timeout)
+                    except asyncio.TimeoutError:
+                        yield None
+            finally:
+                with self._listeners_lock:
+                    listeners = self._room_listeners.get(room_id)
+                    if listeners is not None:
+                        listeners.discard(entry)
+                        if not listeners:
+                            del self._room_listeners[room_id]
+            return
+        
+        pubsub = self._async_redis.pubsub(ignore_subscribe_messages=True)
+        await pubsub.subscribe(f"room:{room_id}:events")
+        try:
+            while True:
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=timeout)
+                yield orjson.loads(message["data"]) if message else None
+        finally:
+            await pubsub.aclose()
+    
+    def _evict_cached_rooms(self, *room_ids: str):
+        """Remove rooms from the cache (one DEL for all of them)"""
+        if not room_ids:
+            return
+        
+        if self._redis is None:
+            if self._room_cache is not None:
+                for room_id in room_ids:
+                    self._room_cache.pop(room_id)
+            return
+        
+        keys = []
+        for room_id in room_ids:
+            keys += [f"room:{room_id}", f"room:{room_id}:participants"]
+        try:
+            self._redis.delete(*keys)
+        except redis.RedisError as e:
+            logger.warning(f"Failed to evict {len(room_ids)} cached room(s): {e}")
     
     def create_room(
         self,
         host_id: str,
         name: Optional[str] = None,
-        is_friends_only: bool = False
+        is_friends_only: bool = False,
+        db: Optional[Session] = None
     ) -> Dict:
         """
         Create a new music room.
@@ -38,299 +341,349 @@ class RoomService:
             host_id: User ID of the host
             name: Optional room name
             is_friends_only: If True, only friends can join
+            db: Optional session to use (a new one is opened if omitted)
             
         Returns:
             Room dictionary with room_id and details
         """
-        db: Session = SessionLocal()
-        try:
-            # Validate host
-            host = db.query(User).filter(User.user_id == host_id).first()
-            if not host:
-                raise ValueError("Host user not found")
-            
-            # Generate unique room ID (simple 6-char code)
-            room_id = secrets.token_hex(3).upper()
-            
-            # Ensure uniqueness
-            while db.query(MusicRoom).filter(MusicRoom.room_id == room_id).first():
-                room_id = secrets.token_hex(3).upper()
-            
-            # Create room
-            room = MusicRoom(
-                room_id=room_id,
-                host_id=host_id,
-                name=name,
-                is_friends_only=is_friends_only,
-                playback_state={
+        with use_session(db) as db:
+            try:
+                # Validate host
+                host_exists = db.query(
+                    db.query(User).filter(User.user_id == host_id).exists()
+                ).scalar()
+                if not host_exists:
+                    raise ValueError("Host user not found")
+                
+                # Room values are kept locally so nothing needs to be
+                # reloaded from the database after commit
+                created_at = datetime.utcnow()
+                playback_state = {
                     "playing": False,
                     "position": 0.0,
-                    "timestamp": datetime.utcnow().isoformat(),
+                    "timestamp": created_at.isoformat(),
                     "current_time": 0.0
-                },
-                created_at=datetime.utcnow(),
-                last_activity=datetime.utcnow()
-            )
-            
-            db.add(room)
-            
-            # Add host as participant
-            participant = RoomParticipant(
-                room_id=room_id,
-                user_id=host_id,
-                joined_at=datetime.utcnow(),
-                last_seen=datetime.utcnow(),
-                is_active=True
-            )
-            
-            db.add(participant)
-            db.commit()
-            db.refresh(room)
-            
-            # Update cache
-            self._room_cache[room_id] = {
-                "room_id": room_id,
-                "host_id": host_id,
-                "name": name,
-                "is_friends_only": is_friends_only,
-                "current_song": None,
-                "playback_state": room.playback_state,
-                "participants": [host_id],
-                "created_at": room.created_at.isoformat(),
-                "last_activity": room.last_activity.isoformat()
-            }
-            
-            logger.info(f"Room created: {room_id} by {host_id}")
-            
-            return {
-                "room_id": room_id,
-                "host_id": host_id,
-                "name": name,
-                "is_friends_only": is_friends_only,
-                "created_at": room.created_at.isoformat()
-            }
-        except ValueError:
-            raise
-        except Exception as e:
-            db.rollback()
-            logger.error(f"Error creating room: {e}")
-            raise ValueError(f"Failed to create room: {str(e)}")
-        finally:
-            db.close()
+                }
+                
+                # Generate a room ID (simple 6-char code); the primary key
+                # guarantees uniqueness, so retry with a new code on collision
+                for attempt in range(_ROOM_ID_ATTEMPTS):
+                    room_id = secrets.token_hex(3).upper()
+                    
+                    # Create room
+                    room = MusicRoom(
+                        room_id=room_id,
+                        host_id=host_id,
+                        name=name,
+                        is_friends_only=is_friends_only,
+                        playback_state=playback_state,
+                        created_at=created_at,
+                        last_activity=created_at
+                    )
+                    
+                    # Add host as participant
+                    participant = RoomParticipant(
+                        room_id=room_id,
+                        user_id=host_id,
+                        joined_at=created_at,
+                        last_seen=created_at,
+                        is_active=True
+                    )
+                    
+                    db.add_all([room, participant])
+                    try:
+                        db.commit()
+                        break
+                    except IntegrityError:
+                        db.rollback()
+                        logger.warning(f"Room ID collision on {room_id}, retrying")
+                else:
+                    raise ValueError("Failed to create room: could not allocate a unique room ID")
+                
+                # Update cache
+                self._cache_room({
+                    "room_id": room_id,
+                    "host_id": host_id,
+                    "name": name,
+                    "is_friends_only": is_friends_only,
+                    "current_song": None,
+                    "playback_state": playback_state,
+                    "participants": [host_id],
+                    "created_at": created_at.isoformat(),
+                    "last_activity": created_at.isoformat()
+                })
+                
+                logger.info(f"Room created: {room_id} by {host_id}")
+                
+                return {
+                    "room_id": room_id,
+                    "host_id": host_id,
+                    "name": name,
+                    "is_friends_only": is_friends_only,
+                    "created_at": created_at.isoformat()
+                }
+            except ValueError:
+                raise
+            except Exception as e:
+                db.rollback()
+                logger.error(f"Error creating room: {e}")
+                raise ValueError(f"Failed to create room: {str(e)}")
     
-    def join_room(self, room_id: str, user_id: str) -> Dict:
+    def join_room(self, room_id: str, user_id: str, db: Optional[Session] = None) -> Dict:
         """
         Join a music room.
         
         Args:
             room_id: Room ID
             user_id: User ID joining
+            db: Optional session to use (a new one is opened if omitted)
             
         Returns:
             Room state dictionary
         """
-        db: Session = SessionLocal()
-        room_id = room_id.upper() # Standardize to uppercase
-        try:
-            # Validate user
-            user = db.query(User).filter(User.user_id == user_id).first()
-            if not user:
-                raise ValueError("User not found")
-            
-            # Get room
-            room = db.query(MusicRoom).filter(MusicRoom.room_id == room_id).first()
-            if not room:
-                raise ValueError("Room not found")
-            
-            # Check if friends-only and not friends with host
-            if room.is_friends_only and room.host_id:
-                friend_service = get_friend_service()
-                if room.host_id != user_id and not friend_service.are_friends(room.host_id, user_id):
-                    raise ValueError("Room is friends-only and you are not friends with the host")
-            
-            # Check if already a participant
-            existing = db.query(RoomParticipant).filter(
-                and_(
-                    RoomParticipant.room_id == room_id,
-                    RoomParticipant.user_id == user_id
+        with use_session(db) as db:
+            room_id = room_id.upper() # Standardize to uppercase
+            try:
+                # Get room, its active participant IDs and whether the user exists in one query
+                dialect = db.get_bind().dialect.name
+                user_exists = db.query(User).filter(User.user_id == user_id).exists()
+                row = db.query(
+                    MusicRoom, user_exists, _active_participant_ids(dialect)
+                ).filter(MusicRoom.room_id == room_id).first()
+                if not row:
+                    raise ValueError("Room not found")
+                room, has_user, participant_ids = row
+                if not has_user:
+                    raise ValueError("User not found")
+                
+                # The cache holds the live playback state (the row only catches
+                # up on flush_dirty_rooms); use the row only on a cache miss
+                cached = self._get_cached_room(room_id)
+                source = cached if cached is not None else {
+                    "host_id": room.host_id,
+                    "current_song": room.current_song,
+                    "playback_state": room.playback_state
+                }
+                host_id = source["host_id"]
+                
+                # Check if friends-only and not friends with host
+                if room.is_friends_only and host_id:
+                    friend_service = get_friend_service()
+                    if host_id != user_id and not friend_service.are_friends(host_id, user_id):
+                        raise ValueError("Room is friends-only and you are not friends with the host")
+                
+                # Add participant, or reactivate an existing one, in one statement
+                now = datetime.utcnow()
+                insert = _DIALECT_INSERTS[dialect]
+                db.execute(
+                    insert(RoomParticipant).values(
+                        room_id=room_id,
+                        user_id=user_id,
+                        joined_at=now,
+                        last_seen=now,
+                        is_active=True
+                    ).on_conflict_do_update(
+                        index_elements=["room_id", "user_id"],
+                        set_={"last_seen": now, "is_active": True}
+                    )
                 )
-            ).first()
-            
-            if existing:
-                # Update last_seen and set active
-                existing.last_seen = datetime.utcnow()
-                existing.is_active = True
-            else:
-                # Add new participant
-                participant = RoomParticipant(
-                    room_id=room_id,
-                    user_id=user_id,
-                    joined_at=datetime.utcnow(),
-                    last_seen=datetime.utcnow(),
-                    is_active=True
+                
+                participant_ids = _decode_participant_ids(participant_ids)
+                if user_id not in participant_ids:
+                    participant_ids.append(user_id)
+                
+                # Update room activity with a direct UPDATE (no unit-of-work flush)
+                db.query(MusicRoom).filter_by(room_id=room_id).update(
+                    {"last_activity": now}, synchronize_session=False
                 )
-                db.add(participant)
-            
-            # Update room activity
-            room.last_activity = datetime.utcnow()
-            
-            db.commit()
-            
-            # Get all participants
-            participants = db.query(RoomParticipant).filter(
-                RoomParticipant.room_id == room_id,
-                RoomParticipant.is_active == True
-            ).all()
-            
-            participant_ids = [p.user_id for p in participants]
-            
-            # Update cache
-            if room_id in self._room_cache:
-                if user_id not in self._room_cache[room_id]["participants"]:
-                    self._room_cache[room_id]["participants"].append(user_id)
-            
-            logger.info(f"User {user_id} joined room {room_id}")
-            
-            return {
-                "room_id": room_id,
-                "host_id": room.host_id,
-                "name": room.name,
-                "is_friends_only": room.is_friends_only,
-                "current_song": room.current_song,
-                "playback_state": room.playback_state,
-                "participants": participant_ids,
-                "is_host": room.host_id == user_id
-            }
-        except ValueError:
-            raise
-        except Exception as e:
-            db.rollback()
-            logger.error(f"Error joining room: {e}")
-            raise ValueError(f"Failed to join room: {str(e)}")
-        finally:
-            db.close()
+                
+                # Build state before commit so the room isn't reloaded afterwards
+                state = {
+                    "room_id": room_id,
+                    "host_id": host_id,
+                    "name": room.name,
+                    "is_friends_only": room.is_friends_only,
+                    "current_song": source["current_song"],
+                    "playback_state": source["playback_state"],
+                    "participants": participant_ids,
+                    "created_at": room.created_at.isoformat(),
+                    "last_activity": now.isoformat()
+                }
+                
+                db.commit()
+                
+                # Update cache (without clobbering buffered playback state
+                # if the room is already cached)
+                if cached is None or not self._update_cached_room(
+                    room_id,
+                    fields={"last_activity": state["last_activity"]},
+                    add_participant=user_id
+                ):
+                    self._cache_room(state)
+                
+                logger.info(f"User {user_id} joined room {room_id}")
+                
+                return {
+                    "room_id": room_id,
+                    "host_id": state["host_id"],
+                    "name": state["name"],
+                    "is_friends_only": state["is_friends_only"],
+                    "current_song": state["current_song"],
+                    "playback_state": state["playback_state"],
+                    "participants": participant_ids,
+                    "is_host": state["host_id"] == user_id
+                }
+            except ValueError:
+                raise
+            except Exception as e:
+                db.rollback()
+                logger.error(f"Error joining room: {e}")
+                raise ValueError(f"Failed to join room: {str(e)}")
     
-    def leave_room(self, room_id: str, user_id: str) -> bool:
+    def leave_room(self, room_id: str, user_id: str, db: Optional[Session] = None) -> bool:
         """
         Leave a music room.
         
         Args:
             room_id: Room ID
             user_id: User ID
+            db: Optional session to use (a new one is opened if omitted)
             
         Returns:
             True if successful, False otherwise
         """
-        db: Session = SessionLocal()
-        room_id = room_id.upper()
-        try:
-            room = db.query(MusicRoom).filter(MusicRoom.room_id == room_id).first()
-            if not room:
-                raise ValueError("Room not found")
-            
-            # Mark participant as inactive
-            participant = db.query(RoomParticipant).filter(
-                and_(
-                    RoomParticipant.room_id == room_id,
-                    RoomParticipant.user_id == user_id
-                )
-            ).first()
-            
-            if participant:
-                participant.is_active = False
-                participant.last_seen = datetime.utcnow()
-            
-            # If host is leaving, transfer to oldest active participant
-            if room.host_id == user_id:
-                active_participants = db.query(RoomParticipant).filter(
+        with use_session(db) as db:
+            room_id = room_id.upper()
+            try:
+                # Lock the room row so concurrent leaves can't race the host transfer
+                room = db.query(MusicRoom).filter(
+                    MusicRoom.room_id == room_id
+                ).with_for_update().first()
+                if not room:
+                    raise ValueError("Room not found")
+                
+                now = datetime.utcnow()
+                
+                # Mark participant as inactive (no-op if they never joined)
+                db.query(RoomParticipant).filter(
                     and_(
+                        RoomParticipant.room_id == room_id,
+                        RoomParticipant.user_id == user_id
+                    )
+                ).update({"is_active": False, "last_seen": now}, synchronize_session=False)
+                
+                # If host is leaving, transfer to oldest active participant
+                # (keeping the current host if nobody else is left) in one UPDATE
+                if room.host_id == user_id:
+                    next_host = db.query(RoomParticipant.user_id).filter(
                         RoomParticipant.room_id == room_id,
                         RoomParticipant.is_active == True,
                         RoomParticipant.user_id != user_id
+                    ).order_by(RoomParticipant.joined_at.asc()).limit(1).scalar_subquery()
+                    
+                    host_id = db.execute(
+                        update(MusicRoom)
+                        .where(MusicRoom.room_id == room_id)
+                        .values(host_id=func.coalesce(next_host, MusicRoom.host_id), last_activity=now)
+                        .returning(MusicRoom.host_id)
+                        .execution_options(synchronize_session=False)
+                    ).scalar()
+                    
+                    room_empty = host_id == user_id
+                    if not room_empty:
+                        logger.info(f"Host transferred to {host_id} in room {room_id}")
+                    else:
+                        # No other participants - mark room for cleanup
+                        logger.info(f"Room {room_id} is now empty, will be cleaned up")
+                else:
+                    host_id = room.host_id
+                    db.query(MusicRoom).filter_by(room_id=room_id).update(
+                        {"last_activity": now}, synchronize_session=False
                     )
-                ).order_by(RoomParticipant.joined_at.asc()).first()
+                    room_empty = False
                 
-                if active_participants:
-                    room.host_id = active_participants.user_id
-                    logger.info(f"Host transferred to {active_participants.user_id} in room {room_id}")
-                else:
-                    # No other participants - mark room for cleanup
-                    logger.info(f"Room {room_id} is now empty, will be cleaned up")
-            
-            room.last_activity = datetime.utcnow()
-            db.commit()
-            
-            # Update cache
-            if room_id in self._room_cache:
-                if user_id in self._room_cache[room_id]["participants"]:
-                    self._room_cache[room_id]["participants"].remove(user_id)
-                self._room_cache[room_id]["host_id"] = room.host_id
-            
-            logger.info(f"User {user_id} left room {room_id}")
-            
-            return {
-                "status": "left",
-                "room_id": room_id
-            }
-        except ValueError:
-            raise
-        except Exception as e:
-            db.rollback()
-            logger.error(f"Error leaving room: {e}")
-            raise ValueError(f"Failed to leave room: {str(e)}")
-        finally:
-            db.close()
+                db.commit()
+                
+                # Persist any buffered playback state now that the room is idle
+                if room_empty:
+                    self.flush_dirty_rooms([room_id])
+                
+                # Update cache
+                self._update_cached_room(
+                    room_id,
+                    fields={
+                        "host_id": host_id,
+                        "last_activity": now.isoformat()
+                    },
+                    remove_participant=user_id
+                )
+                
+                logger.info(f"User {user_id} left room {room_id}")
+                
+                return {
+                    "status": "left",
+                    "room_id": room_id,
+                    "host_id": host_id
+                }
+            except ValueError:
+                raise
+            except Exception as e:
+                db.rollback()
+                logger.error(f"Error leaving room: {e}")
+                raise ValueError(f"Failed to leave room: {str(e)}")
     
-    def get_room_state(self, room_id: str) -> Optional[Dict]:
+    def get_room_state(self, room_id: str, db: Optional[Session] = None) -> Optional[Dict]:
         """
         Get current room state.
         
         Args:
             room_id: Room ID
+            db: Optional session to use (a new one is opened if omitted)
             
         Returns:
             Room state dictionary or None
         """
-        db: Session = SessionLocal()
         room_id = room_id.upper()
-        try:
-            room = db.query(MusicRoom).filter(MusicRoom.room_id == room_id).first()
-            if not room:
+        cached = self._get_cached_room(room_id)
+        if cached is not None:
+            return cached
+        
+        with use_session(db) as db:
+            try:
+                # Room and its active participant IDs in one query
+                row = db.query(
+                    MusicRoom, _active_participant_ids(db.get_bind().dialect.name)
+                ).filter(MusicRoom.room_id == room_id).first()
+                if not row:
+                    return None
+                room, participant_ids = row
+                participant_ids = _decode_participant_ids(participant_ids)
+                
+                state = {
+                    "room_id": room_id,
+                    "host_id": room.host_id,
+                    "name": room.name,
+                    "is_friends_only": room.is_friends_only,
+                    "current_song": room.current_song,
+                    "playback_state": room.playback_state,
+                    "participants": participant_ids,
+                    "created_at": room.created_at.isoformat(),
+                    "last_activity": room.last_activity.isoformat()
+                }
+                self._cache_room(state)
+                return state
+            except Exception as e:
+                logger.error(f"Error getting room state: {e}")
                 return None
-            
-            # Get active participants
-            participants = db.query(RoomParticipant).filter(
-                and_(
-                    RoomParticipant.room_id == room_id,
-                    RoomParticipant.is_active == True
-                )
-            ).all()
-            
-            participant_ids = [p.user_id for p in participants]
-            
-            return {
-                "room_id": room_id,
-                "host_id": room.host_id,
-                "name": room.name,
-                "is_friends_only": room.is_friends_only,
-                "current_song": room.current_song,
-                "playback_state": room.playback_state,
-                "participants": participant_ids,
-                "created_at": room.created_at.isoformat(),
-                "last_activity": room.last_activity.isoformat()
-            }
-        except Exception as e:
-            logger.error(f"Error getting room state: {e}")
-            return None
-        finally:
-            db.close()
     
     def update_room_state(
         self,
         room_id: str,
         user_id: str,
         current_song: Optional[Dict] = None,
-        playback_state: Optional[Dict] = None
+        playback_state: Optional[Dict] = None,
+        updated_at: Optional[datetime] = None,
+        db: Optional[Session] = None
     ) -> Dict:
         """
         Update room state (host only).
@@ -340,141 +693,208 @@ class RoomService:
             user_id: User ID (must be host)
             current_song: Optional song metadata
             playback_state: Optional playback state
+            updated_at: Server time the update was received (default: now)
+            db: Optional session to use (a new one is opened if omitted)
             
         Returns:
             Updated room state
         """
-        db: Session = SessionLocal()
         room_id = room_id.upper()
-        try:
-            room = db.query(MusicRoom).filter(MusicRoom.room_id == room_id).first()
-            if not room:
-                raise ValueError("Room not found")
-            
-            if room.host_id != user_id:
-                raise ValueError("Only host can update room state")
-            
-            if current_song is not None:
-                room.current_song = current_song
-            
-            if playback_state is not None:
-                # Update timestamp to server time
-                playback_state["timestamp"] = datetime.utcnow().isoformat()
-                room.playback_state = playback_state
-            
-            room.last_activity = datetime.utcnow()
-            db.commit()
-            db.refresh(room)
-            
-            # Update cache
-            if room_id in self._room_cache:
-                if current_song is not None:
-                    self._room_cache[room_id]["current_song"] = current_song
-                if playback_state is not None:
-                    self._room_cache[room_id]["playback_state"] = playback_state
+        
+        # Host check against the cached state (the database is only read on a miss)
+        room_state = self.get_room_state(room_id, db=db)
+        if not room_state:
+            raise ValueError("Room not found")
+        
+        if room_state["host_id"] != user_id:
+            raise ValueError("Only host can update room state")
+        
+        now = updated_at or datetime.utcnow()
+        fields = {"last_activity": now.isoformat()}
+        if current_song is not None:
+            fields["current_song"] = current_song
+        
+        if playback_state is not None:
+            # Update timestamp to server time
+            playback_state["timestamp"] = now.isoformat()
+            fields["playback_state"] = playback_state
+        
+        # Write-behind: the cache is authoritative and flush_dirty_rooms()
+        # persists it; write through if the cache can't take the update
+        if not (self._update_cached_room(room_id, fields=fields) and self._mark_room_dirty(room_id)):
+            self._write_room_state(room_id, current_song, playback_state, now, db=db)
+        
+        current_song = fields.get("current_song", room_state["current_song"])
+        playback_state = fields.get("playback_state", room_state["playback_state"])
+        
+        # Push the change to subscribers instead of making them poll
+        self._publish_room_event(room_id, {
+            "type": "state_updated",
+            "room_id": room_id,
+            "current_song": current_song,
+            "playback_state": playback_state
+        })
+        
+        return {
+            "room_id": room_id,
+            "current_song": current_song,
+            "playback_state": playback_state
+        }
+    
+    def _write_room_state(
+        self,
+        room_id: str,
+        current_song: Optional[Dict],
+        playback_state: Optional[Dict],
+        now: datetime,
+        db: Optional[Session] = None
+    ):
+        """Write a room state update straight to the database"""
+        values = {"last_activity": now}
+        if current_song is not None:
+            values["current_song"] = current_song
+        if playback_state is not None:
+            values["playback_state"] = playback_state
+        
+        with use_session(db) as db:
+            try:
+                db.query(MusicRoom).filter(
+                    MusicRoom.room_id == room_id
+                ).update(values, synchronize_session=False)
+                db.commit()
+            except Exception as e:
+                db.rollback()
+                logger.error(f"Error updating room state: {e}")
+                raise ValueError(f"Failed to update room state: {str(e)}")
+    
+    def flush_dirty_rooms(self, room_ids: Optional[List[str]] = None, db: Optional[Session] = None) -> int:
+        """
+        Persist cached playback state of dirty rooms to the database.
+        
+        Args:
+            room_ids: Only flush these rooms (default: all dirty rooms)
+            db: Optional session to use (a new one is opened if omitted)
             
-            return {
-                "room_id": room_id,
-                "current_song": room.current_song,
-                "playback_state": room.playback_state
-            }
-        except ValueError:
-            raise
-        except Exception as e:
-            db.rollback()
-            logger.error(f"Error updating room state: {e}")
-            raise ValueError(f"Failed to update room state: {str(e)}")
-        finally:
-            db.close()
+        Returns:
+            Number of rooms written
+        """
+        dirty = self._pop_dirty_rooms(room_ids)
+        if not dirty:
+            return 0
+        
+        rows = []
+        for room_id in dirty:
+            state = self._get_cached_room(room_id)
+            if state:
+                rows.append({
+                    "room_id": room_id,
+                    "current_song": state.get("current_song"),
+                    "playback_state": state.get("playback_state"),
+                    "last_activity": datetime.fromisoformat(state["last_activity"])
+                })
+        if not rows:
+            return 0
+        
+        with use_session(db) as db:
+            try:
+                # ORM bulk UPDATE by primary key (executemany)
+                db.execute(update(MusicRoom), rows)
+                db.commit()
+                return len(rows)
+            except Exception as e:
+                db.rollback()
+                logger.error(f"Error flushing room state: {e}")
+                # Keep them dirty so the next flush retries
+                for row in rows:
+                    self._mark_room_dirty(row["room_id"])
+                return 0
     
-    def get_user_rooms(self, user_id: str) -> List[Dict]:
+    def get_user_rooms(self, user_id: str, db: Optional[Session] = None) -> List[Dict]:
         """
         Get all rooms a user is currently in.
         
         Args:
             user_id: User ID
+            db: Optional session to use (a new one is opened if omitted)
             
         Returns:
             List of room dictionaries
         """
-        db: Session = SessionLocal()
-        try:
-            # Get active participants
-            participants = db.query(RoomParticipant).filter(
-                and_(
+        with use_session(db) as db:
+            try:
+                # Get active memberships and their rooms in one query
+                rows = db.query(MusicRoom, RoomParticipant).join(
+                    RoomParticipant, RoomParticipant.room_id == MusicRoom.room_id
+                ).filter(
                     RoomParticipant.user_id == user_id,
                     RoomParticipant.is_active == True
-                )
-            ).all()
-            
-            rooms = []
-            for participant in participants:
-                room = db.query(MusicRoom).filter(
-                    MusicRoom.room_id == participant.room_id
-                ).first()
+                ).all()
                 
-                if room:
-                    rooms.append({
+                return [
+                    {
                         "room_id": room.room_id,
                         "host_id": room.host_id,
                         "name": room.name,
                         "is_friends_only": room.is_friends_only,
                         "is_host": room.host_id == user_id,
                         "joined_at": participant.joined_at.isoformat()
-                    })
-            
-            return rooms
-        except Exception as e:
-            logger.error(f"Error getting user rooms: {e}")
-            return []
-        finally:
-            db.close()
+                    }
+                    for room, participant in rows
+                ]
+            except Exception as e:
+                logger.error(f"Error getting user rooms: {e}")
+                return []
     
-    def cleanup_empty_rooms(self, max_age_hours: int = 24) -> int:
+    def cleanup_empty_rooms(self, max_age_hours: int = 24, db: Optional[Session] = None) -> int:
         """
         Clean up empty rooms older than max_age_hours.
         
         Args:
             max_age_hours: Maximum age in hours for empty rooms
+            db: Optional session to use (a new one is opened if omitted)
             
         Returns:
             Number of rooms cleaned up
         """
-        db: Session = SessionLocal()
-        try:
-            cutoff_time = datetime.utcnow() - timedelta(hours=max_age_hours)
-            
-            # Find rooms with no active participants
-            rooms = db.query(MusicRoom).filter(
-                MusicRoom.last_activity < cutoff_time
-            ).all()
-            
-            cleaned = 0
-            for room in rooms:
-                active_count = db.query(RoomParticipant).filter(
-                    and_(
-                        RoomParticipant.room_id == room.room_id,
-                        RoomParticipant.is_active == True
-                    )
-                ).count()
+        with use_session(db) as db:
+            try:
+                cutoff_time = datetime.utcnow() - timedelta(hours=max_age_hours)
                 
-                if active_count == 0:
-                    # Remove from cache
-                    if room.room_id in self._room_cache:
-                        del self._room_cache[room.room_id]
-                    
-                    db.delete(room)
-                    cleaned += 1
-            
-            db.commit()
-            logger.info(f"Cleaned up {cleaned} empty rooms")
-            return cleaned
-        except Exception as e:
-            db.rollback()
-            logger.error(f"Error cleaning up rooms: {e}")
-            return 0
-        finally:
-            db.close()
+                # Stale rooms with no active participants
+                has_active = select(RoomParticipant.id).where(
+                    RoomParticipant.room_id == MusicRoom.room_id,
+                    RoomParticipant.is_active == True
+                ).exists()
+                empty_rooms = select(MusicRoom.room_id).where(
+                    MusicRoom.last_activity < cutoff_time,
+                    ~has_active
+                )
+                
+                # Delete their (inactive) participants, then the rooms, in two
+                # set-based statements; SQLite doesn't enforce ON DELETE CASCADE
+                db.execute(
+                    delete(RoomParticipant)
+                    .where(RoomParticipant.room_id.in_(empty_rooms))
+                    .execution_options(synchronize_session=False)
+                )
+                deleted = db.execute(
+                    delete(MusicRoom)
+                    .where(MusicRoom.last_activity < cutoff_time, ~has_active)
+                    .returning(MusicRoom.room_id)
+                    .execution_options(synchronize_session=False)
+                ).scalars().all()
+                
+                db.commit()
+                
+                # Remove from cache
+                self._evict_cached_rooms(*deleted)
+                cleaned = len(deleted)
+                logger.info(f"Cleaned up {cleaned} empty rooms")
+                return cleaned
+            except Exception as e:
+                db.rollback()
+                logger.error(f"Error cleaning up rooms: {e}")
+                return 0
 
 
 # Singleton instance
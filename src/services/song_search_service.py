@@ -4,16 +4,61 @@ Searches for songs and retrieves metadata including images
 """
 
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import orjson
+import os
+import re
+import hashlib
+import io
 from typing import List, Dict, Optional
-from urllib.parse import quote
-import time
+from urllib.parse import quote, urlparse
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError, wait
 import logging
 
+from src.services.ttl_cache import TTLCache
+
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# iTunes artwork size segment, rewritten to request larger images
+_ARTWORK_SIZE_RE = re.compile(r'100x100bb')
+
+# Seconds iTunes gets on its own before Last.fm is started alongside it
+_LASTFM_HEAD_START = 1.0
+
+# Longest Retry-After the session will sleep for; searches are interactive,
+# so a longer server hint is cut down rather than stalling the request
+_MAX_RETRY_AFTER = 2.0
+
+
+class _CappedRetry(Retry):
+    """Retry that honors Retry-After only up to _MAX_RETRY_AFTER seconds"""
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            return None
+        return min(retry_after, _MAX_RETRY_AFTER)
+
+# Image hosts the thumbnail proxy may fetch from (iTunes and Last.fm artwork)
+_THUMBNAIL_HOSTS = ("mzstatic.com", "lastfm.freetls.fastly.net")
+
+# Try to import Redis client (optional shared search cache)
+try:
+    import redis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+
+# Try to import Pillow (optional artwork thumbnails)
+try:
+    from PIL import Image
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+
 
 class SongSearchService:
     """Service for searching songs and getting metadata"""
@@ -23,6 +68,73 @@ class SongSearchService:
         self.session.headers.update({
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
         })
+        # Pooled keep-alive connections with built-in retry/backoff
+        adapter = HTTPAdapter(
+            pool_connections=20,
+            pool_maxsize=100,
+            max_retries=_CappedRetry(
+                total=3,
+                backoff_factor=0.5,
+                status_forcelist=[429, 500, 502, 503, 504],
+                respect_retry_after_header=True,
+                raise_on_status=False
+            )
+        )
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        # Separate pools so source searches never wait behind their own
+        # Last.fm track-info lookups
+        self.search_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="song-search")
+        self.info_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="song-info")
+        self.track_info_timeout = 3
+        
+        # Memoize searches and track info: in-process first, then Redis
+        # (when REDIS_URL is set) so workers share results
+        self.cache_ttl = int(os.getenv("SEARCH_CACHE_TTL", "3600"))
+        self.search_cache = TTLCache(max_size=10000, ttl=self.cache_ttl)
+        self.track_info_cache = TTLCache(max_size=10000, ttl=self.cache_ttl)
+        # Encoded thumbnails are a few KB each; kept per process only
+        self.thumbnail_cache = TTLCache(max_size=2000, ttl=24 * 3600)
+        self._redis = None
+        redis_url = os.getenv("REDIS_URL")
+        if redis_url and REDIS_AVAILABLE:
+            self._redis = redis.Redis(
+                connection_pool=redis.ConnectionPool.from_url(redis_url, decode_responses=True)
+            )
+    
+    def _cache_get(self, local: TTLCache, key: str):
+        """Look up a memoized result locally, then in Redis"""
+        value = local.get(key)
+        if value is not None or self._redis is None:
+            return value
+        
+        try:
+            raw = self._redis.get(key)
+        except redis.RedisError as e:
+            logger.debug(f"Redis cache read failed: {e}")
+            return None
+        if raw is None:
+            return None
+        value = orjson.loads(raw)
+        local.put(key, value)
+        return value
+    
+    def _cache_put(self, local: TTLCache, key: str, value):
+        """Memoize a result locally and in Redis"""
+        local.put(key, value)
+        if self._redis is None:
+            return
+        
+        try:
+            self._redis.setex(key, self.cache_ttl, orjson.dumps(value))
+        except redis.RedisError as e:
+            logger.debug(f"Redis cache write failed: {e}")
+    
+    @staticmethod
+    def _cache_key(prefix: str, *parts) -> str:
+        """Build a fixed-length cache key from normalized parts"""
+        digest = hashlib.sha1("\x1f".join(str(p) for p in parts).encode("utf-8")).hexdigest()
+        return f"{prefix}:{digest}"
     
     def search_songs(self, query: str, limit: int = 20) -> List[Dict]:
         """
@@ -40,12 +152,30 @@ class SongSearchService:
             return []
         
         query = query.strip()
+        
+        # Cached results are shared, so hand out copies
+        cache_key = self._cache_key("search", query.lower(), limit)
+        cached = self._cache_get(self.search_cache, cache_key)
+        if cached is not None:
+            logger.info(f"Search cache hit for query: '{query}'")
+            return [dict(song) for song in cached]
+        
         results = []
         
+        # iTunes first; Last.fm (a search plus per-track lookups) is only
+        # started if iTunes is slow or comes back short
+        logger.info(f"Searching iTunes for: '{query}'")
+        itunes_future = self.search_executor.submit(self._search_itunes, query, limit)
+        lastfm_future = None
+        
         # Primary source: iTunes API (free, no auth, reliable)
         try:
-            logger.info(f"Searching iTunes for: '{query}'")
-            itunes_results = self._search_itunes(query, limit)
+            try:
+                itunes_results = itunes_future.result(timeout=_LASTFM_HEAD_START)
+            except FuturesTimeoutError:
+                logger.info(f"iTunes is slow; querying Last.fm alongside for: '{query}'")
+                lastfm_future = self.search_executor.submit(self._search_lastfm, query, limit)
+                itunes_results = itunes_future.result()
             if itunes_results:
                 results.extend(itunes_results)
                 logger.info(f"Found {len(itunes_results)} results from iTunes for query: {query}")
@@ -54,11 +184,12 @@ class SongSearchService:
         except Exception as e:
             logger.error(f"iTunes search failed: {e}", exc_info=True)
         
-        # Fallback: Try Last.fm if iTunes didn't return enough
+        # Fallback: Use Last.fm if iTunes didn't return enough
         if len(results) < limit:
+            if lastfm_future is None:
+                lastfm_future = self.search_executor.submit(self._search_lastfm, query, limit - len(results))
             try:
-                logger.info(f"Searching Last.fm for additional results: '{query}'")
-                lastfm_results = self._search_lastfm(query, limit - len(results))
+                lastfm_results = lastfm_future.result()
                 if lastfm_results:
                     results.extend(lastfm_results)
                     logger.info(f"Found {len(lastfm_results)} additional results from Last.fm")
@@ -69,17 +200,25 @@ class SongSearchService:
         seen = set()
         unique_results = []
         for song in results:
-            title = song.get('title', '').lower().strip()
-            artist = (song.get('artists', [''])[0] if song.get('artists') else '').lower().strip()
-            key = (title, artist)
-            if key not in seen and key != ('', '') and title:
+            title = song.get('title', '').strip().casefold()
+            if not title:
+                continue
+            artists = song.get('artists') or ('',)
+            key = (title, artists[0].strip().casefold())
+            if key not in seen:
                 seen.add(key)
                 unique_results.append(song)
                 if len(unique_results) >= limit:
                     break
         
         logger.info(f"Total unique results: {len(unique_results)} for query: '{query}'")
-        return unique_results[:limit]
+        unique_results = unique_results[:limit]
+        
+        # Don't memoize empty results - they're usually upstream failures
+        if unique_results:
+            self._cache_put(self.search_cache, cache_key, unique_results)
+            return [dict(song) for song in unique_results]
+        return unique_results
     
     def _search_lastfm(self, query: str, limit: int) -> List[Dict]:
         """Search using Last.fm API"""
@@ -102,7 +241,8 @@ class SongSearchService:
                     logger.info(f"No Last.fm results for query: {query}")
                     return []
                 
-                results = []
+                # Fetch track info (for images) for all tracks concurrently
+                matches = []
                 for track in tracks[:limit]:
                     track_name = track.get('name', '').strip()
                     artist_name = track.get('artist', '').strip()
@@ -110,12 +250,22 @@ class SongSearchService:
                     if not track_name:
                         continue
                     
-                    # Get track info for image (non-blocking, don't wait if slow)
-                    try:
-                        track_info = self._get_lastfm_track_info(artist_name, track_name)
-                        image = track_info.get('image', '')
-                    except:
-                        image = ''
+                    info_future = self.info_executor.submit(self._get_lastfm_track_info, artist_name, track_name)
+                    matches.append((track, track_name, artist_name, info_future))
+                
+                # Don't wait on slow lookups beyond a single shared timeout
+                wait([m[3] for m in matches], timeout=self.track_info_timeout)
+                
+                results = []
+                for track, track_name, artist_name, info_future in matches:
+                    image = ''
+                    if info_future.done():
+                        try:
+                            image = info_future.result().get('image', '')
+                        except Exception:
+                            image = ''
+                    else:
+                        info_future.cancel()
                     
                     results.append({
                         'title': track_name,
@@ -143,6 +293,11 @@ class SongSearchService:
             if not artist or not track:
                 return {'image': '', 'genre': []}
             
+            cache_key = self._cache_key("lastfm_track", artist.lower(), track.lower())
+            cached = self._cache_get(self.track_info_cache, cache_key)
+            if cached is not None:
+                return dict(cached)
+            
             url = "https://ws.audioscrobbler.com/2.0/"
             params = {
                 'method': 'track.getInfo',
@@ -168,10 +323,12 @@ class SongSearchService:
                             image_url = img.get('#text')
                             break
                 
-                return {
+                track_info = {
                     'image': image_url,
                     'genre': [tag.get('name', '') for tag in track_data.get('toptags', {}).get('tag', [])[:3]]
                 }
+                self._cache_put(self.track_info_cache, cache_key, track_info)
+                return dict(track_info)
         except requests.exceptions.Timeout:
             # Timeout is OK - return empty, don't block search
             pass
@@ -191,71 +348,51 @@ class SongSearchService:
                 'entity': 'song'
             }
             
-            # Add retry logic for reliability
-            max_retries = 3
-            for attempt in range(max_retries):
-                try:
-                    response = self.session.get(url, params=params, timeout=15)
-                    if response.status_code == 200:
-                        data = response.json()
-                        results = []
-                        
-                        # Check if we got results
-                        items = data.get('results', [])
-                        if not items:
-                            logger.warning(f"No iTunes results for query: {query}")
-                            return []
-                        
-                        for item in items:
-                            # Get high-quality artwork
-                            artwork_url = item.get('artworkUrl100', '')
-                            if artwork_url:
-                                # Try to get higher quality (600x600)
-                                artwork_url = artwork_url.replace('100x100bb', '600x600bb')
-                                # Fallback to 300x300 if 600x600 doesn't work
-                                if '100x100bb' in artwork_url:
-                                    artwork_url = artwork_url.replace('100x100bb', '300x300bb')
-                            
-                            # Only add if we have a title
-                            track_name = item.get('trackName', '').strip()
-                            if track_name:
-                                results.append({
-                                    'title': track_name,
-                                    'artists': [item.get('artistName', 'Unknown Artist')],
-                                    'image': artwork_url,
-                                    'genre': [item.get('primaryGenreName', '')] if item.get('primaryGenreName') else [],
-                                    'platform_id': str(item.get('trackId', '')),
-                                    'album': item.get('collectionName', ''),
-                                    'source': 'itunes'
-                                })
-                        
-                        logger.info(f"iTunes search successful: {len(results)} results for '{query}'")
-                        return results
-                    elif response.status_code == 429:
-                        # Rate limited - wait and retry
-                        wait_time = (attempt + 1) * 2
-                        logger.warning(f"iTunes rate limited, waiting {wait_time}s before retry...")
-                        time.sleep(wait_time)
-                        continue
-                    else:
-                        logger.error(f"iTunes API returned status {response.status_code}")
-                        break
-                except requests.exceptions.Timeout:
-                    if attempt < max_retries - 1:
-                        logger.warning(f"iTunes search timeout, retrying... (attempt {attempt + 1}/{max_retries})")
-                        time.sleep(1)
-                        continue
-                    else:
-                        logger.error("iTunes search timeout - request took too long after retries")
-                        break
-                except requests.exceptions.RequestException as e:
-                    if attempt < max_retries - 1:
-                        logger.warning(f"iTunes network error, retrying... (attempt {attempt + 1}/{max_retries}): {e}")
-                        time.sleep(1)
-                        continue
-                    else:
-                        logger.error(f"iTunes search network error: {e}")
-                        break
+            # Retries (with backoff, honoring a capped Retry-After) are handled by the session adapter
+            try:
+                response = self.session.get(url, params=params, timeout=(3, 10))
+            except requests.exceptions.Timeout:
+                logger.error("iTunes search timeout - request took too long after retries")
+                return []
+            except requests.exceptions.RequestException as e:
+                logger.error(f"iTunes search network error: {e}")
+                return []
+            
+            if response.status_code == 200:
+                data = response.json()
+                results = []
+                
+                # Check if we got results
+                items = data.get('results', [])
+                if not items:
+                    logger.warning(f"No iTunes results for query: {query}")
+                    return []
+                
+                for item in items:
+                    # Get high-quality artwork (600x600)
+                    artwork_url = item.get('artworkUrl100', '')
+                    if artwork_url:
+                        artwork_url = _ARTWORK_SIZE_RE.sub('600x600bb', artwork_url, count=1)
+                    
+                    # Only add if we have a title
+                    track_name = item.get('trackName', '').strip()
+                    if track_name:
+                        results.append({
+                            'title': track_name,
+                            'artists': [item.get('artistName', 'Unknown Artist')],
+                            'image': artwork_url,
+                            'genre': [item.get('primaryGenreName', '')] if item.get('primaryGenreName') else [],
+                            'platform_id': str(item.get('trackId', '')),
+                            'album': item.get('collectionName', ''),
+                            'source': 'itunes'
+                        })
+                
+                logger.info(f"iTunes search successful: {len(results)} results for '{query}'")
+                return results
+            elif response.status_code == 429:
+                logger.warning("iTunes rate limited after retries")
+            else:
+                logger.error(f"iTunes API returned status {response.status_code}")
         except Exception as e:
             logger.error(f"iTunes search error: {e}", exc_info=True)
         
@@ -266,6 +403,53 @@ class SongSearchService:
         # Placeholder - would need Spotify API credentials
         return None
     
+    @staticmethod
+    def is_thumbnail_source(image_url: str) -> bool:
+        """Whether the thumbnail proxy is allowed to fetch this URL"""
+        parsed = urlparse(image_url)
+        host = (parsed.hostname or '').lower()
+        return parsed.scheme in ('http', 'https') and any(
+            host == allowed or host.endswith('.' + allowed) for allowed in _THUMBNAIL_HOSTS
+        )
+    
+    def get_thumbnail(self, image_url: str, size: int = 128) -> Optional[bytes]:
+        """
+        Get a small WebP thumbnail of search artwork.
+        
+        Args:
+            image_url: Artwork URL from a search result (iTunes/Last.fm hosts only)
+            size: Maximum width/height in pixels
+            
+        Returns:
+            WebP image bytes, or None if unavailable
+        """
+        if not PIL_AVAILABLE or not self.is_thumbnail_source(image_url):
+            return None
+        
+        cache_key = self._cache_key("thumb", image_url, size)
+        cached = self.thumbnail_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        
+        try:
+            response = self.session.get(image_url, timeout=(3, 10))
+            if response.status_code != 200:
+                logger.debug(f"Thumbnail source returned status {response.status_code}")
+                return None
+            
+            with Image.open(io.BytesIO(response.content)) as image:
+                image = image.convert('RGBA' if image.mode in ('RGBA', 'LA', 'P') else 'RGB')
+                image.thumbnail((size, size))
+                output = io.BytesIO()
+                image.save(output, format='WEBP', quality=80)
+        except Exception as e:
+            logger.debug(f"Thumbnail generation failed: {e}")
+            return None
+        
+        thumbnail = output.getvalue()
+        self.thumbnail_cache.put(cache_key, thumbnail)
+        return thumbnail
+    
     def get_song_image_fallback(self, title: str, artist: str) -> str:
         """Fallback method to get song image using web scraping"""
         try:
@@ -3,17 +3,41 @@ Song Storage Service
 Manages persistent storage of songs using database
 """
 
-from typing import List, Dict, Optional
+from typing import Dict, Iterator, List, Optional
 from datetime import datetime
-from sqlalchemy.orm import Session
-from sqlalchemy import func, or_, and_
+from sqlalchemy.orm import Session, selectinload
+from sqlalchemy import delete, func, literal, or_
+from sqlalchemy.dialects import postgresql, sqlite
+import itertools
 import logging
 import secrets
 
-from src.database.models import Song, UserSong, SessionLocal
+from src.database.models import Song, UserSong, song_search_blob
+from src.database.session import session_scope, use_session
 
 logger = logging.getLogger(__name__)
 
+_DIALECT_INSERTS = {
+    "postgresql": postgresql.insert,
+    "sqlite": sqlite.insert,
+}
+
+_STREAM_BATCH_SIZE = 500
+
+
+def _song_to_dict(song: Song) -> Dict:
+    """Public song fields shared by the listing and search responses"""
+    return {
+        "title": song.title,
+        "artists": song.artists,
+        "album": song.album,
+        "image": song.image,
+        "genre": song.genre,
+        "platform": song.platform,
+        "platform_id": song.platform_id,
+        "youtube_video_id": song.youtube_video_id
+    }
+
 
 class SongStorageService:
     """Service for storing and retrieving songs from database"""
@@ -36,6 +60,7 @@ class SongStorageService:
         if not song:
             # Create new song
             song_id = f"song_{secrets.token_hex(12)}"
+            now = datetime.utcnow()
             song = Song(
                 song_id=song_id,
                 title=title,
@@ -46,26 +71,50 @@ class SongStorageService:
                 platform=song_data.get("platform", "unknown"),
                 platform_id=song_data.get("platform_id"),
                 youtube_video_id=song_data.get("youtube_video_id"),
-                created_at=datetime.utcnow(),
-                last_updated=datetime.utcnow(),
-                extra_data=song_data.get("metadata", {})
+                created_at=now,
+                last_updated=now,
+                extra_data=song_data.get("metadata", {}),
+                search_blob=song_search_blob(title, artists, song_data.get("genre", []))
             )
             db.add(song)
             db.commit()
             db.refresh(song)
         else:
-            # Update existing song if new data provided
+            # Update existing song if new data provided; commit only on change
+            dirty = False
             if song_data.get("image") and not song.image:
                 song.image = song_data.get("image")
+                dirty = True
             if song_data.get("youtube_video_id") and not song.youtube_video_id:
                 song.youtube_video_id = song_data.get("youtube_video_id")
+                dirty = True
             if song_data.get("album") and not song.album:
                 song.album = song_data.get("album")
-            song.last_updated = datetime.utcnow()
-            db.commit()
+                dirty = True
+            if not song.search_blob:
+                song.search_blob = song_search_blob(song.title, song.artists, song.genre)
+                dirty = True
+            if dirty:
+                song.last_updated = datetime.utcnow()
+                db.commit()
         
         return song
     
+    @staticmethod
+    def _normalize_song(song: Dict) -> Dict:
+        """Normalize incoming song data before storing it"""
+        return {
+            "title": song.get("title", "").strip(),
+            "artists": [a.strip() for a in song.get("artists", [])],
+            "genre": [g.strip() for g in song.get("genre", [])] if song.get("genre") else [],
+            "album": song.get("album", "").strip(),
+            "image": song.get("image", ""),
+            "platform": song.get("platform", "unknown"),
+            "platform_id": song.get("platform_id"),
+            "youtube_video_id": song.get("youtube_video_id"),
+            "metadata": song.get("metadata", {})
+        }
+    
     def add_song(self, song: Dict, user_id: Optional[str] = None) -> bool:
         """
         Add a song to storage.
@@ -77,67 +126,171 @@ class SongStorageService:
         Returns:
             True if added, False if already exists
         """
-        db: Session = SessionLocal()
-        try:
-            # Normalize song data
-            normalized_song = {
-                "title": song.get("title", "").strip(),
-                "artists": [a.strip() for a in song.get("artists", [])],
-                "genre": [g.strip() for g in song.get("genre", [])] if song.get("genre") else [],
-                "album": song.get("album", "").strip(),
-                "image": song.get("image", ""),
-                "platform": song.get("platform", "unknown"),
-                "platform_id": song.get("platform_id"),
-                "youtube_video_id": song.get("youtube_video_id"),
-                "metadata": song.get("metadata", {})
-            }
-            
-            # Get or create song
-            db_song = self._get_or_create_song(db, normalized_song)
-            
-            # Add to user songs if user_id provided
-            if user_id:
-                self.add_song_to_user(user_id, db_song.song_id, db, source="manual")
+        with session_scope() as db:
+            try:
+                # Normalize song data
+                normalized_song = self._normalize_song(song)
+                
+                # Get or create song
+                db_song = self._get_or_create_song(db, normalized_song)
+                
+                # Add to user songs if user_id provided
+                if user_id:
+                    self.add_song_to_user(user_id, db_song.song_id, db, source="manual")
+                
+                return True
+            except Exception as e:
+                logger.error(f"Error adding song: {e}")
+                db.rollback()
+                return False
+    
+    def add_songs_bulk(self, songs: List[Dict], user_id: Optional[str] = None) -> bool:
+        """
+        Add many songs to storage in one batch.
+        
+        Existing songs are matched by title with a single IN query, missing
+        ones are bulk inserted, and everything is committed once.
+        
+        Args:
+            songs: Song dictionaries with title, artists, genre, etc.
+            user_id: Optional user ID to associate the songs with
             
+        Returns:
+            True if stored, False on error
+        """
+        normalized_songs = [self._normalize_song(song) for song in songs]
+        normalized_songs = [song for song in normalized_songs if song["title"]]
+        if not normalized_songs:
             return True
-        except Exception as e:
-            logger.error(f"Error adding song: {e}")
-            db.rollback()
-            return False
-        finally:
-            db.close()
+        
+        with session_scope() as db:
+            try:
+                titles_lower = {song["title"].lower() for song in normalized_songs}
+                existing = {
+                    song.title.lower(): song
+                    for song in db.query(Song).filter(func.lower(Song.title).in_(titles_lower))
+                }
+                
+                now = datetime.utcnow()
+                song_ids = []
+                missing = {}
+                for song_data in normalized_songs:
+                    title_lower = song_data["title"].lower()
+                    song = existing.get(title_lower)
+                    if song is not None:
+                        # Fill in details the stored song is missing
+                        if song_data["image"] and not song.image:
+                            song.image = song_data["image"]
+                        if song_data["youtube_video_id"] and not song.youtube_video_id:
+                            song.youtube_video_id = song_data["youtube_video_id"]
+                        if song_data["album"] and not song.album:
+                            song.album = song_data["album"]
+                        if db.is_modified(song):
+                            song.last_updated = now
+                        song_ids.append(song.song_id)
+                        continue
+                    
+                    if title_lower not in missing:
+                        missing[title_lower] = {
+                            "song_id": f"song_{secrets.token_hex(12)}",
+                            "title": song_data["title"],
+                            "artists": song_data["artists"],
+                            "genre": song_data["genre"],
+                            "album": song_data["album"],
+                            "image": song_data["image"],
+                            "platform": song_data["platform"],
+                            "platform_id": song_data["platform_id"],
+                            "youtube_video_id": song_data["youtube_video_id"],
+                            "created_at": now,
+                            "last_updated": now,
+                            "extra_data": song_data["metadata"],
+                            "search_blob": song_search_blob(song_data["title"], song_data["artists"], song_data["genre"])
+                        }
+                    song_ids.append(missing[title_lower]["song_id"])
+                
+                if missing:
+                    db.bulk_insert_mappings(Song, list(missing.values()))
+                db.commit()
+                
+                # Add to user songs if user_id provided
+                if user_id:
+                    self.add_songs_to_user(user_id, song_ids, db, source="manual")
+                
+                return True
+            except Exception as e:
+                logger.error(f"Error adding songs: {e}")
+                db.rollback()
+                return False
     
     def add_song_to_user(self, user_id: str, song_id: str, db: Optional[Session] = None, source: str = "manual"):
         """Add song to user's collection"""
-        should_close = False
-        if db is None:
-            db = SessionLocal()
-            should_close = True
-        
-        try:
-            # Check if already exists
-            user_song = db.query(UserSong).filter(
-                and_(
-                    UserSong.user_id == user_id,
-                    UserSong.song_id == song_id
+        with use_session(db) as db:
+            try:
+                # Insert unless already linked, in one statement
+                insert = _DIALECT_INSERTS[db.get_bind().dialect.name]
+                db.execute(
+                    insert(UserSong).values(
+                        user_id=user_id,
+                        song_id=song_id,
+                        source=source,
+                        added_at=datetime.utcnow(),
+                        is_favorite=False,
+                        play_count=0
+                    ).on_conflict_do_nothing(
+                        index_elements=["user_id", "song_id"]
+                    )
                 )
-            ).first()
+                db.commit()
+            except Exception as e:
+                logger.error(f"Error adding song to user: {e}")
+                db.rollback()
+    
+    def add_songs_to_user(self, user_id: str, song_ids: List[str], db: Optional[Session] = None, source: str = "manual") -> int:
+        """
+        Add many songs to a user's collection in one batch.
+        
+        Links are written with one multi-row INSERT ... ON CONFLICT DO
+        NOTHING, so links that already exist (or are added concurrently)
+        are skipped without failing the batch.
+        
+        Args:
+            user_id: User ID
+            song_ids: Song IDs to link to the user
+            db: Optional session to reuse
+            source: Source recorded on the new UserSong rows
             
-            if not user_song:
-                user_song = UserSong(
-                    user_id=user_id,
-                    song_id=song_id,
-                    source=source,
-                    added_at=datetime.utcnow()
+        Returns:
+            Number of songs added
+        """
+        song_ids = list(dict.fromkeys(song_ids))
+        if not song_ids:
+            return 0
+        
+        with use_session(db) as db:
+            try:
+                now = datetime.utcnow()
+                insert = _DIALECT_INSERTS[db.get_bind().dialect.name]
+                result = db.execute(
+                    insert(UserSong).values([
+                        {
+                            "user_id": user_id,
+                            "song_id": song_id,
+                            "source": source,
+                            "added_at": now,
+                            "is_favorite": False,
+                            "play_count": 0
+                        }
+                        for song_id in song_ids
+                    ]).on_conflict_do_nothing(
+                        index_elements=["user_id", "song_id"]
+                    )
                 )
-                db.add(user_song)
                 db.commit()
-        except Exception as e:
-            logger.error(f"Error adding song to user: {e}")
-            db.rollback()
-        finally:
-            if should_close:
-                db.close()
+                return result.rowcount
+            except Exception as e:
+                logger.error(f"Error adding songs to user: {e}")
+                db.rollback()
+                return 0
     
     def get_user_songs(self, user_id: str) -> Dict:
         """
@@ -146,9 +299,12 @@ class SongStorageService:
         Returns:
             Dictionary with seed_songs, listened_songs, favorite_songs
         """
-        db: Session = SessionLocal()
-        try:
-            user_songs = db.query(UserSong).filter(
+        with session_scope() as db:
+            # selectinload fetches all songs in one IN query instead of one lazy
+            # load per row (no row duplication of the wide JSON columns)
+            user_songs = db.query(UserSong).options(
+                selectinload(UserSong.song)
+            ).filter(
                 UserSong.user_id == user_id
             ).all()
             
@@ -156,20 +312,10 @@ class SongStorageService:
             favorite_songs = []
             
             for user_song in user_songs:
-                song = user_song.song
-                song_dict = {
-                    "title": song.title,
-                    "artists": song.artists,
-                    "album": song.album,
-                    "image": song.image,
-                    "genre": song.genre,
-                    "platform": song.platform,
-                    "platform_id": song.platform_id,
-                    "youtube_video_id": song.youtube_video_id,
-                    "added_at": user_song.added_at.isoformat() if user_song.added_at else None,
-                    "source": user_song.source,
-                    "play_count": user_song.play_count
-                }
+                song_dict = _song_to_dict(user_song.song)
+                song_dict["added_at"] = user_song.added_at.isoformat() if user_song.added_at else None
+                song_dict["source"] = user_song.source
+                song_dict["play_count"] = user_song.play_count
                 
                 seed_songs.append(song_dict)
                 
@@ -181,36 +327,32 @@ class SongStorageService:
                 "listened_songs": [],  # This comes from listening history
                 "favorite_songs": favorite_songs
             }
-        finally:
-            db.close()
     
     def get_user_seed_songs(self, user_id: str) -> List[Dict]:
         """Get user's seed songs for analysis"""
         user_data = self.get_user_songs(user_id)
         return user_data.get("seed_songs", [])
     
-    def get_all_songs(self) -> List[Dict]:
-        """Get all stored songs"""
-        db: Session = SessionLocal()
-        try:
-            songs = db.query(Song).all()
-            return [
-                {
-                    "title": song.title,
-                    "artists": song.artists,
-                    "album": song.album,
-                    "image": song.image,
-                    "genre": song.genre,
-                    "platform": song.platform,
-                    "platform_id": song.platform_id,
-                    "youtube_video_id": song.youtube_video_id,
-                    "created_at": song.created_at.isoformat() if song.created_at else None,
-                    "last_updated": song.last_updated.isoformat() if song.last_updated else None
-                }
-                for song in songs
-            ]
-        finally:
-            db.close()
+    def get_all_songs(self) -> Iterator[Dict]:
+        """
+        Stream all stored songs.
+        
+        Rows are fetched in batches of _STREAM_BATCH_SIZE with a server-side
+        cursor, so the whole table is never held in memory at once. The
+        session stays open until the iterator is exhausted or closed.
+        
+        Returns:
+            Iterator of song dictionaries
+        """
+        with session_scope() as db:
+            songs = db.query(Song).execution_options(
+                stream_results=True
+            ).yield_per(_STREAM_BATCH_SIZE)
+            for song in songs:
+                song_dict = _song_to_dict(song)
+                song_dict["created_at"] = song.created_at.isoformat() if song.created_at else None
+                song_dict["last_updated"] = song.last_updated.isoformat() if song.last_updated else None
+                yield song_dict
     
     def search_songs(self, query: str, limit: int = 20) -> List[Dict]:
         """
@@ -223,46 +365,29 @@ class SongStorageService:
         Returns:
             List of matching songs
         """
-        db: Session = SessionLocal()
-        try:
+        with session_scope() as db:
             query_lower = query.lower()
             
-            # Search in title (works for both SQLite and PostgreSQL)
-            songs = db.query(Song).filter(
-                func.lower(Song.title).contains(query_lower)
-            ).limit(limit).all()
-            
-            # Also search in artists and genre by checking JSON arrays
-            # This works for both SQLite and PostgreSQL
-            additional_songs = db.query(Song).filter(
-                Song.song_id.notin_([s.song_id for s in songs])  # Exclude already found
-            ).all()
-            
-            # Filter by checking if query appears in artists or genre
-            for song in additional_songs:
-                if len(songs) >= limit:
-                    break
-                # Check artists
-                artists_str = " ".join(song.artists or []).lower()
-                genre_str = " ".join(song.genre or []).lower()
-                if query_lower in artists_str or query_lower in genre_str:
-                    songs.append(song)
+            if db.get_bind().dialect.name == "postgresql":
+                # Both predicates are served by songs_blob_trgm_idx; the
+                # word-similarity match also catches typos and partial words
+                songs = db.query(Song).filter(
+                    or_(
+                        Song.search_blob.contains(query_lower),
+                        literal(query_lower).op("<%")(Song.search_blob)
+                    )
+                ).order_by(
+                    func.word_similarity(query_lower, Song.search_blob).desc()
+                ).limit(limit).all()
+            else:
+                # Earliest match first, so title hits rank above artist/genre hits
+                songs = db.query(Song).filter(
+                    Song.search_blob.contains(query_lower)
+                ).order_by(
+                    func.instr(Song.search_blob, query_lower), Song.title
+                ).limit(limit).all()
             
-            return [
-                {
-                    "title": song.title,
-                    "artists": song.artists,
-                    "album": song.album,
-                    "image": song.image,
-                    "genre": song.genre,
-                    "platform": song.platform,
-                    "platform_id": song.platform_id,
-                    "youtube_video_id": song.youtube_video_id
-                }
-                for song in songs[:limit]
-            ]
-        finally:
-            db.close()
+            return [_song_to_dict(song) for song in songs]
     
     def get_songs_for_analysis(self, user_id: str) -> List[Dict]:
         """
@@ -272,53 +397,50 @@ class SongStorageService:
         Returns:
             List of songs formatted for analysis
         """
-        user_data = self.get_user_songs(user_id)
-        seed_songs = user_data.get("seed_songs", [])
-        
         # Get listened songs from listening history service
         from src.services.listening_history_service import get_listening_history_service
         history_service = get_listening_history_service()
         listened_songs = history_service.get_listened_songs(user_id, days=30)
         
-        # Combine and format
-        all_songs = []
-        seen = set()
-        
-        for song in seed_songs:
-            key = (song.get("title", "").lower(), "|".join([a.lower() for a in song.get("artists", [])]))
-            if key not in seen:
-                all_songs.append({
-                    "title": song.get("title", ""),
-                    "artists": song.get("artists", []),
-                    "genre": song.get("genre", [])
-                })
-                seen.add(key)
-        
-        for song in listened_songs:
-            key = (song.get("title", "").lower(), "|".join([a.lower() for a in song.get("artists", [])]))
-            if key not in seen:
-                all_songs.append({
-                    "title": song.get("title", ""),
-                    "artists": song.get("artists", []),
-                    "genre": song.get("genre", [])
-                })
-                seen.add(key)
+        with session_scope() as db:
+            # Stream only the three seed-song columns analysis needs instead of
+            # building the full get_user_songs() payload
+            seed_rows = db.query(Song.title, Song.artists, Song.genre).join(
+                UserSong, UserSong.song_id == Song.song_id
+            ).filter(
+                UserSong.user_id == user_id
+            )
+            listened_rows = (
+                (song.get("title", ""), song.get("artists", []), song.get("genre", []))
+                for song in listened_songs
+            )
+            
+            # Combine and format in one pass; the dict keeps the first occurrence
+            # of each (title, artists) key in insertion order
+            all_songs = {}
+            for title, artists, genre in itertools.chain(seed_rows, listened_rows):
+                key = (title.lower(), tuple(a.lower() for a in artists))
+                if key not in all_songs:
+                    all_songs[key] = {
+                        "title": title,
+                        "artists": artists,
+                        "genre": genre
+                    }
         
-        return all_songs
+        return list(all_songs.values())
     
     def clear_user_songs(self, user_id: str):
         """Clear all songs for a user"""
-        db: Session = SessionLocal()
-        try:
-            db.query(UserSong).filter(
-                UserSong.user_id == user_id
-            ).delete()
-            db.commit()
-        except Exception as e:
-            logger.error(f"Error clearing user songs: {e}")
-            db.rollback()
-        finally:
-            db.close()
+        with session_scope() as db:
+            try:
+                # Bulk delete; no in-session UserSong objects need syncing
+                db.execute(
+                    delete(UserSong).where(UserSong.user_id == user_id)
+                )
+                db.commit()
+            except Exception as e:
+                logger.error(f"Error clearing user songs: {e}")
+                db.rollback()
 
 
 # Singleton instance
@@ -3,11 +3,17 @@ Storage Service
 Manages JSON file storage for seed songs and listening history
 """
 
-import json
+import atexit
 import os
+import threading
 from typing import List, Dict, Optional
 from datetime import datetime
 
+import orjson
+
+_MAX_LISTENED_SONGS = 1000
+_MAX_ANALYSES = 50
+
 
 class StorageService:
     """Service for storing seed songs and listening data in JSON"""
@@ -16,7 +22,84 @@ class StorageService:
         self.data_dir = data_dir
         self.seed_songs_file = os.path.join(data_dir, "seed_songs.json")
         self.user_data_file = os.path.join(data_dir, "user_data.json")
+        # Append-only log of user data changes since the last snapshot
+        self.user_data_log_file = os.path.join(data_dir, "user_data.jsonl")
+        self.flush_interval = float(os.getenv("STORAGE_FLUSH_INTERVAL", "30"))
         os.makedirs(data_dir, exist_ok=True)
+        
+        # User data lives in memory; writes append to the log and a timer
+        # periodically compacts everything back into user_data.json
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._flush_timer: Optional[threading.Timer] = None
+        self._user_data = self._load_json(self.user_data_file, {})
+        self._replay_log()
+        atexit.register(self.flush)
+    
+    def _replay_log(self):
+        """Apply log entries written after the last snapshot"""
+        if not os.path.exists(self.user_data_log_file):
+            return
+        try:
+            with open(self.user_data_log_file, 'rb') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        entry = orjson.loads(line)
+                    except orjson.JSONDecodeError:
+                        # Torn final line from a crash mid-append
+                        continue
+                    self._apply(entry["user_id"], entry["kind"], entry["data"])
+                    self._dirty = True
+        except Exception as e:
+            print(f"Error replaying {self.user_data_log_file}: {e}")
+    
+    def _apply(self, user_id: str, kind: str, record: Dict):
+        """Apply one listened song or analysis record to the in-memory data"""
+        user = self._user_data.setdefault(user_id, {
+            "listened_songs": [],
+            "analysis_history": []
+        })
+        if kind == "listen":
+            key, limit = "listened_songs", _MAX_LISTENED_SONGS
+        else:
+            key, limit = "analysis_history", _MAX_ANALYSES
+        entries = user.setdefault(key, [])
+        entries.append(record)
+        if len(entries) > limit:
+            del entries[:-limit]
+    
+    def _record(self, user_id: str, kind: str, record: Dict):
+        """Apply a record in memory and append it to the log"""
+        with self._lock:
+            self._apply(user_id, kind, record)
+            try:
+                with open(self.user_data_log_file, 'ab') as f:
+                    f.write(orjson.dumps({"user_id": user_id, "kind": kind, "data": record}) + b"\n")
+            except Exception as e:
+                print(f"Error appending to {self.user_data_log_file}: {e}")
+            self._dirty = True
+            if self._flush_timer is None:
+                self._flush_timer = threading.Timer(self.flush_interval, self.flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+    
+    def flush(self):
+        """Compact in-memory user data into user_data.json and truncate the log"""
+        with self._lock:
+            self._flush_timer = None
+            if not self._dirty:
+                return
+            tmp_file = self.user_data_file + ".tmp"
+            if not self._save_json(tmp_file, self._user_data):
+                return
+            try:
+                os.replace(tmp_file, self.user_data_file)
+                open(self.user_data_log_file, 'w').close()
+                self._dirty = False
+            except Exception as e:
+                print(f"Error compacting {self.user_data_file}: {e}")
     
     def _load_json(self, filepath: str, default: dict = None) -> dict:
         """Load JSON file"""
@@ -24,20 +107,22 @@ class StorageService:
             default = {}
         if os.path.exists(filepath):
             try:
-                with open(filepath, 'r', encoding='utf-8') as f:
-                    return json.load(f)
+                with open(filepath, 'rb') as f:
+                    return orjson.loads(f.read())
             except Exception as e:
                 print(f"Error loading {filepath}: {e}")
                 return default
         return default
     
-    def _save_json(self, filepath: str, data: dict):
+    def _save_json(self, filepath: str, data: dict) -> bool:
         """Save JSON file"""
         try:
-            with open(filepath, 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=2, ensure_ascii=False)
+            with open(filepath, 'wb') as f:
+                f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+            return True
         except Exception as e:
             print(f"Error saving {filepath}: {e}")
+            return False
     
     def save_seed_songs(self, user_id: str, seed_songs: List[Dict]):
         """
@@ -48,10 +133,11 @@ class StorageService:
             seed_songs: List of seed songs
         """
         data = self._load_json(self.seed_songs_file, {})
+        now_iso = datetime.now().isoformat()
         data[user_id] = {
             "seed_songs": seed_songs,
-            "created_at": datetime.now().isoformat(),
-            "updated_at": datetime.now().isoformat()
+            "created_at": now_iso,
+            "updated_at": now_iso
         }
         self._save_json(self.seed_songs_file, data)
     
@@ -68,56 +154,26 @@ class StorageService:
             user_id: User identifier
             song_data: Song data with timestamp
         """
-        data = self._load_json(self.user_data_file, {})
-        
-        if user_id not in data:
-            data[user_id] = {
-                "listened_songs": [],
-                "analysis_history": []
-            }
-        
         song_data["listened_at"] = datetime.now().isoformat()
-        data[user_id]["listened_songs"].append(song_data)
-        
-        # Keep only last 1000 songs
-        if len(data[user_id]["listened_songs"]) > 1000:
-            data[user_id]["listened_songs"] = data[user_id]["listened_songs"][-1000:]
-        
-        self._save_json(self.user_data_file, data)
+        self._record(user_id, "listen", song_data)
     
     def get_listening_data(self, user_id: str, limit: Optional[int] = None) -> List[Dict]:
         """Get listening data for a user"""
-        data = self._load_json(self.user_data_file, {})
-        songs = data.get(user_id, {}).get("listened_songs", [])
+        songs = self._user_data.get(user_id, {}).get("listened_songs", [])
         
         if limit:
-            songs = songs[-limit:]
+            return songs[-limit:]
         
-        return songs
+        return list(songs)
     
     def save_analysis_result(self, user_id: str, analysis_result: Dict):
         """Save analysis result"""
-        data = self._load_json(self.user_data_file, {})
-        
-        if user_id not in data:
-            data[user_id] = {
-                "listened_songs": [],
-                "analysis_history": []
-            }
-        
         analysis_result["analyzed_at"] = datetime.now().isoformat()
-        data[user_id]["analysis_history"].append(analysis_result)
-        
-        # Keep only last 50 analyses
-        if len(data[user_id]["analysis_history"]) > 50:
-            data[user_id]["analysis_history"] = data[user_id]["analysis_history"][-50:]
-        
-        self._save_json(self.user_data_file, data)
+        self._record(user_id, "analysis", analysis_result)
     
     def get_latest_analysis(self, user_id: str) -> Optional[Dict]:
         """Get latest analysis result for a user"""
-        data = self._load_json(self.user_data_file, {})
-        history = data.get(user_id, {}).get("analysis_history", [])
+        history = self._user_data.get(user_id, {}).get("analysis_history", [])
         return history[-1] if history else None
     
     def get_all_user_data(self, user_id: str) -> Dict:
@@ -5,22 +5,71 @@ Manages persistent storage and updates of user taste profiles
 
 from typing import Dict, Optional, List
 from datetime import datetime
+from threading import Lock
 from sqlalchemy.orm import Session
 from sqlalchemy import and_
+from sqlalchemy.dialects import postgresql, sqlite
 import numpy as np
+import copy
+import hashlib
 import logging
+import os
 
-from src.database.models import TasteProfile, SessionLocal
-from src.services.embedding_service import EmbeddingService
+from src.database.models import TasteProfile
+from src.database.session import session_scope
+from src.services.embedding_service import get_embedding_service
+from src.services.ttl_cache import TTLCache
 
 logger = logging.getLogger(__name__)
 
+_DIALECT_INSERTS = {
+    "postgresql": postgresql.insert,
+    "sqlite": sqlite.insert,
+}
+
+
+def _song_signature(song: Dict) -> bytes:
+    """8-byte digest of a song's lowercased title and artists, for dedup sets"""
+    key = "\0".join([song.get("title", ""), *song.get("artists", [])]).lower()
+    return hashlib.blake2b(key.encode(), digest_size=8).digest()
+
+
+def _split_taste_vector(profile_data: Dict):
+    """Split a profile into its JSON part and the taste vector as float32 bytes"""
+    data = {k: v for k, v in profile_data.items() if k != "taste_vector"}
+    taste_vector = profile_data.get("taste_vector")
+    if taste_vector is None:
+        return data, None
+    return data, np.asarray(taste_vector, dtype=np.float32).tobytes()
+
+
+def _taste_vector(profile: TasteProfile) -> np.ndarray:
+    """Read a stored taste vector, falling back to the legacy JSON list"""
+    if profile.taste_vector_bytes is not None:
+        return np.frombuffer(profile.taste_vector_bytes, dtype=np.float32)
+    return np.asarray(profile.profile_data.get("taste_vector", []), dtype=np.float32)
+
 
 class TasteProfileService:
     """Service for managing user taste profiles in database"""
     
     def __init__(self):
-        self.embedding_service = EmbeddingService()
+        self.embedding_service = get_embedding_service()
+        # Warm profiles skip the DB; writes through this service invalidate
+        self.profile_cache = TTLCache(
+            max_size=10000,
+            ttl=float(os.getenv("PROFILE_CACHE_TTL", "60"))
+        )
+        # Bumped on every invalidation; a load only caches what it read if no
+        # write invalidated the cache meanwhile
+        self._profile_generation = 0
+        self._generation_lock = Lock()
+    
+    def _invalidate_profile(self, user_id: str):
+        """Drop a cached profile after a write"""
+        with self._generation_lock:
+            self._profile_generation += 1
+            self.profile_cache.pop(user_id)
     
     def save_profile(self, user_id: str, profile_data: Dict) -> bool:
         """
@@ -33,38 +82,41 @@ class TasteProfileService:
         Returns:
             True if saved successfully
         """
-        db: Session = SessionLocal()
-        try:
-            # Check if profile exists
-            existing = db.query(TasteProfile).filter(
-                TasteProfile.user_id == user_id
-            ).first()
-            
-            if existing:
-                # Update existing profile
-                existing.profile_data = profile_data
-                existing.song_count = profile_data.get("song_count", len(profile_data.get("seed_songs", [])))
-                existing.last_updated = datetime.utcnow()
-            else:
-                # Create new profile
-                new_profile = TasteProfile(
+        with session_scope() as db:
+            try:
+                data, taste_vector_bytes = _split_taste_vector(profile_data)
+                song_count = profile_data.get("song_count", len(profile_data.get("seed_songs", [])))
+                now = datetime.utcnow()
+                
+                # Create or update the profile in one statement (user_id is unique)
+                insert = _DIALECT_INSERTS[db.get_bind().dialect.name]
+                stmt = insert(TasteProfile).values(
                     user_id=user_id,
-                    profile_data=profile_data,
-                    song_count=profile_data.get("song_count", len(profile_data.get("seed_songs", []))),
-                    created_at=datetime.utcnow(),
-                    last_updated=datetime.utcnow()
+                    profile_data=data,
+                    taste_vector_bytes=taste_vector_bytes,
+                    song_count=song_count,
+                    created_at=now,
+                    last_updated=now
                 )
-                db.add(new_profile)
-            
-            db.commit()
-            logger.info(f"Saved taste profile for user {user_id}")
-            return True
-        except Exception as e:
-            logger.error(f"Error saving taste profile: {e}")
-            db.rollback()
-            return False
-        finally:
-            db.close()
+                db.execute(
+                    stmt.on_conflict_do_update(
+                        index_elements=["user_id"],
+                        set_={
+                            "profile_data": stmt.excluded.profile_data,
+                            "taste_vector_bytes": stmt.excluded.taste_vector_bytes,
+                            "song_count": stmt.excluded.song_count,
+                            "last_updated": stmt.excluded.last_updated
+                        }
+                    )
+                )
+                db.commit()
+                self._invalidate_profile(user_id)
+                logger.info(f"Saved taste profile for user {user_id}")
+                return True
+            except Exception as e:
+                logger.error(f"Error saving taste profile: {e}")
+                db.rollback()
+                return False
     
     def load_profile(self, user_id: str) -> Optional[Dict]:
         """
@@ -76,20 +128,31 @@ class TasteProfileService:
         Returns:
             Profile dictionary or None if not found
         """
-        db: Session = SessionLocal()
-        try:
-            profile = db.query(TasteProfile).filter(
-                TasteProfile.user_id == user_id
-            ).first()
-            
-            if profile:
-                return profile.profile_data
-            return None
-        except Exception as e:
-            logger.error(f"Error loading taste profile: {e}")
-            return None
-        finally:
-            db.close()
+        # Callers get their own copy so they can't mutate the cached profile
+        cached = self.profile_cache.get(user_id)
+        if cached is not None:
+            return copy.deepcopy(cached)
+        
+        with self._generation_lock:
+            generation = self._profile_generation
+        
+        with session_scope() as db:
+            try:
+                profile = db.query(TasteProfile).filter(
+                    TasteProfile.user_id == user_id
+                ).first()
+                
+                if profile:
+                    profile_data = {**profile.profile_data, "taste_vector": _taste_vector(profile).tolist()}
+                    with self._generation_lock:
+                        # Skip caching a profile a concurrent write already replaced
+                        if self._profile_generation == generation:
+                            self.profile_cache.put(user_id, copy.deepcopy(profile_data))
+                    return profile_data
+                return None
+            except Exception as e:
+                logger.error(f"Error loading taste profile: {e}")
+                return None
     
     def update_profile_with_new_songs(
         self,
@@ -109,86 +172,81 @@ class TasteProfileService:
         Returns:
             Updated profile dictionary or None if update failed
         """
-        db: Session = SessionLocal()
-        try:
-            # Load existing profile
-            existing_profile = db.query(TasteProfile).filter(
-                TasteProfile.user_id == user_id
-            ).first()
-            
-            if not existing_profile:
-                logger.warning(f"No existing profile found for user {user_id}, creating new one")
-                # Create new profile from new songs
-                return self._create_profile_from_songs(user_id, new_songs)
-            
-            profile_data = existing_profile.profile_data
-            existing_seed_songs = profile_data.get("seed_songs", [])
-            existing_taste_vector = np.array(profile_data.get("taste_vector", []))
-            
-            # Generate embeddings for new songs
-            new_embeddings = self.embedding_service.embed_songs_batch(new_songs)
-            
-            if not new_embeddings:
-                logger.warning(f"No embeddings generated for new songs")
-                return profile_data
-            
-            # Compute average embedding for new songs
-            new_avg_embedding = np.mean([emb[0] for emb in new_embeddings], axis=0)
-            
-            # Blend with existing taste vector using weighted average
-            if len(existing_taste_vector) > 0 and len(existing_taste_vector) == len(new_avg_embedding):
-                # Weighted average: (1-weight) * existing + weight * new
-                updated_taste_vector = (
-                    (1 - weight) * existing_taste_vector + 
-                    weight * new_avg_embedding
-                )
-            else:
-                # If dimensions don't match or existing is empty, use new
-                updated_taste_vector = new_avg_embedding
-            
-            # Merge seed songs (avoid duplicates)
-            seen_songs = {
-                (s.get("title", "").lower(), 
-                 "|".join([a.lower() for a in s.get("artists", [])]))
-                for s in existing_seed_songs
-            }
-            
-            merged_seed_songs = existing_seed_songs.copy()
-            for new_song in new_songs:
-                song_key = (
-                    new_song.get("title", "").lower(),
-                    "|".join([a.lower() for a in new_song.get("artists", [])])
-                )
-                if song_key not in seen_songs:
-                    merged_seed_songs.append(new_song)
-                    seen_songs.add(song_key)
-            
-            # Update profile data
-            updated_profile = {
-                "user_id": user_id,
-                "seed_songs": merged_seed_songs,
-                "taste_vector": updated_taste_vector.tolist(),
-                "song_count": len(merged_seed_songs),
-                "status": "complete",
-                "last_updated": datetime.utcnow().isoformat()
-            }
-            
-            # Save updated profile
-            existing_profile.profile_data = updated_profile
-            existing_profile.song_count = len(merged_seed_songs)
-            existing_profile.last_updated = datetime.utcnow()
-            
-            db.commit()
-            logger.info(f"Updated taste profile for user {user_id} with {len(new_songs)} new songs")
-            
-            return updated_profile
-            
-        except Exception as e:
-            logger.error(f"Error updating taste profile: {e}")
-            db.rollback()
-            return None
-        finally:
-            db.close()
+        with session_scope() as db:
+            try:
+                # Load existing profile
+                existing_profile = db.query(TasteProfile).filter(
+                    TasteProfile.user_id == user_id
+                ).first()
+                
+                if not existing_profile:
+                    logger.warning(f"No existing profile found for user {user_id}, creating new one")
+                    # Create new profile from new songs
+                    return self._create_profile_from_songs(user_id, new_songs)
+                
+                profile_data = existing_profile.profile_data
+                existing_seed_songs = profile_data.get("seed_songs", [])
+                existing_taste_vector = _taste_vector(existing_profile)
+                
+                # Generate embeddings for new songs
+                new_embeddings = self.embedding_service.embed_songs_batch(new_songs)
+                
+                if not new_embeddings:
+                    logger.warning(f"No embeddings generated for new songs")
+                    return {**profile_data, "taste_vector": existing_taste_vector.tolist()}
+                
+                # Compute average embedding for new songs (one contiguous float32 matrix)
+                new_embedding_matrix = np.asarray([emb[0] for emb in new_embeddings], dtype=np.float32)
+                new_avg_embedding = new_embedding_matrix.mean(axis=0, dtype=np.float32)
+                
+                # Blend with existing taste vector using weighted average
+                if len(existing_taste_vector) > 0 and len(existing_taste_vector) == len(new_avg_embedding):
+                    # Weighted average: (1-weight) * existing + weight * new
+                    # (both operands are float32, so the blend stays float32)
+                    updated_taste_vector = (
+                        (1 - weight) * existing_taste_vector + 
+                        weight * new_avg_embedding
+                    )
+                else:
+                    # If dimensions don't match or existing is empty, use new
+                    updated_taste_vector = new_avg_embedding
+                
+                # Merge seed songs (avoid duplicates)
+                seen_songs = {_song_signature(s) for s in existing_seed_songs}
+                
+                merged_seed_songs = list(existing_seed_songs)
+                for new_song in new_songs:
+                    signature = _song_signature(new_song)
+                    if signature not in seen_songs:
+                        merged_seed_songs.append(new_song)
+                        seen_songs.add(signature)
+                
+                # Update profile data
+                now = datetime.utcnow()
+                updated_profile = {
+                    "user_id": user_id,
+                    "seed_songs": merged_seed_songs,
+                    "taste_vector": updated_taste_vector.tolist(),
+                    "song_count": len(merged_seed_songs),
+                    "status": "complete",
+                    "last_updated": now.isoformat()
+                }
+                
+                # Save updated profile
+                existing_profile.profile_data, existing_profile.taste_vector_bytes = _split_taste_vector(updated_profile)
+                existing_profile.song_count = len(merged_seed_songs)
+                existing_profile.last_updated = now
+                
+                db.commit()
+                self._invalidate_profile(user_id)
+                logger.info(f"Updated taste profile for user {user_id} with {len(new_songs)} new songs")
+                
+                return updated_profile
+                
+            except Exception as e:
+                logger.error(f"Error updating taste profile: {e}")
+                db.rollback()
+                return None
     
     def _create_profile_from_songs(self, user_id: str, songs: List[Dict]) -> Optional[Dict]:
         """Create a new profile from songs"""
@@ -200,16 +258,17 @@ class TasteProfileService:
                 return None
             
             # Compute average embedding
-            avg_embedding = np.mean([emb[0] for emb in embeddings], axis=0)
+            avg_embedding = np.asarray([emb[0] for emb in embeddings], dtype=np.float32).mean(axis=0, dtype=np.float32)
             
+            now_iso = datetime.utcnow().isoformat()
             profile_data = {
                 "user_id": user_id,
                 "seed_songs": songs,
                 "taste_vector": avg_embedding.tolist(),
                 "song_count": len(songs),
                 "status": "complete",
-                "created_at": datetime.utcnow().isoformat(),
-                "last_updated": datetime.utcnow().isoformat()
+                "created_at": now_iso,
+                "last_updated": now_iso
             }
             
             # Save to database
@@ -222,24 +281,23 @@ class TasteProfileService:
     
     def delete_profile(self, user_id: str) -> bool:
         """Delete taste profile for a user"""
-        db: Session = SessionLocal()
-        try:
-            profile = db.query(TasteProfile).filter(
-                TasteProfile.user_id == user_id
-            ).first()
-            
-            if profile:
-                db.delete(profile)
-                db.commit()
-                logger.info(f"Deleted taste profile for user {user_id}")
-                return True
-            return False
-        except Exception as e:
-            logger.error(f"Error deleting taste profile: {e}")
-            db.rollback()
-            return False
-        finally:
-            db.close()
+        with session_scope() as db:
+            try:
+                profile = db.query(TasteProfile).filter(
+                    TasteProfile.user_id == user_id
+                ).first()
+                
+                if profile:
+                    db.delete(profile)
+                    db.commit()
+                    self._invalidate_profile(user_id)
+                    logger.info(f"Deleted taste profile for user {user_id}")
+                    return True
+                return False
+            except Exception as e:
+                logger.error(f"Error deleting taste profile: {e}")
+                db.rollback()
+                return False
 
 
 # Singleton instance
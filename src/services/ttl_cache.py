@@ -0,0 +1,43 @@
+"""
+TTL Cache
+Small in-process LRU cache with per-entry expiry, shared by the services
+"""
+
+from collections import OrderedDict
+from threading import Lock
+import time
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire after ``ttl`` seconds"""
+    
+    def __init__(self, max_size: int = 10000, ttl: float = 3600):
+        self.cache = OrderedDict()  # key -> (expires_at, value)
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = Lock()
+    
+    def get(self, key):
+        """Get a live cached value, or None"""
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self.cache[key]
+                return None
+            self.cache.move_to_end(key)
+            return entry[1]
+    
+    def put(self, key, value):
+        """Cache a value, evicting the least recently used entry if full"""
+        with self.lock:
+            self.cache[key] = (time.monotonic() + self.ttl, value)
+            self.cache.move_to_end(key)
+            if len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+    
+    def pop(self, key):
+        """Drop a cached value if present"""
+        with self.lock:
+            self.cache.pop(key, None)
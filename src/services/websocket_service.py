@@ -3,29 +3,241 @@ WebSocket Service
 Handles Socket.IO connections, authentication, and real-time events
 """
 
+import asyncio
 import socketio
-from typing import Dict, Optional, Set
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set, Tuple
 import logging
 from datetime import datetime
-import json
+import orjson
+import os
+import time
+from urllib.parse import parse_qs
 
 from src.services.auth_service import get_auth_service
 from src.services.room_service import get_room_service
+from src.services.ttl_cache import TTLCache
 
 logger = logging.getLogger(__name__)
 
+# Per-socket token bucket for fanout events (sync_state, room_chat)
+_EVENT_RATE = float(os.getenv("SOCKET_EVENT_RATE", "30"))  # tokens refilled per second
+_EVENT_BURST = float(os.getenv("SOCKET_EVENT_BURST", "60"))  # bucket capacity
+
+# sync_state updates are coalesced per room and handed to the room service
+# at most once per window; listeners still get every update immediately
+_SYNC_WRITE_DELAY = 0.5  # seconds
+
+# How long a host recorded in room_hosts is trusted before sync_state re-checks
+# the room service (the host can change on another worker or over HTTP)
+_HOST_RECHECK_INTERVAL = 2.0  # seconds
+
+# Try to import the asyncio Redis client (optional cross-worker fanout)
+try:
+    import redis.asyncio
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+
+
+def _create_client_manager() -> Optional[socketio.AsyncManager]:
+    """
+    Pick the Socket.IO client manager.
+    
+    With REDIS_URL set, emits are published through Redis so every worker
+    fans them out to its own clients, allowing several uvicorn workers.
+    The load balancer must keep each client on one worker (sticky
+    sessions, e.g. nginx ip_hash) for the HTTP long-polling transport.
+    """
+    redis_url = os.getenv("REDIS_URL")
+    if not redis_url:
+        return None
+    if not REDIS_AVAILABLE:
+        logger.warning("REDIS_URL is set but redis is not installed; Socket.IO emits stay local to this worker")
+        return None
+    logger.info("Socket.IO fanout backed by Redis")
+    return socketio.AsyncRedisManager(redis_url)
+
+
+class _OrjsonModule:
+    """json-module stand-in so Socket.IO and Engine.IO encode packets with orjson"""
+    
+    @staticmethod
+    def dumps(obj, *args, **kwargs) -> str:
+        # Socket.IO passes separators=...; orjson output is already compact
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+    
+    @staticmethod
+    def loads(s, *args, **kwargs):
+        return orjson.loads(s)
+
+
 # Create Socket.IO server
 sio = socketio.AsyncServer(
+    client_manager=_create_client_manager(),
+    json=_OrjsonModule,
     cors_allowed_origins="*",  # Configure in production
     async_mode='asgi',
-    logger=True,
-    engineio_logger=True
+    # Engine.IO heartbeats detect dead clients; a missed pong triggers disconnect
+    ping_interval=25,
+    ping_timeout=20,
+    # Per-event Socket.IO logging is opt-in; Engine.IO frame logging stays off
+    logger=os.getenv("SIO_DEBUG") == "1",
+    engineio_logger=False
 )
 
-# Track connected users and their rooms
-connected_users: Dict[str, Dict] = {}  # {user_id: {socket_id, room_id, last_ping}}
-user_socket_map: Dict[str, str] = {}  # {socket_id: user_id}
-room_users: Dict[str, Set[str]] = {}  # {room_id: {user_id, ...}}
+# With the Redis manager a room's sockets are spread over several workers, so
+# sio.manager only sees this worker's share of each room
+_MULTI_WORKER = isinstance(sio.manager, socketio.AsyncRedisManager)
+
+
+@dataclass(slots=True)
+class Connection:
+    """State of one authenticated socket"""
+    user_id: str
+    username: str
+    connected_at: datetime
+    room_id: Optional[str] = None
+    tokens: float = _EVENT_BURST
+    last_refill: float = field(default_factory=time.monotonic)
+    
+    def take_token(self) -> bool:
+        """Refill the rate-limit bucket and consume one token if available"""
+        now = time.monotonic()
+        self.tokens = min(_EVENT_BURST, self.tokens + (now - self.last_refill) * _EVENT_RATE)
+        self.last_refill = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+# Track connected sockets and their rooms
+connections: Dict[str, Connection] = {}  # {socket_id: Connection}
+user_sids: Dict[str, str] = {}  # {user_id: socket_id}
+room_participants_cache: Dict[str, List[Dict]] = {}  # {room_id: participants}, dropped on membership change
+room_hosts: Dict[str, Tuple[str, float]] = {}  # {room_id: (host user_id, time.monotonic() checked)}
+room_songs: Dict[str, Dict] = {}  # {room_id: current_song last sent in state_synced}
+username_cache = TTLCache(max_size=10000, ttl=300)  # {user_id: username} for users on other workers
+# {room_id: (playback_state, current_song, user_id, received_at)} awaiting a flush
+pending_writes: Dict[str, Tuple[Dict, Optional[Dict], str, datetime]] = {}
+_flush_tasks: Set[asyncio.Task] = set()  # keeps scheduled flushes from being garbage collected
+
+
+async def _remove_room_member(sid: str, room_id: str) -> bool:
+    """
+    Take a socket out of a Socket.IO room.
+    
+    Returns:
+        True if the socket was in the room (membership changed)
+    """
+    if room_id not in sio.rooms(sid):
+        return False
+    await sio.leave_room(sid, room_id)
+    room_participants_cache.pop(room_id, None)
+    if next(sio.manager.get_participants('/', room_id), None) is None:
+        room_hosts.pop(room_id, None)
+        room_songs.pop(room_id, None)
+    return True
+
+
+def _note_room_host(room_id: str, result: Optional[Dict]):
+    """Record the host reported by a leave, if this worker still tracks the room"""
+    if result and room_id in room_hosts:
+        room_hosts[room_id] = (result["host_id"], time.monotonic())
+
+
+def forget_room_host(room_id: str):
+    """Drop a room's recorded host after it changed outside Socket.IO (e.g. an HTTP leave)"""
+    room_hosts.pop(room_id.upper(), None)
+
+
+def _queue_room_state(room_id: str, playback_state: Dict, current_song: Optional[Dict], user_id: str, received_at: datetime):
+    """Buffer the latest sync_state for a room, scheduling a flush if none is pending"""
+    pending = pending_writes.get(room_id)
+    if pending is None:
+        task = asyncio.create_task(_flush_room_state(room_id))
+        _flush_tasks.add(task)
+        task.add_done_callback(_flush_tasks.discard)
+    elif current_song is None:
+        # Keep a song change from earlier in the window
+        current_song = pending[1]
+    pending_writes[room_id] = (playback_state, current_song, user_id, received_at)
+
+
+def _with_pending_state(room_id: str, room_state: Optional[Dict]) -> Optional[Dict]:
+    """Overlay a room's not-yet-flushed sync_state on state read from the room service"""
+    pending = pending_writes.get(room_id)
+    if room_state is None or pending is None:
+        return room_state
+    playback_state, current_song, _, _ = pending
+    room_state = {**room_state, "playback_state": playback_state}
+    if current_song is not None:
+        room_state["current_song"] = current_song
+    return room_state
+
+
+async def _flush_room_state(room_id: str):
+    """Persist the newest buffered sync_state for a room after the coalescing window"""
+    await asyncio.sleep(_SYNC_WRITE_DELAY)
+    playback_state, current_song, user_id, received_at = pending_writes.pop(room_id)
+    try:
+        await asyncio.to_thread(
+            get_room_service().update_room_state,
+            room_id=room_id,
+            user_id=user_id,
+            current_song=current_song,
+            playback_state=playback_state,
+            updated_at=received_at
+        )
+    except Exception as e:
+        logger.error(f"Error persisting state for room {room_id}: {e}")
+        if sid := user_sids.get(user_id):
+            await sio.emit('error', {
+                "message": str(e),
+                "code": "UPDATE_FAILED"
+            }, room=sid)
+
+
+def _room_usernames(room_id: str) -> Dict[str, str]:
+    """Map user_id to username for this worker's authenticated sockets in a room"""
+    usernames = {}
+    for participant_sid, _ in sio.manager.get_participants('/', room_id):
+        # Sockets already dropped from connections (mid-disconnect) are skipped
+        conn = connections.get(participant_sid)
+        if conn is not None:
+            usernames[conn.user_id] = conn.username
+    return usernames
+
+
+async def _reject_rate_limited(sid: str):
+    """Tell a client its event was dropped by the rate limit"""
+    await sio.emit('error', {
+        "message": "Too many events, slow down",
+        "code": "RATE_LIMIT"
+    }, room=sid)
+
+
+def _lookup_usernames(user_ids: List[str]) -> Dict[str, str]:
+    """Fetch display names for several users in one query"""
+    from src.database.models import User
+    from src.database.session import session_scope
+    with session_scope() as db:
+        rows = db.query(User.user_id, User.username, User.name).filter(
+            User.user_id.in_(user_ids)
+        ).all()
+    return {row.user_id: row.username or row.name or row.user_id for row in rows}
+
+
+def _lookup_username(user_id: str) -> str:
+    """Fetch a user's display name once per connection"""
+    from src.database.models import User
+    from src.database.session import session_scope
+    with session_scope() as db:
+        row = db.query(User.username, User.name).filter(User.user_id == user_id).first()
+    if row:
+        return row.username or row.name or user_id
+    return "User"
 
 
 @sio.event
@@ -40,40 +252,45 @@ async def connect(sid, environ, auth):
         if auth and isinstance(auth, dict):
             token = auth.get('token')
         
-        if not token:
-            # Try query parameter
-            query_string = environ.get('QUERY_STRING', '')
-            if query_string:
-                params = dict(param.split('=') for param in query_string.split('&') if '=' in param)
-                token = params.get('token')
+        if not token and (query_string := environ.get('QUERY_STRING')):
+            # Try query parameter (parse_qs also handles '=' inside the value)
+            token = parse_qs(query_string).get('token', [None])[0]
         
         if not token:
             logger.warning(f"Connection rejected: No token provided for {sid}")
             return False
         
-        # Verify token
+        # Verify token (a session-table lookup) off the event loop
         auth_service = get_auth_service()
-        user_id = auth_service.verify_token(token)
+        user_id = await asyncio.to_thread(auth_service.verify_token, token)
         
         if not user_id:
             logger.warning(f"Connection rejected: Invalid token for {sid}")
             return False
         
+        # Resolve the display name once; chat and participant lists reuse it
+        try:
+            username = await asyncio.to_thread(_lookup_username, user_id)
+        except Exception as e:
+            logger.error(f"Error fetching username for {user_id}: {e}")
+            username = "User"
+        
         # Store connection info
-        connected_users[user_id] = {
-            "socket_id": sid,
-            "room_id": None,
-            "last_ping": datetime.utcnow(),
-            "connected_at": datetime.utcnow()
-        }
-        user_socket_map[sid] = user_id
+        now = datetime.utcnow()
+        connections[sid] = Connection(
+            user_id=user_id,
+            username=username,
+            connected_at=now
+        )
+        user_sids[user_id] = sid
         
         logger.info(f"User {user_id} connected (socket: {sid})")
         
         # Send connection confirmation
         await sio.emit('connected', {
             "user_id": user_id,
-            "timestamp": datetime.utcnow().isoformat()
+            "username": username,
+            "timestamp": now.isoformat()
         }, room=sid)
         
         return True
@@ -86,37 +303,37 @@ async def connect(sid, environ, auth):
 async def disconnect(sid):
     """Handle client disconnection"""
     try:
-        user_id = user_socket_map.get(sid)
-        if not user_id:
+        if (conn := connections.pop(sid, None)) is None:
             return
+        user_id = conn.user_id
+        # A newer socket for the same user keeps its mapping
+        if user_sids.get(user_id) == sid:
+            del user_sids[user_id]
         
         # Get room info
-        user_info = connected_users.get(user_id, {})
-        room_id = user_info.get("room_id")
+        room_id = conn.room_id
         
         # Remove from room
         if room_id:
-            room_users[room_id] = room_users.get(room_id, set()) - {user_id}
+            changed = await _remove_room_member(sid, room_id)
             
             # Leave room in database
             room_service = get_room_service()
             try:
-                room_service.leave_room(room_id, user_id)
+                result = await asyncio.to_thread(room_service.leave_room, room_id, user_id)
+                _note_room_host(room_id, result)
             except:
                 pass
             
-            # Notify other users in room
-            await sio.emit('user_left', {
-                "user_id": user_id,
-                "timestamp": datetime.utcnow().isoformat()
-            }, room=room_id)
-            
-            # Broadcast updated participant list
-            await broadcast_participant_list(room_id)
-        
-        # Clean up
-        del connected_users[user_id]
-        del user_socket_map[sid]
+            # Notify the room only if membership actually changed
+            if changed:
+                await sio.emit('user_left', {
+                    "user_id": user_id,
+                    "timestamp": datetime.utcnow().isoformat()
+                }, room=room_id)
+                
+                # Broadcast updated participant list
+                await broadcast_participant_list(room_id)
         
         logger.info(f"User {user_id} disconnected (socket: {sid})")
     except Exception as e:
@@ -135,13 +352,13 @@ async def join_room(sid, data):
     }
     """
     try:
-        user_id = user_socket_map.get(sid)
-        if not user_id:
+        if (conn := connections.get(sid)) is None:
             await sio.emit('error', {
                 "message": "Not authenticated",
                 "code": "AUTH_REQUIRED"
             }, room=sid)
             return
+        user_id = conn.user_id
         
         room_id = data.get('room_id')
         if not room_id:
@@ -156,7 +373,7 @@ async def join_room(sid, data):
         # Join room in database
         room_service = get_room_service()
         try:
-            room_state = room_service.join_room(room_id, user_id)
+            room_state = await asyncio.to_thread(room_service.join_room, room_id, user_id)
         except ValueError as e:
             await sio.emit('error', {
                 "message": str(e),
@@ -165,29 +382,33 @@ async def join_room(sid, data):
             return
         
         # Update tracking
-        connected_users[user_id]["room_id"] = room_id
-        if room_id not in room_users:
-            room_users[room_id] = set()
-        room_users[room_id].add(user_id)
+        conn.room_id = room_id
+        room_hosts[room_id] = (room_state["host_id"], time.monotonic())
         
-        # Join Socket.IO room
+        # Join Socket.IO room; it is the source of truth for membership
         await sio.enter_room(sid, room_id)
+        room_participants_cache.pop(room_id, None)
+        # The next state_synced carries the song so the newcomer can't miss it
+        room_songs.pop(room_id, None)
         
-        # Get current room state
-        current_state = room_service.get_room_state(room_id)
+        # Get current room state, including any update still being coalesced
+        current_state = _with_pending_state(
+            room_id, await asyncio.to_thread(room_service.get_room_state, room_id)
+        )
         
         # Send confirmation to user
+        timestamp = datetime.utcnow().isoformat()
         await sio.emit('room_joined', {
             "room_id": room_id,
             "room_state": current_state,
             "is_host": current_state["host_id"] == user_id if current_state else False,
-            "timestamp": datetime.utcnow().isoformat()
+            "timestamp": timestamp
         }, room=sid)
         
         # Notify others in room
         await sio.emit('user_joined', {
             "user_id": user_id,
-            "timestamp": datetime.utcnow().isoformat()
+            "timestamp": timestamp
         }, room=room_id, skip_sid=sid)
         
         # Broadcast updated participant list to everyone in the room
@@ -213,12 +434,11 @@ async def leave_room_socket(sid, data):
     }
     """
     try:
-        user_id = user_socket_map.get(sid)
-        if not user_id:
+        if (conn := connections.get(sid)) is None:
             return
+        user_id = conn.user_id
         
-        user_info = connected_users.get(user_id, {})
-        room_id = data.get('room_id') or user_info.get("room_id")
+        room_id = data.get('room_id') or conn.room_id
         
         if not room_id:
             await sio.emit('error', {
@@ -232,31 +452,32 @@ async def leave_room_socket(sid, data):
         # Leave room in database
         room_service = get_room_service()
         try:
-            room_service.leave_room(room_id, user_id)
+            result = await asyncio.to_thread(room_service.leave_room, room_id, user_id)
         except:
-            pass
+            result = None
         
         # Update tracking
-        connected_users[user_id]["room_id"] = None
-        if room_id in room_users:
-            room_users[room_id] = room_users[room_id] - {user_id}
+        conn.room_id = None
         
         # Leave Socket.IO room
-        await sio.leave_room(sid, room_id)
+        changed = await _remove_room_member(sid, room_id)
+        _note_room_host(room_id, result)
         
-        # Notify others in room
-        await sio.emit('user_left', {
-            "user_id": user_id,
-            "timestamp": datetime.utcnow().isoformat()
-        }, room=room_id)
-        
-        # Broadcast updated participant list
-        await broadcast_participant_list(room_id)
+        # Notify others in room only if membership actually changed
+        timestamp = datetime.utcnow().isoformat()
+        if changed:
+            await sio.emit('user_left', {
+                "user_id": user_id,
+                "timestamp": timestamp
+            }, room=room_id)
+            
+            # Broadcast updated participant list
+            await broadcast_participant_list(room_id)
         
         # Send confirmation to user
         await sio.emit('room_left', {
             "room_id": room_id,
-            "timestamp": datetime.utcnow().isoformat()
+            "timestamp": timestamp
         }, room=sid)
         
         logger.info(f"User {user_id} left room {room_id}")
@@ -281,11 +502,14 @@ async def sync_state(sid, data):
     }
     """
     try:
-        user_id = user_socket_map.get(sid)
-        if not user_id:
+        if (conn := connections.get(sid)) is None:
+            return
+        user_id = conn.user_id
+        if not conn.take_token():
+            await _reject_rate_limited(sid)
             return
         
-        room_id = data.get('room_id')
+        room_id = data.get('room_id') or conn.room_id
         playback_state = data.get('playback_state')
         current_song = data.get('current_song')
         
@@ -298,28 +522,45 @@ async def sync_state(sid, data):
         
         room_id = room_id.upper()
         
-        # Update room state (only host can do this)
+        # Only the host can update; trust the recently checked host without
+        # touching the room service. A mismatch or an old check re-reads it,
+        # since the host may have changed on another worker or over HTTP.
         room_service = get_room_service()
-        try:
-            room_service.update_room_state(
-                room_id=room_id,
-                user_id=user_id,
-                current_song=current_song,
-                playback_state=playback_state
-            )
-        except ValueError as e:
-            await sio.emit('error', {
-                "message": str(e),
-                "code": "UPDATE_FAILED"
-            }, room=sid)
-            return
-        
-        # Broadcast to all in room (except sender)
-        await sio.emit('state_synced', {
+        host = room_hosts.get(room_id)
+        now_mono = time.monotonic()
+        if host is None or host[0] != user_id or now_mono - host[1] > _HOST_RECHECK_INTERVAL:
+            room_state = await asyncio.to_thread(room_service.get_room_state, room_id)
+            if room_state and room_id in room_hosts:
+                room_hosts[room_id] = (room_state["host_id"], now_mono)
+            if not room_state or room_state["host_id"] != user_id:
+                await sio.emit('error', {
+                    "message": "Only host can update room state",
+                    "code": "UPDATE_FAILED"
+                }, room=sid)
+                return
+        
+        # Stamp with server time now; the room service write is coalesced
+        now = datetime.utcnow()
+        timestamp = now.isoformat()
+        playback_state["timestamp"] = timestamp
+        _queue_room_state(room_id, playback_state, current_song, user_id, now)
+        
+        # Broadcast to all in room (except sender). Most updates only move the
+        # playback position, so the song is sent only when it changes. With
+        # several workers a listener may join on a worker that can't reset
+        # this worker's room_songs (or see its pending write), so the song is
+        # then sent every time. A room
+        # emit is encoded once by the manager and the same frame is queued to
+        # every participant, so there is no per-recipient serialization to
+        # avoid here; looping sio.send over participants would be slower.
+        payload = {
             "playback_state": playback_state,
-            "current_song": current_song,
-            "timestamp": datetime.utcnow().isoformat()
-        }, room=room_id, skip_sid=sid)
+            "timestamp": timestamp
+        }
+        if current_song is not None and (_MULTI_WORKER or current_song != room_songs.get(room_id)):
+            room_songs[room_id] = current_song
+            payload["current_song"] = current_song
+        await sio.emit('state_synced', payload, room=room_id, skip_sid=sid)
         
         logger.debug(f"State synced in room {room_id} by {user_id}")
     except Exception as e:
@@ -338,11 +579,14 @@ async def room_chat(sid, data):
     }
     """
     try:
-        user_id = user_socket_map.get(sid)
-        if not user_id:
+        if (conn := connections.get(sid)) is None:
+            return
+        user_id = conn.user_id
+        if not conn.take_token():
+            await _reject_rate_limited(sid)
             return
         
-        room_id = data.get('room_id')
+        room_id = data.get('room_id') or conn.room_id
         message = data.get('message')
         
         if not room_id or not message:
@@ -350,27 +594,14 @@ async def room_chat(sid, data):
         
         room_id = room_id.upper()
         
-        # In a real app, we'd fetch the name from DB. 
-        # For efficiency, we can pass it from client or use a cached name if available.
-        # Let's try to get user info if possible
-        username = "User"
-        try:
-            from src.database.models import User, SessionLocal
-            db = SessionLocal()
-            user = db.query(User).filter(User.user_id == user_id).first()
-            if user:
-                username = user.username or user.name or user_id
-            db.close()
-        except:
-            pass
-
-        # Broadcast message to everyone in the room
+        # Broadcast message to the rest of the room; the sender renders its
+        # own message locally
         await sio.emit('room_chat', {
             "user_id": user_id,
-            "username": username,
+            "username": conn.username,  # resolved at connect, no DB round-trip
             "message": message,
             "timestamp": datetime.utcnow().isoformat()
-        }, room=room_id)
+        }, room=room_id, skip_sid=sid)
         
         logger.info(f"Chat in room {room_id} from {user_id}: {message[:50]}...")
     except Exception as e:
@@ -388,11 +619,10 @@ async def request_sync(sid, data):
     }
     """
     try:
-        user_id = user_socket_map.get(sid)
-        if not user_id:
+        if (conn := connections.get(sid)) is None:
             return
         
-        room_id = data.get('room_id')
+        room_id = data.get('room_id') or conn.room_id
         if not room_id:
             return
         
@@ -400,7 +630,9 @@ async def request_sync(sid, data):
         
         # Get current room state
         room_service = get_room_service()
-        room_state = room_service.get_room_state(room_id)
+        room_state = _with_pending_state(
+            room_id, await asyncio.to_thread(room_service.get_room_state, room_id)
+        )
         
         if room_state:
             await sio.emit('state_synced', {
@@ -412,48 +644,58 @@ async def request_sync(sid, data):
         logger.error(f"Error in request_sync: {e}")
 
 
-@sio.event
-async def ping(sid, data):
-    """Handle ping for connection keepalive"""
-    try:
-        user_id = user_socket_map.get(sid)
-        if user_id and user_id in connected_users:
-            connected_users[user_id]["last_ping"] = datetime.utcnow()
-        
-        await sio.emit('pong', {
-            "timestamp": datetime.utcnow().isoformat()
-        }, room=sid)
-    except Exception as e:
-        logger.error(f"Error in ping: {e}")
+async def _shared_room_participants(room_id: str) -> List[Dict]:
+    """
+    Participant list for a room whose sockets may live on other workers.
+    
+    Membership comes from the room service (shared through Redis); names of
+    users connected here are known, the rest are batched into one query.
+    """
+    room_state = await asyncio.to_thread(get_room_service().get_room_state, room_id)
+    user_ids = room_state["participants"] if room_state else []
+    
+    names = {}
+    missing = []
+    for uid in user_ids:
+        if (uid_sid := user_sids.get(uid)) and (conn := connections.get(uid_sid)):
+            names[uid] = conn.username
+        elif username := username_cache.get(uid):
+            names[uid] = username
+        else:
+            missing.append(uid)
+    
+    if missing:
+        fetched = await asyncio.to_thread(_lookup_usernames, missing)
+        for uid, username in fetched.items():
+            names[uid] = username
+            username_cache.put(uid, username)
+    
+    return [
+        {"user_id": uid, "username": names.get(uid, "Unknown User")}
+        for uid in user_ids
+    ]
 
 
 async def broadcast_participant_list(room_id: str):
     """Broadcast the list of currently online participants in a room"""
     try:
-        user_ids = list(room_users.get(room_id, set()))
-        if not user_ids:
-            return
-
-        participants = []
-        try:
-            from src.database.models import User, SessionLocal
-            db = SessionLocal()
-            users = db.query(User).filter(User.user_id.in_(user_ids)).all()
-            
-            # Create a map for quick lookup
-            user_map = {u.user_id: u.username or u.name or u.user_id for u in users}
-            
-            for uid in user_ids:
-                participants.append({
-                    "user_id": uid,
-                    "username": user_map.get(uid, "Unknown User")
-                })
-            db.close()
-        except Exception as e:
-            logger.error(f"Error fetching usernames for participant list: {e}")
-            # Fallback to just IDs if DB fails
-            for uid in user_ids:
-                participants.append({"user_id": uid, "username": uid})
+        # Other workers change membership without touching this worker's
+        # cache, so the shared list is rebuilt every time
+        if _MULTI_WORKER:
+            participants = await _shared_room_participants(room_id)
+            if not participants:
+                return
+        # Membership changes drop the cached list; otherwise reuse it
+        elif (participants := room_participants_cache.get(room_id)) is None:
+            # Names were resolved at connect, so no DB round-trip is needed
+            usernames = _room_usernames(room_id)
+            if not usernames:
+                return
+            participants = [
+                {"user_id": uid, "username": username}
+                for uid, username in usernames.items()
+            ]
+            room_participants_cache[room_id] = participants
 
         await sio.emit('room_participants_update', {
             "room_id": room_id,
@@ -17,7 +17,7 @@ from datetime import datetime
 from sqlalchemy.orm import Session
 from sqlalchemy import func, or_, and_
 
-from src.database.models import Song, SessionLocal
+from src.database.models import Song, SessionLocal, song_search_blob
 
 # For fuzzy string matching
 import difflib
@@ -535,7 +535,8 @@ class YouTubeService:
                     youtube_video_id=video_id,
                     platform="youtube_cache",
                     created_at=datetime.utcnow(),
-                    last_updated=datetime.utcnow()
+                    last_updated=datetime.utcnow(),
+                    search_blob=song_search_blob(song_title.strip(), artists_list, [])
                 )
                 db.add(song)
                 db.commit()
@@ -8,6 +8,7 @@ class FriendRoomClient {
         this.apiBase = apiBase;
         this.token = token;
         this.userId = null;
+        this.username = null;
         this.socket = null;
         this.currentRoom = null;
         this.isHost = false;
@@ -93,6 +94,7 @@ class FriendRoomClient {
         this.socket.on('connected', (data) => {
             console.log('Authenticated:', data);
             this.userId = data.user_id;
+            this.username = data.username;
         });
 
         this.socket.on('room_joined', (data) => {
@@ -181,6 +183,16 @@ class FriendRoomClient {
             room_id: rId,
             message: message.trim()
         });
+
+        // The server doesn't echo our own messages back; show them right away
+        if (this.onRoomChat) {
+            this.onRoomChat({
+                user_id: this.userId,
+                username: this.username,
+                message: message.trim(),
+                timestamp: new Date().toISOString()
+            });
+        }
     }
 
     /**